@@ -4,11 +4,24 @@ backtracks.py
 Routines to calculate the tidal stripping of a satellite galaxy in reverse
 from present to infall.
 """
-import scipy.optimize as opt
+import numpy as np
+import instrument
 import profileclass
 import rubiatracks
 from astropy import units
 
+def _historysteps(halo_history):
+    # Per stripping step (present first) the mass loss ratio of the step and
+    # the scale radius in kpc of the halo before it, with each rmax and
+    # enclosed mass evaluated once.
+    rmax = [halo.get_rmax() for halo in halo_history]
+    delm = np.array([(halo_history[i-1].get_mass(rmax[i-1]) /
+        halo_history[i-1].get_mass(rmax[i])).value
+        for i in range(1, len(halo_history))])
+    rs = np.array([halo.rs.to(units.kpc).value for halo in halo_history[1:]])
+    return delm, rs
+
+@instrument.staged
 def cdmgal_backtracks(mstar, rstar, halo_history):
     """
     Return the stellar mass and half-light radius of a satellite galaxy when
@@ -30,16 +43,10 @@ def cdmgal_backtracks(mstar, rstar, halo_history):
         # mass loss ratio of this stripping.
         delm = (strippedhalo.get_mass(strippedhalo.get_rmax()) / \
             strippedhalo.get_mass(starthalo.get_rmax())).value
-        # solve for rovera before stripping with:
+        # rovera before stripping, inverting
         #   strippedrovera=rubiatracks.getrhfinal(delm, 1, rovera,...)*rovera
-        fsresult = opt.fsolve(lambda x: rubiatracks.getrhfinal(delm, 1, x,
-            minrmax=True)*x/strippedrovera - 1.0, strippedrovera,full_output=True)
-
-        if fsresult[2] == 1:
-          rovera = fsresult[0][0]
-        else:
-          rovera = strippedrovera
-          print(r"Error in cdmgal_backtracks with interpolation using fsolve: %s" % fsresult.mesg)
+        rovera = rubiatracks.getroverainitial(delm, 1, strippedrovera,
+            minrmax=True)
         # solve for the stellar mass before stripping.
         startmstar = strippedmstar / rubiatracks.getmstarfinal(delm, 1,
             rovera=rovera, minrmax=True)
@@ -48,3 +55,42 @@ def cdmgal_backtracks(mstar, rstar, halo_history):
         strippedmstar = startmstar
     
     return startmstar, rovera * 1.3 * starthalo.rs.to(units.kpc).value
+
+@instrument.staged
+def cdmgal_backtracks_batch(mstar, rstar, halo_history):
+    """
+    cdmgal_backtracks for arrays of galaxies sharing one halo history: the
+    stripping steps are evaluated once and every step of the inverse
+    recursion runs on all galaxies at once.
+
+    Arguments:
+      mstar: array of the stellar masses of the galaxies at present.
+      rstar: array of their half-light radii at present.
+      halo_history: list of profileclass objects containing the subhalo
+        density profile following each pericenter passage and at infall.
+
+    Returns (mstar, rstar, converged): the stellar masses and half-light
+    radii at infall, and a boolean array that is False where the inversion
+    gave no finite positive solution (those entries are nan). A history of
+    the infall profile only returns the galaxies unchanged.
+    """
+    delm, rs = _historysteps(halo_history)
+    rstar = np.asarray(rstar, dtype=float)
+    if not len(delm):
+        # infall only, nothing stripped yet.
+        return mstar, rstar, np.ones(rstar.shape, dtype=bool)
+    ratio = np.ones(rstar.shape)
+    # galaxies without a solution turn into nan and are masked, not warned
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for step in range(len(delm)):
+            # as in cdmgal_backtracks, rovera after each stripping is taken from
+            # the present half-light radius.
+            rovera = rubiatracks.getroverainitial(delm[step], 1,
+                rstar / 1.3 / rs[step], minrmax=True)
+            ratio = ratio / rubiatracks.getmstarfinal(delm[step], 1,
+                rovera=rovera, minrmax=True)
+        rstart = rovera * 1.3 * rs[-1]
+        converged = np.isfinite(ratio) & (ratio > 0) & np.isfinite(rstart) & \
+            (rstart > 0)
+    return (mstar * np.where(converged, ratio, np.nan),
+        np.where(converged, rstart, np.nan), converged)
@@ -0,0 +1,484 @@
+"""
+benchmarks.py
+
+Timing benchmarks for the profile code. Run as
+
+    python benchmarks.py [results.json]
+
+to print the tables and, if a file name is given, write the scaling suite
+(bench_scaling) to it as JSON. Two such files, e.g. from two commits, are
+compared with
+
+    python benchmarks.py --compare old.json new.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from astropy import units
+import abunmatch
+import backtracks
+import getmlossp10
+import getrtide
+import parallel
+import profileclass
+import profilekernels
+import profilesolve
+import profilepop
+import rubiatracks
+import trackhistory
+
+RHOUNIT = units.M_sun/units.kpc**3
+QUNITS = {'rho0': RHOUNIT, 'rs': units.kpc, 'rvir': units.kpc,
+    'mvir': units.M_sun, 'deltavirrhou': RHOUNIT, 'c': 1,
+    'vmax': units.km/units.s, 'rmax': units.kpc}
+# Powers of a length rescaling carried by each halo parameter, used to make
+# populations of differently sized halos of one shape.
+SCALEPOWERS = {'rs': 1, 'rvir': 1, 'rmax': 1, 'mvir': 3, 'vmax': 1}
+
+# Problem sizes of the scaling suite.
+SCALINGNS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Cold import budget of the library modules, in seconds on top of the import
+# of their dependencies (numpy, scipy.special, astropy.units/constants), and
+# the modules the import must not pull in.
+IMPORTBUDGET = 0.15
+IMPORTDEPS = ('numpy', 'scipy.special', 'astropy.units', 'astropy.constants')
+IMPORTFORBIDDEN = ('matplotlib', 'scipy.optimize', 'scipy.integrate',
+    'scipy.misc', 'scipy.interpolate')
+
+def _besttime(f, repeat=5, number=None):
+    # Best time per call over repeat runs of number calls each, with number
+    # picked so one run takes about 0.1 s when not given.
+    if number is None:
+        number = 1
+        while True:
+            t = time.time()
+            for i in range(number):
+                f()
+            dt = time.time() - t
+            if dt > 0.1 or number >= 1e5:
+                break
+            number *= 10
+    best = np.inf
+    for i in range(repeat):
+        t = time.time()
+        for j in range(number):
+            f()
+        best = min(best, (time.time() - t)/number)
+    return best
+
+def _referencehalo(alpha, beta, gamma, rho0=3e6, rs=2.5, rvir=60.0):
+    # Every parameter of one halo, in the profilekernels units.
+    mvir = profilekernels.zhaomass(rvir, rho0, rs, alpha, beta, gamma)
+    rmax = profilekernels.zhaoxmax(alpha, beta, gamma)*rs
+    vmax = float(profilekernels.vcirc(profilekernels.zhaomass(rmax, rho0, rs, alpha, beta, gamma), rmax))
+    return {'rho0': rho0, 'rs': rs, 'rvir': rvir, 'mvir': mvir,
+        'deltavirrhou': mvir/(4*np.pi/3*rvir**3), 'c': rvir/rs,
+        'vmax': vmax, 'rmax': rmax}
+
+def bench_solver(alpha=1.5, beta=4.2, gamma=0.7, npop=10000, out=sys.stdout):
+    """
+    Per constructor branch of profileclass.Zhao (profilesolve.BRANCHES):
+    scalar constructor latency, concentration-solve iterations, relative
+    error of the recovered rs and rho0, and the per-halo time of the same
+    branch solved for npop halos at once with ZhaoPopulation.
+
+    Optional Keyword Arguments:
+      alpha, beta, gamma: Zhao shape (default 1.5, 4.2, 0.7).
+      npop: population size for the vectorized timing (default 10000).
+      out: stream for the table (default stdout).
+
+    Returns a list of dicts, one per branch.
+    """
+    ref = _referencehalo(alpha, beta, gamma)
+    shape = profilesolve.ZhaoShape(alpha, beta, gamma)
+    rng = np.random.RandomState(0)
+    scale = 10**rng.uniform(-0.5, 0.5, npop)
+    rows = []
+    out.write('%-28s %12s %6s %10s %10s %14s\n' % ('branch', 'ctor [us]',
+        'niter', 'err rs', 'err rho0', 'vector [us/halo]'))
+    for branch in profilesolve.BRANCHES:
+        given = dict((k, ref[k]) for k in branch)
+        kwargs = dict((k, ref[k]*QUNITS[k]) for k in branch)
+        ctor = _besttime(lambda: profileclass.Zhao(alpha, beta, gamma, **kwargs))
+        p, info = profilesolve.solvehalo(shape, full_output=True, **given)
+        # a population of rescaled halos (rs and rvir scaled together).
+        popgiven = dict((k, v*scale**SCALEPOWERS.get(k, 0)) for k, v in given.items())
+        vector = _besttime(lambda: profilepop.ZhaoPopulation(alpha, beta, gamma, **popgiven),
+            repeat=3, number=1)/npop
+        row = {'branch': '+'.join(branch), 'ctor_s': ctor, 'niter': int(info['niter']),
+            'err_rs': abs(p['rs']/ref['rs'] - 1), 'err_rho0': abs(p['rho0']/ref['rho0'] - 1),
+            'vector_s_per_halo': vector}
+        rows.append(row)
+        out.write('%-28s %12.1f %6d %10.1e %10.1e %14.2f\n' % (row['branch'],
+            1e6*ctor, row['niter'], row['err_rs'], row['err_rho0'], 1e6*vector))
+    return rows
+
+def bench_phigrid(nr=1000, out=sys.stdout):
+    """
+    Accuracy and speed of the tabulated potential (profilegrid) behind
+    RhoProfile.get_phi: relative error of the generic grid for an NFW halo
+    against the analytic nfwpotential, grid build time and the time of one
+    vectorized query at nr radii.
+
+    Optional Keyword Arguments:
+      nr: number of query radii, log spaced over 1e-3 to 1e3 kpc (default 1000).
+      out: stream for the table (default stdout).
+
+    Returns a dict.
+    """
+    halo = profileclass.NFW(mvir=1e12*units.M_sun, c=10, deltavirrhou=200*1.4e2*RHOUNIT)
+    r = np.logspace(-3, 3, nr)
+    exact = profileclass.nfwpotential(halo.rho0, halo.rs, r*units.kpc).to(profileclass.PHIUNIT).value
+    def build():
+        halo._gridcache = None
+        return halo._grid()
+    grid = build()
+    err = np.max(np.abs(grid.get_phi(r)/exact - 1))
+    row = {'err_phi': err, 'build_s': _besttime(build, repeat=3),
+        'query_s': _besttime(lambda: grid.get_phi(r))}
+    out.write('NFW grid Phi: max rel err %.1e, build %.2f ms, %d radii %.2f ms\n' % (
+        err, 1e3*row['build_s'], nr, 1e3*row['query_s']))
+    return row
+
+def _coldimport(modules, repeat):
+    # Best wall time of importing modules in a fresh interpreter, and the
+    # IMPORTFORBIDDEN modules that ended up loaded.
+    code = ('import sys, time\n'
+        't = time.time()\n'
+        'import %s\n'
+        'sys.stdout.write(repr((time.time() - t, [m for m in %r if m in sys.modules])))\n'
+        % (', '.join(modules), IMPORTFORBIDDEN))
+    here = os.path.dirname(os.path.abspath(__file__))
+    best, loaded = np.inf, []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+        dt, loaded = eval(out)
+        best = min(best, dt)
+    return best, loaded
+
+def bench_import(modules=('profileclass', 'profilepop'), budget=IMPORTBUDGET,
+    repeat=5, out=sys.stdout):
+    """
+    Cold import time of the library modules, each in a fresh interpreter,
+    against the import time of their IMPORTDEPS. The import is within
+    budget if it costs at most budget seconds more than the dependencies
+    and loads none of IMPORTFORBIDDEN (plotting, and the scipy submodules
+    that are imported where a feature needs them).
+
+    Optional Keyword Arguments:
+      modules: module names to import (default profileclass, profilepop).
+      budget: allowed seconds on top of the dependencies (default IMPORTBUDGET).
+      repeat: fresh interpreters per measurement, best one taken (default 5).
+      out: stream for the table (default stdout).
+
+    Returns a list of dicts, one per module, with an 'ok' flag.
+    """
+    deps, _ = _coldimport(IMPORTDEPS, repeat)
+    rows = []
+    out.write('%-16s %10s %10s %8s  %s\n' % ('module', 'import [s]', 'own [s]', 'budget', 'forbidden'))
+    for m in modules:
+        dt, loaded = _coldimport([m], repeat)
+        row = {'module': m, 'import_s': dt, 'deps_s': deps, 'own_s': dt - deps,
+            'forbidden': loaded, 'ok': dt - deps <= budget and not loaded}
+        rows.append(row)
+        out.write('%-16s %10.3f %10.3f %8s  %s\n' % (m, dt, dt - deps,
+            'ok' if row['ok'] else 'OVER', ', '.join(loaded) or '-'))
+    return rows
+
+# The scaling suite. Each case is a setup(n) returning a zero-argument
+# callable that does the work for n items (halos, radii, history steps...);
+# only the callable is timed.
+
+class _HDU(object):
+    # Stand-in for a FITS table HDU as read by getperi.
+
+    def __init__(self, data):
+        self.data = data
+
+def _mergertree(n, nts=100, seed=0):
+    # Synthetic merger tree table of n subhalos on eccentric orbits around
+    # their host, nts snapshots from the present backwards, in the layout
+    # getperi reads (distances in Mpc/h, rvirhost in kpc, time in Gyr).
+    rng = np.random.RandomState(seed)
+    t = np.linspace(13.7, 1.0, nts)
+    period = rng.uniform(1.5, 4.0, (n, 1))
+    phase = 2*np.pi*(t/period + rng.uniform(0, 1, (n, 1)))
+    rperi = rng.uniform(0.02, 0.08, (n, 1))
+    rapo = rperi*rng.uniform(2, 5, (n, 1))
+    d = rperi + (rapo - rperi)*0.5*(1 - np.cos(phase))
+    names = ('time', 'redshift', 'dhost', 'dxhost', 'dyhost', 'dzhost',
+        'vxwrthost', 'vywrthost', 'vzwrthost', 'rvirhost')
+    data = np.recarray(n, dtype=[(k, 'f8', (nts,)) for k in names])
+    data.time = t
+    data.redshift = (13.7/t)**(2.0/3) - 1
+    data.dhost = d
+    data.dxhost = d*np.cos(phase)
+    data.dyhost = d*np.sin(phase)
+    data.dzhost = 0.0
+    data.vxwrthost = np.gradient(data.dxhost, axis=1)
+    data.vywrthost = np.gradient(data.dyhost, axis=1)
+    data.vzwrthost = 0.0
+    data.rvirhost = 300.0
+    return [None, _HDU(data)]
+
+def _ctorcase(cls, shape, branch):
+    # n scalar constructions of one parameterization.
+    ref = _referencehalo(*shape)
+    kwargs = dict((k, ref[k]*QUNITS[k]) for k in branch)
+    args = shape if cls is profileclass.Zhao else ()
+    def setup(n):
+        def run():
+            for i in range(n):
+                cls(*args, **kwargs)
+        return run
+    return setup
+
+def _popcase(cls, shape, branch):
+    # One vectorized solve of n rescaled halos of one parameterization.
+    ref = _referencehalo(*shape)
+    args = shape if cls is profilepop.ZhaoPopulation else ()
+    def setup(n):
+        scale = 10**np.random.RandomState(0).uniform(-0.5, 0.5, n)
+        given = dict((k, ref[k]*scale**SCALEPOWERS.get(k, 0)) for k in branch)
+        return lambda: cls(*args, **given)
+    return setup
+
+def _radiuscase(profile, method):
+    # One call of a profile method on n radii.
+    def setup(n):
+        r = np.logspace(-2, 2, n)
+        return lambda: getattr(profile, method)(r, units=False)
+    return setup
+
+def _vmaxcase(cls, shape):
+    # get_vmax of a population of n halos.
+    ref = _referencehalo(*shape)
+    args = shape if cls is profilepop.ZhaoPopulation else ()
+    def setup(n):
+        scale = 10**np.random.RandomState(0).uniform(-0.5, 0.5, n)
+        pop = cls(*args, rho0=ref['rho0'], rs=ref['rs']*scale, rvir=ref['rvir']*scale)
+        return lambda: pop.get_vmax(units=False)
+    return setup
+
+def _trackcase(func, withscatter):
+    # One call of a rubiatracks function on n mass loss ratios; the scatter
+    # is only drawn for gamma < 0.25.
+    gamma = 0 if withscatter else 1
+    def setup(n):
+        np.random.seed(0)
+        mloss = np.random.RandomState(0).uniform(0.01, 1, n)
+        return lambda: func(mloss, gamma, withscatter=withscatter)
+    return setup
+
+def _composecase(n):
+    # n satellites of 1 to 5 pericenter passages each, cuspy and cored.
+    rng = np.random.RandomState(0)
+    offsets = np.concatenate([[0], np.cumsum(rng.randint(1, 6, n))])
+    mloss = rng.uniform(0.05, 1, offsets[-1])
+    gamma = rng.choice([0., 1.], n)
+    return lambda: trackhistory.composetracks(mloss, offsets, gamma)
+
+def _abunmatchcase(n):
+    loghm = np.random.RandomState(0).uniform(8, 11, n)
+    rng = np.random.RandomState(1)
+    return lambda: abunmatch.am_stellar_logmass_mwsat_sample(loghm, rng=rng)
+
+def _backtrackscase(n):
+    # A halo history of n stripping steps (present first).
+    deltavir = 27191*RHOUNIT
+    history = [profileclass.NFW(mvir=m*units.M_sun, c=10, deltavirrhou=deltavir)
+        for m in np.linspace(1e9, 3e9, n + 1)]
+    return lambda: backtracks.cdmgal_backtracks(1e6*units.M_sun, 0.3, history)
+
+def _backtracksbatchcase(n):
+    # n galaxies backtracked through one 3-step halo history.
+    deltavir = 27191*RHOUNIT
+    history = [profileclass.NFW(mvir=m*units.M_sun, c=10, deltavirrhou=deltavir)
+        for m in np.linspace(1e9, 3e9, 4)]
+    rng = np.random.RandomState(0)
+    mstar = 10**rng.uniform(4, 7, n)*units.M_sun
+    rstar = rng.uniform(0.05, 1, n)
+    return lambda: backtracks.cdmgal_backtracks_batch(mstar, rstar, history)
+
+def _parallelcase(n):
+    # n satellites of 100 galaxies, each with its own 3-step halo history,
+    # on a pool of all cores.
+    deltavir = 27191*RHOUNIT
+    rng = np.random.RandomState(0)
+    histories = [[profileclass.NFW(mvir=m*units.M_sun, c=10, deltavirrhou=deltavir)
+        for m in np.sort(rng.uniform(1e9, 3e9, 4))] for i in range(n)]
+    mstars = [10**rng.uniform(4, 7, 100)*units.M_sun for i in range(n)]
+    rstars = [rng.uniform(0.05, 1, 100) for i in range(n)]
+    return lambda: parallel.backtrackhistories(mstars, rstars, histories, seed=0)
+
+def _mlosscase(n):
+    # n strippings of one infall halo to different tidal radii.
+    deltavir = 27191*RHOUNIT
+    halo = profileclass.NFW(mvir=3e9*units.M_sun, c=10, deltavirrhou=deltavir)
+    rtide = halo.rvir*np.linspace(0.1, 0.9, n)
+    def run():
+        for rt in rtide:
+            getmlossp10.getmlossp10(1, 3, 1, halo.mvir, halo.rs, halo.rvir,
+                halo.rvir, rt, deltavir)
+    return run
+
+def _mlosspopcase(n):
+    # The same n strippings in one population call.
+    deltavir = 27191*RHOUNIT
+    halo = profileclass.NFW(mvir=3e9*units.M_sun, c=10, deltavirrhou=deltavir)
+    rtide = halo.rvir*np.linspace(0.1, 0.9, n)
+    return lambda: getmlossp10.getmlossp10pop(1, 3, 1, halo.mvir, halo.rs,
+        halo.rvir, halo.rvir, rtide, deltavir)
+
+def _rtidecase(n):
+    # Tidal radii of n extended NFW subhalos in one NFW host.
+    deltavir = 27191*RHOUNIT
+    host = profileclass.NFW(mvir=1.5e12*units.M_sun, c=8, deltavirrhou=deltavir)
+    rng = np.random.RandomState(0)
+    subs = profilepop.NFWPopulation(mvir=rng.uniform(1e8, 1e10, n),
+        c=rng.uniform(5, 15, n), deltavirrhou=deltavir)
+    rperi = rng.uniform(10, 150, n)
+    return lambda: getrtide.getrtidenfw(host.rho0, host.rs, subs, rperi, 1e-16/units.s)
+
+def _pericase(n):
+    import getperi
+    f = _mergertree(n)
+    return lambda: getperi.getperi(f, getomegaperi=False)
+
+def _scalingcases():
+    # (name, setup) pairs of the scaling suite.
+    cases = []
+    for name, cls, pop, shape in [('NFW', profileclass.NFW, profilepop.NFWPopulation, (1, 3, 1)),
+        ('Zhao', profileclass.Zhao, profilepop.ZhaoPopulation, (1.5, 4.2, 0.7))]:
+        for branch in profilesolve.BRANCHES:
+            cases.append(('%s(%s)' % (name, '+'.join(branch)), _ctorcase(cls, shape, branch)))
+            cases.append(('%s(%s)' % (pop.__name__, '+'.join(branch)), _popcase(pop, shape, branch)))
+    deltavir = 27191*RHOUNIT
+    nfw = profileclass.NFW(mvir=1e12*units.M_sun, c=10, deltavirrhou=deltavir)
+    zhao = profileclass.Zhao(1.5, 4.2, 0.7, mvir=1e12*units.M_sun, c=10, deltavirrhou=deltavir)
+    trunc = profileclass.Zhao(1, 3, 1, mvir=1e12*units.M_sun, c=10, deltavirrhou=deltavir, rdecrvir=0.1)
+    for name, profile in [('NFW', nfw), ('Zhao', zhao), ('Zhao[rdecrvir]', trunc)]:
+        for method in ('get_mass', 'get_vcirc'):
+            cases.append(('%s.%s' % (name, method), _radiuscase(profile, method)))
+    cases.append(('NFWPopulation.get_vmax', _vmaxcase(profilepop.NFWPopulation, (1, 3, 1))))
+    cases.append(('ZhaoPopulation.get_vmax', _vmaxcase(profilepop.ZhaoPopulation, (1.5, 4.2, 0.7))))
+    for func in (rubiatracks.getvmaxfinal, rubiatracks.getrmaxfinal,
+        rubiatracks.getrhfinal, rubiatracks.getmstarfinal):
+        for withscatter in (False, True):
+            cases.append(('rubiatracks.%s%s' % (func.__name__, '[withscatter]' if withscatter else ''),
+                _trackcase(func, withscatter)))
+    cases.append(('trackhistory.composetracks', _composecase))
+    cases.append(('abunmatch.am_stellar_logmass_mwsat_sample', _abunmatchcase))
+    cases.append(('backtracks.cdmgal_backtracks', _backtrackscase))
+    cases.append(('backtracks.cdmgal_backtracks_batch', _backtracksbatchcase))
+    cases.append(('parallel.backtrackhistories', _parallelcase))
+    cases.append(('getmlossp10.getmlossp10', _mlosscase))
+    cases.append(('getmlossp10.getmlossp10pop', _mlosspopcase))
+    cases.append(('getrtide.getrtidenfw', _rtidecase))
+    cases.append(('getperi.getperi', _pericase))
+    return cases
+
+def bench_scaling(ns=SCALINGNS, maxtime=1.0, cases=None, out=sys.stdout):
+    """
+    Scaling curves: wall time of every case of the suite (profile
+    construction per parameterization, scalar and vectorized; get_mass,
+    get_vcirc and population get_vmax on arrays; the rubiatracks
+    functions with and without scatter and composed over passages;
+    abundance matching sampling; backtracks, getmlossp10, getrtide and
+    getperi) at each problem size n. A case stops growing once one size
+    takes more than maxtime seconds to set up and run; cases that cannot
+    run here (a missing module) are recorded as skipped.
+
+    Optional Keyword Arguments:
+      ns: problem sizes (default SCALINGNS, 1 to 10^6).
+      maxtime: time cap per size in seconds (default 1).
+      cases: list of substrings; only cases whose name contains one run
+        (default all).
+      out: stream for the table (default stdout).
+
+    Returns a list of dicts with 'case', 'n', 'time_s' and 'per_item_s',
+    or 'skipped' with the reason instead of the times.
+    """
+    rows = []
+    out.write('%-48s %8s %12s %12s\n' % ('case', 'n', 'time [s]', 'per item [s]'))
+    for name, setup in _scalingcases():
+        if cases is not None and not any(c in name for c in cases):
+            continue
+        for n in ns:
+            n = int(n)
+            t = time.time()
+            try:
+                run = setup(n)
+            except ImportError as e:
+                rows.append({'case': name, 'n': n, 'skipped': str(e)})
+                out.write('%-48s %8d  skipped: %s\n' % (name, n, e))
+                break
+            t1 = time.time()
+            run()
+            first = time.time() - t1
+            elapsed = time.time() - t
+            dt = _besttime(run, repeat=3) if first < 0.1 else first
+            rows.append({'case': name, 'n': n, 'time_s': dt, 'per_item_s': dt/n})
+            out.write('%-48s %8d %12.3e %12.3e\n' % (name, n, dt, dt/n))
+            if elapsed > maxtime:
+                break
+    return rows
+
+def _gitcommit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+def writejson(rows, path):
+    """
+    Write benchmark rows to path as JSON, with the commit, interpreter and
+    numpy version they were measured with.
+    """
+    meta = {'commit': _gitcommit(), 'python': platform.python_version(),
+        'numpy': np.__version__, 'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'rows': rows}, f, indent=1, sort_keys=True)
+
+def compare(oldpath, newpath, out=sys.stdout):
+    """
+    Time ratios new/old of the (case, n) entries measured in both JSON
+    files written by writejson. Returns a list of dicts.
+    """
+    with open(oldpath) as f:
+        old = dict(((r['case'], r['n']), r) for r in json.load(f)['rows'])
+    with open(newpath) as f:
+        new = json.load(f)['rows']
+    rows = []
+    out.write('%-48s %8s %12s %12s %8s\n' % ('case', 'n', 'old [s]', 'new [s]', 'ratio'))
+    for r in new:
+        o = old.get((r['case'], r['n']))
+        if o is None or 'time_s' not in o or 'time_s' not in r:
+            continue
+        row = {'case': r['case'], 'n': r['n'], 'old_s': o['time_s'],
+            'new_s': r['time_s'], 'ratio': r['time_s']/o['time_s']}
+        rows.append(row)
+        out.write('%-48s %8d %12.3e %12.3e %8.2f\n' % (row['case'], row['n'],
+            row['old_s'], row['new_s'], row['ratio']))
+    return rows
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--compare']:
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    imports = bench_import()
+    bench_solver()
+    bench_phigrid()
+    rows = bench_scaling()
+    if len(sys.argv) > 1:
+        writejson(rows, sys.argv[1])
+    if not all(row['ok'] for row in imports):
+        sys.exit(1)
@@ -8,9 +8,7 @@ import numpy as np
 from astropy import units
 import matplotlib.pyplot as plt
 import profileclass
-import getrtide
-import getmlossp10
-reload(getmlossp10)
+import strippipeline
 import rubiatracks
 import abunmatch as am
 import backtracks as bt
@@ -71,58 +69,34 @@ myseed = 38729501
 
 ####### CDM subhalo evolution for the given orbit history. ###################
 
-# Make a list of profileclass.NFW objects for the history of the subhalo.
-subprofilehist = []
-# Add the initial subhalo profile. Note the deltavirrhou should be calculated
+# The stripping sequence of this orbit history: the parent halo profile, the
+# tidal radius and the stripped subhalo profile at each pericenter passage.
+pipeline = strippipeline.StrippingPipeline(pericenters, periomega, perimass,
+    pericon, deltavirrhou=27191*units.M_sun/units.kpc**3)
+
+# The initial subhalo profile. Note the deltavirrhou should be calculated
 # using the subhalo redshift with the Norman and Bryan virial overdensity.
 # For the sake of demonstration, I am using a constant virial density.
-subprofilehist.append(profileclass.NFW(mvir=init_msubhalo, c=init_csubhalo,
-    deltavirrhou=27191*units.M_sun/units.kpc**3))
-for i in np.arange(pericenters.size):
-    # the parent halo profile during satellite pericenter passage.
-    pprofile = profileclass.NFW(mvir=perimass[i], c=pericon[i], 
-        deltavirrhou=27191*units.M_sun/units.kpc**3)
-    # starting tidal radius of the subhalo
-    startrtide = subprofilehist[i].rvir
-    # tidal radius at pericenter
-    perirtide = getrtide.getrtidenfw(pprofile.rho0, pprofile.rs,
-        subprofilehist[i].mvir, pericenters[i], periomega[i])
-
-    # determine subhalo density profile after stripping.
-    strippedhalo = getmlossp10.getmlossp10(1, 3, 1, subprofilehist[i].mvir,
-        subprofilehist[i].rs, subprofilehist[i].rvir, startrtide, perirtide,
-        27191*units.M_sun/units.kpc**3)
-    subprofilehist.append(strippedhalo)
+cdminfall = profileclass.NFW(mvir=init_msubhalo, c=init_csubhalo,
+    deltavirrhou=27191*units.M_sun/units.kpc**3)
+# The history of the subhalo as a table, one row per profile from infall to
+# the present, and as a list of profiles.
+cdmtable = pipeline.run(cdminfall, gamma=1)
+subprofilehist = profileclass.profilesfromtable(cdmtable)
 
 ####### SIDM subhalo evolution for the given orbit history. ##################
 
 # Carry out the same procedure as with CDM but with SIDM profiles and tracks,
 # starting from infall and proceeding to the present.
-sidmsubprofilehist = []
 # Convert the infall halo profile to a corresponding SIDM profile.
-
-
-sidmsubprofilehist.append(getafromsidm.getprofilefromsidm( \
+sidminfall = getafromsidm.getprofilefromsidm( \
         subprofilehist[0].get_vmax(),subprofilehist[0].get_rmax(), \
-            13.6*units.Gyr,subprofilehist[0].rvir,27191*units.M_sun/units.kpc**3,0))
+            13.6*units.Gyr,subprofilehist[0].rvir,27191*units.M_sun/units.kpc**3,0)
 # should have correct age, but will fix later
 
-# Strip the halo at each pericenter passage and append the corresponding
-# stripped SIDM profiles.
-for i in np.arange(pericenters.size):
-    # the parent halo profile during satellite pericenter passage.
-    pprofile = profileclass.NFW(mvir=perimass[i], c=pericon[i], 
-        deltavirrhou=27191*units.M_sun/units.kpc**3)
-    # starting tidal radius of the subhalo
-    startrtide = subprofilehist[i].rvir
-    # tidal radius at pericenter
-    perirtide = getrtide.getrtidenfw(pprofile.rho0, pprofile.rs,
-        subprofilehist[i].mvir, pericenters[i], periomega[i])
-
-    strippedhalo = getmlossp10.getmlossp10(1, 3, 0, subprofilehist[i].mvir,
-        subprofilehist[i].rs, subprofilehist[i].rvir, startrtide, perirtide,
-        27191*units.M_sun/units.kpc**3)
-    subprofilehist.append(strippedhalo)
+# Strip the cored halo at each pericenter passage.
+sidmtable = pipeline.run(sidminfall, gamma=0)
+sidmsubprofilehist = profileclass.profilesfromtable(sidmtable)
 
 ####### CDM abundance matching for the subhalo at z=0. #######################
 
@@ -130,7 +104,7 @@ for i in np.arange(pericenters.size):
 rng = np.random.RandomState(myseed)
 
 # The subhalo mass at z=0.
-mhalo = subprofilehist[-2].mvir / units.M_sun
+mhalo = subprofilehist[-1].mvir / units.M_sun
 # Array of log(mhalo) to feed into abundance matching.
 loghm = np.full(nsample, np.log10(mhalo))
 
@@ -151,14 +125,14 @@ cdmrstar=masssize.masssizegammar(10**logcdmsm,0)
 # An empty array for the SIDM stellar masses.
 logsidmsm = np.empty_like(logcdmsm)
 
-for i in np.arange(len(logcdmsm[0:-1])):
-    # Tidally disrupt the satellite with the given stellar mass in reverse.
-    (mstarinfall, rstarinfall) = \
-        bt.cdmgal_backtracks(10**logcdmsm[i]*units.M_sun,
-            cdmrstar[i], subprofilehist)
+# Tidally disrupt the satellites with the given stellar masses in reverse,
+# all at once; converged is False for galaxies without an infall solution.
+(mstarinfall, rstarinfall, converged) = \
+    bt.cdmgal_backtracks_batch(10**logcdmsm[0:-1]*units.M_sun,
+        cdmrstar[0:-1], subprofilehist)
 
-    # Use mstarinfall and rstarinfall with the SIDM sidmsubprofilehist subhalo
-    # profile history to determine the stellar mass and radius for SIDM at z=0.
+# Use mstarinfall and rstarinfall with the SIDM sidmsubprofilehist subhalo
+# profile history to determine the stellar mass and radius for SIDM at z=0.
 
 import rubiatracks
 
@@ -1,11 +1,15 @@
 import numpy as np
+from astropy import units
+import instrument
 import profileclass
 reload(profileclass)
+import profilepop
 import rubiatracks
 
 #get the density profile of a halo experiencing tidal mass loss, according to Penarrubia 2010
 
-def getmlossp10(alpha0,beta0,gamma0,mvir0,rs0,rvir,rtide0,rtide1,finaldeltavirrhou):
+@instrument.staged
+def getmlossp10(alpha0,beta0,gamma0,mvir0,rs0,rvir,rtide0,rtide1,finaldeltavirrhou,withscatter=False,rng=None):
 
     #these parameters specify the shape of the halo before the tidal interaction:
     #alpha0, beta0, gamma0 specify the inital profile (Penarrubia 2010, eqn 2)
@@ -17,39 +21,36 @@ def getmlossp10(alpha0,beta0,gamma0,mvir0,rs0,rvir,rtide0,rtide1,finaldeltavirrh
 
     #finaldeltavirrhou: the virial parameter during the tidal interaction 
 
+    #withscatter, rng: draw the track scatter (gamma0<0.25) from rng, as in rubiatracks
+
 
     #if the tidal radius is outside the virial radius, no tidal stripping occurs
     if rvir<=rtide1:
+        #(a new profile, as the caller owns it; the memoized one below never escapes)
         return profileclass.Zhao(alpha0,beta0,gamma0,mvir=mvir0,rs=rs0,rvir=rvir)
 
-    #initialize the profile before the tidal interaction
-    rho0=profileclass.Zhao(alpha0,beta0,gamma0,mvir=mvir0,rs=rs0,rvir=rvir)
+    #initialize the profile before the tidal interaction (memoized, as the
+    #same infall template is stripped along every orbit)
+    rho0=profileclass.makeprofile(profileclass.Zhao,alpha0,beta0,gamma0,mvir=mvir0,rs=rs0,rvir=rvir)
 #    rho0=profileclass.Zhao(alpha0,beta0,gamma0,mvir=mvir0,rs=rs0,deltavirrhou=finaldeltavirrhou)
 
     #the mass within the tidal radius before the tidal interaction
     msa0=rho0.get_mass(rtide0)
     #the mass within the tidal radius of during the tidal interaction
     msnew=rho0.get_mass(rtide1)
-    
-    msms0=msnew/msa0
+
+    #the ratio between the mass within the tidal radius before the tidal interaction and during the tidal interaction
+    msms01=(msnew/msa0).value
 
     #if >10% mass is lost, change beta to 5
-    #if msms0<=.9:
+    #if msms01<=.9:
     #    rho1=profileclass.Zhao(alpha0,5,gamma0,rho0=rho0.rho0,rs=rs0,deltavirrhou=finaldeltavirrhou)
     #else:
     #    rho1=rho0
 
-        
-    msnew1=rho0.get_mass(rtide1)
-    msrt0=rho0.get_mass(rtide0)
-
-    #the ratio between the mass within the tidal radius before the tidal interaction and during the tidal interaction
-    msms01=(msnew1/msrt0).value
-
     #use the tracks to get the new vmax, rmax
-    rmax=rubiatracks.getrmaxfinal(msms01,gamma0,minrmax=False)*rho0.get_rmax()
-    vmax=rubiatracks.getvmaxfinal(msms01,gamma0,minrmax=False)*rho0.get_vmax()
-    print rmax,vmax
+    rmax=rubiatracks.getrmaxfinal(msms01,gamma0,minrmax=False,withscatter=withscatter,rng=rng)*rho0.get_rmax()
+    vmax=rubiatracks.getvmaxfinal(msms01,gamma0,minrmax=False,withscatter=withscatter,rng=rng)*rho0.get_vmax()
     
     #vmax, rmvax and the virial parameter determine the final halo shapes
     if msms01<=.9:
@@ -58,3 +59,46 @@ def getmlossp10(alpha0,beta0,gamma0,mvir0,rs0,rvir,rtide0,rtide1,finaldeltavirrh
         rhof=profileclass.Zhao(alpha0,beta0,gamma0,vmax=vmax,rmax=rmax,deltavirrhou=finaldeltavirrhou)
             
     return rhof
+
+@instrument.staged
+def getmlossp10pop(alpha0,beta0,gamma0,mvir0,rs0,rvir,rtide0,rtide1,finaldeltavirrhou):
+
+    #getmlossp10 for a population of subhalos: every argument may be an array
+    #with one entry per halo (Quantities or floats in M_sun, kpc, M_sun/kpc^3),
+    #and the stripped halos come back as one profilepop.ZhaoPopulation,
+    #solved for all halos at once without building a profile per halo
+
+    #the profiles before the tidal interaction, one per halo of the broadcast arguments
+    mvir0,rs0,rvir,rtide0,rtide1,alpha0,beta0,gamma0=np.broadcast_arrays(units.Quantity(mvir0,units.M_sun).value,
+        *[units.Quantity(r,units.kpc).value for r in (rs0,rvir,rtide0,rtide1)]+[alpha0,beta0,gamma0])
+    pop0=profilepop.ZhaoPopulation(alpha0,beta0,gamma0,mvir=mvir0,rs=rs0,rvir=rvir)
+    rtide0,rtide1=rtide0.ravel(),rtide1.ravel()
+
+    #halos with the tidal radius outside the virial radius are not stripped
+    stripped=np.nonzero(pop0.rvir>rtide1)[0]
+    rho0,rs,rvir,mvir=[getattr(pop0,k).copy() for k in ('rho0','rs','rvir','mvir')]
+    beta=pop0.beta.copy()
+    converged=pop0.converged.copy()
+    if len(stripped):
+        #the ratio between the mass within the tidal radius before the tidal interaction and during the tidal interaction
+        msms01=pop0.get_mass(rtide1,units=False)[stripped]/pop0.get_mass(rtide0,units=False)[stripped]
+        gamma=pop0.gamma[stripped]
+
+        #use the tracks to get the new vmax, rmax
+        rmax=rubiatracks.getrmaxfinal(msms01,gamma,minrmax=False)*pop0.get_rmax(units=False)[stripped]
+        vmax=rubiatracks.getvmaxfinal(msms01,gamma,minrmax=False)*pop0.get_vmax(units=False)[stripped]
+
+        #vmax, rmax and the virial parameter determine the final halo shapes,
+        #with beta=5 if >10% of the mass is lost
+        beta[stripped]=np.where(msms01<=.9,5,pop0.beta[stripped])
+        popf=profilepop.ZhaoPopulation(pop0.alpha[stripped],beta[stripped],gamma,
+            vmax=vmax,rmax=rmax,deltavirrhou=finaldeltavirrhou)
+        for a,k in zip((rho0,rs,rvir,mvir),('rho0','rs','rvir','mvir')):
+            a[stripped]=getattr(popf,k)
+        #halos whose stripped profile has no solution are flagged in pop.converged
+        converged[stripped]&=popf.converged
+
+    pop=profilepop.ZhaoPopulation.__new__(profilepop.ZhaoPopulation)
+    pop.alpha,pop.beta,pop.gamma=pop0.alpha,beta,pop0.gamma
+    pop._setparams(rho0,rs,rvir,mvir,converged)
+    return pop
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy import units
 import getomega
 kminmpc=1*units.Mpc.to(units.km)
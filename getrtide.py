@@ -0,0 +1,127 @@
+"""
+getrtide.py
+
+Tidal radii of subhalos at pericenter, for whole arrays of subhalos at once.
+The tidal radius r_t of a subhalo of enclosed mass m(r) at distance R from
+the host center solves (King 1962)
+
+    G*m(r_t)/r_t^3 = omega^2 - d^2Phi/dR^2
+                   = omega^2 + G*(2*M(R)/R^3 - 4*pi*rho(R)),
+
+with M and rho the enclosed mass and density of the host and omega the
+angular velocity of the orbit (the centrifugal term). For a point-mass
+subhalo r_t is closed form; for an extended subhalo the implicit equation
+is solved for all subhalos together by the bracketed Newton iteration
+profilesolve.lognewton. Hosts where the right hand side is not positive
+do not bound the subhalo and give r_t = inf.
+
+Units are kpc, M_sun, M_sun/kpc^3 and km/s; Quantities are converted.
+"""
+import numpy as np
+from numpy import pi
+from astropy import units
+import profilekernels
+import profilesolve
+
+G = profilekernels.G
+
+KPC = units.kpc
+MSUN = units.M_sun
+RHOUNIT = MSUN/KPC**3
+OMEGAUNIT = units.km/units.s/KPC
+
+# Default bracket on r_t in kpc for extended subhalos.
+RTMIN = 1e-8
+RTMAX = 1e8
+
+def _tofloat(x, unit):
+    # Quantities are converted to unit, anything else is taken to be in unit.
+    if hasattr(x, 'unit'):
+        return np.asarray(x.to(unit).value, dtype=float)
+    return np.asarray(x, dtype=float)
+
+def tidalfrequency(mass, rho, rperi, omega=0):
+    """
+    omega^2 - d^2Phi/dR^2 in (km/s/kpc)^2 at rperi (kpc) of a host with
+    enclosed mass mass (M_sun) and density rho (M_sun/kpc^3) there, for an
+    orbit of angular velocity omega (km/s/kpc). Arrays broadcast together.
+    """
+    return omega**2 + G*(2*mass/rperi**3 - 4*pi*rho)
+
+def _solve(freq2, msub, rlo, rhi):
+    # r_t in kpc for each tidal frequency^2, of point masses msub or of
+    # the extended subhalo(s) msub.
+    if not hasattr(msub, 'get_mass'):
+        m = _tofloat(msub, MSUN)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(freq2 > 0, np.cbrt(G*m/freq2), np.inf)
+    # a population has one subhalo per entry, a profile is shared by all.
+    npop = len(msub) if hasattr(msub, 'shapenames') else None
+    shape = np.broadcast(freq2, np.empty(npop if npop is not None else ())).shape
+    freq2 = np.broadcast_to(freq2, shape).ravel()
+    rt = np.full(freq2.shape, np.inf)
+    sel = np.nonzero(freq2 > 0)[0]
+
+    def f(r, idx):
+        # ln(G*m(r)/r^3/freq2) and its derivative dln(m)/dln(r) - 3.
+        full = sel[idx]
+        if npop is not None:
+            rr = np.ones(len(freq2))
+            rr[full] = r
+            m = msub.get_mass(rr, units=False)[full]
+            rho = msub.get_rho(rr, units=False)[full]
+        else:
+            m = msub.get_mass(r, units=False)
+            rho = msub.get_rho(r, units=False)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(G*m/r**3/freq2[full]), 4*pi*r**3*rho/m - 3
+
+    if len(sel):
+        lo = np.broadcast_to(_tofloat(rlo, KPC), shape).ravel()[sel]
+        hi = np.broadcast_to(_tofloat(rhi, KPC), shape).ravel()[sel]
+        rt[sel] = profilesolve.lognewton(f, lo, hi)
+    return rt.reshape(shape)
+
+def _result(rt, withunits):
+    rt = rt if np.ndim(rt) else float(rt)
+    return rt*KPC if withunits else rt
+
+def getrtide(host, msub, rperi, omega=0, rlo=RTMIN, rhi=RTMAX, units=True):
+    """
+    Tidal radii of subhalos at pericenter in any host.
+
+    Arguments:
+      host: the host profile, a profileclass profile or a profilepop
+        population (one host per subhalo).
+      msub: the subhalo mass for point-mass subhalos, or the subhalo
+        profile, or a profilepop population of subhalos, whose enclosed
+        mass is used.
+      rperi: pericenter radii.
+
+    Optional Keyword Arguments:
+      omega: angular velocities at pericenter (default 0, no centrifugal
+        term).
+      rlo, rhi: bracket on r_t for extended subhalos (default RTMIN, RTMAX
+        kpc); subhalos without a root in it come back as nan.
+      units: return a Quantity in kpc, or plain floats with units=False.
+
+    Arguments broadcast together, as Quantities or floats in kpc, M_sun and
+    km/s/kpc.
+    """
+    rperi = _tofloat(rperi, KPC)
+    freq2 = tidalfrequency(host.get_mass(rperi, units=False),
+        host.get_rho(rperi, units=False), rperi, _tofloat(omega, OMEGAUNIT))
+    return _result(_solve(freq2, msub, rlo, rhi), units)
+
+def getrtidenfw(rho0, rs, msub, rperi, omega=0, rlo=RTMIN, rhi=RTMAX,
+    units=True):
+    """
+    Tidal radii of subhalos at pericenter in NFW hosts of scale density
+    rho0 and scale radius rs; the other arguments are as for getrtide.
+    """
+    rho0 = _tofloat(rho0, RHOUNIT)
+    rs = _tofloat(rs, KPC)
+    rperi = _tofloat(rperi, KPC)
+    freq2 = tidalfrequency(profilekernels.nfwmass(rperi, rho0, rs),
+        profilekernels.nfwrho(rperi, rho0, rs), rperi, _tofloat(omega, OMEGAUNIT))
+    return _result(_solve(freq2, msub, rlo, rhi), units)
@@ -0,0 +1,145 @@
+"""
+instrument.py
+
+Opt-in counters and timers for the hot paths of the profile and track code:
+calls and function evaluations of the scipy solvers and integrators, wall
+time of each profile constructor branch and of the pipeline stages. Nothing
+is recorded unless a record() block is active, e.g.
+
+    with instrument.record() as report:
+        strippedhalo = getmlossp10.getmlossp10(...)
+    print(json.dumps(report, indent=1))
+
+The report is a plain dict of
+
+    'wall_s': seconds spent inside the record() block,
+    'solvers': {name: {'calls', 'nfev', 'time_s'}} for quad, fsolve,
+        minimize_scalar and minimize,
+    'branches': {'Class:branch': {'calls', 'time_s'}} per constructor branch
+        (e.g. 'Zhao:rho0+rs+mvir'),
+    'stages': {'module.function': {'calls', 'time_s'}} per pipeline stage,
+
+with inclusive times (a stage includes the solver calls made inside it).
+"""
+import functools
+import time
+
+# The reports of the record() blocks currently open, innermost last. Every
+# event is added to all of them, so nested blocks each see their own totals.
+_active = []
+
+def _add(section, name, dt, nfev=None):
+    for report in _active:
+        entry = report[section].setdefault(name, {'calls': 0, 'time_s': 0.0})
+        entry['calls'] += 1
+        entry['time_s'] += dt
+        if nfev is not None:
+            entry['nfev'] = entry.get('nfev', 0) + nfev
+
+class record(object):
+    """
+    Context manager collecting the report of everything run inside it;
+    entering it returns the report dict, filled in as the block runs.
+    """
+
+    def __enter__(self):
+        self.report = {'wall_s': 0.0, 'solvers': {}, 'branches': {}, 'stages': {}}
+        self._t = time.time()
+        _active.append(self.report)
+        return self.report
+
+    def __exit__(self, *exc):
+        self.report['wall_s'] = time.time() - self._t
+        _active.remove(self.report)
+        return False
+
+class _Timer(object):
+    # Times its with-block into section/name of the active reports.
+
+    def __init__(self, section, name):
+        self.section = section
+        self.name = name
+
+    def __enter__(self):
+        self._t = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.section, self.name, time.time() - self._t)
+        return False
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULLTIMER = _NullTimer()
+
+def tic():
+    """
+    Start time for toc, or None when nothing is being recorded.
+    """
+    return time.time() if _active else None
+
+def toc(section, name, t):
+    """
+    Add the time since t=tic() to section ('branches' or 'stages') entry
+    name of the active reports.
+    """
+    if t is not None:
+        _add(section, name, time.time() - t)
+
+def stage(name):
+    """
+    with-block timer of one pipeline stage.
+    """
+    return _Timer('stages', name) if _active else _NULLTIMER
+
+def staged(func):
+    """
+    Decorator timing every call of func as the stage 'module.function'.
+    """
+    name = '%s.%s' % (func.__module__, func.__name__)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _active:
+            return func(*args, **kwargs)
+        with _Timer('stages', name):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _solver(name, call, func, args, kwargs):
+    # Run call(func, *args, **kwargs), counting the evaluations of func.
+    if not _active:
+        return call(func, *args, **kwargs)
+    nfev = [0]
+    def counted(*a, **k):
+        nfev[0] += 1
+        return func(*a, **k)
+    t = time.time()
+    try:
+        return call(counted, *args, **kwargs)
+    finally:
+        _add('solvers', name, time.time() - t, nfev[0])
+
+# Drop-in replacements for the scipy routines; scipy.integrate and
+# scipy.optimize are only imported on first use.
+
+def quad(func, *args, **kwargs):
+    from scipy.integrate import quad
+    return _solver('quad', quad, func, args, kwargs)
+
+def fsolve(func, *args, **kwargs):
+    from scipy.optimize import fsolve
+    return _solver('fsolve', fsolve, func, args, kwargs)
+
+def minimize_scalar(func, *args, **kwargs):
+    from scipy.optimize import minimize_scalar
+    return _solver('minimize_scalar', minimize_scalar, func, args, kwargs)
+
+def minimize(func, *args, **kwargs):
+    from scipy.optimize import minimize
+    return _solver('minimize', minimize, func, args, kwargs)
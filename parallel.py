@@ -0,0 +1,126 @@
+"""
+parallel.py
+
+Process-pool drivers for running many independent subhalo histories, e.g.
+the backtracking of the galaxies of every satellite of a host:
+
+    results = parallel.backtrackhistories(mstars, rstars, histories,
+        processes=8)
+
+Histories are sent to the workers in chunks and the results come back in
+input order, and serial=True runs the same tasks in this process for
+debugging. Tasks with random draws (striphistories with the track scatter)
+get their own random seed per history, drawn from one master seed, so the
+results do not depend on the number of processes or the chunk size.
+Instrument records are not collected from the workers.
+"""
+import multiprocessing
+import numpy as np
+import backtracks
+import getmlossp10
+
+def _seeds(n, seed):
+    # One seed per task, drawn from the master seed.
+    return np.random.RandomState(seed).randint(0, 2**31 - 1, size=n)
+
+def _runtask(task):
+    # Run func(item, rng) with the task's RandomState, or func(item) for an
+    # unseeded task; the global numpy state is seeded too, for code that
+    # draws from it.
+    func, item, seed = task
+    if seed is None:
+        return func(item)
+    np.random.seed(seed)
+    return func(item, np.random.RandomState(seed))
+
+def pmap(func, items, processes=None, chunksize=None, seed=None,
+    serial=False, seeded=True):
+    """
+    Return [func(item, rng) for item in items], computed on a process pool.
+
+    Arguments:
+      func: module-level function (it must pickle) of an item and a
+        numpy RandomState, or of the item only with seeded=False.
+      items: sequence of picklable inputs.
+
+    Optional Keyword Arguments:
+      processes: pool size (default the number of cores).
+      chunksize: items sent to a worker at a time (default about four
+        chunks per process).
+      seed: master seed of the per-item RandomStates (default random).
+      serial: run in this process instead of a pool.
+      seeded: pass each item a RandomState (default True); with False func
+        makes no random draws and gets the item only.
+    """
+    items = list(items)
+    seeds = _seeds(len(items), seed) if seeded else [None]*len(items)
+    tasks = [(func, item, s) for item, s in zip(items, seeds)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if serial or processes <= 1 or len(tasks) <= 1:
+        return [_runtask(task) for task in tasks]
+    if chunksize is None:
+        chunksize = max(1, -(-len(tasks) // (4*processes)))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = list(pool.imap(_runtask, tasks, chunksize))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def _backtrackone(item):
+    mstar, rstar, history = item
+    return backtracks.cdmgal_backtracks_batch(mstar, rstar, history)
+
+def backtrackhistories(mstars, rstars, histories, **kwargs):
+    """
+    Backtrack the galaxies of many satellites, each with its own halo
+    history, in parallel.
+
+    Arguments:
+      mstars, rstars: per satellite, the present stellar masses and
+        half-light radii (arrays) of its galaxies.
+      histories: per satellite, its halo_history list of profiles.
+      kwargs: pool options of pmap (the backtracking makes no random
+        draws, so no seeds are used).
+
+    Returns the cdmgal_backtracks_batch (mstar, rstar, converged) of every
+    satellite, in input order.
+    """
+    return pmap(_backtrackone, zip(mstars, rstars, histories), seeded=False,
+        **kwargs)
+
+def _stripone(item, rng):
+    alpha, beta, gamma, halo, rtides, finaldeltavirrhou, withscatter = item
+    history = [halo]
+    for rtide in rtides:
+        halo = getmlossp10.getmlossp10(alpha, beta, gamma, halo.mvir, halo.rs,
+            halo.rvir, halo.rvir, rtide, finaldeltavirrhou,
+            withscatter=withscatter, rng=rng)
+        history.append(halo)
+    return history
+
+def striphistories(alpha, beta, gamma, halos, rtides, finaldeltavirrhou,
+    withscatter=False, **kwargs):
+    """
+    Strip many infall halos along their orbits with getmlossp10, in
+    parallel.
+
+    Arguments:
+      alpha, beta, gamma: the shape of the infall halos.
+      halos: the infall profile of each satellite.
+      rtides: per satellite, the tidal radius at each pericenter passage.
+      finaldeltavirrhou: the virial parameter during the interactions.
+      withscatter: draw the rubiatracks scatter (gamma<0.25) in the
+        stripping, from each history's seeded RandomState.
+      kwargs: pool options of pmap.
+
+    Returns, per satellite in input order, the list of profiles from infall
+    through each passage (the reverse of a backtracks halo_history).
+    """
+    return pmap(_stripone, [(alpha, beta, gamma, halo, rt, finaldeltavirrhou,
+        withscatter) for halo, rt in zip(halos, rtides)], **kwargs)
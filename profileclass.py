@@ -1,23 +1,93 @@
 import copy
-from sys import stdout
-from scipy.optimize import minimize_scalar,minimize,fsolve
+import io
+from collections import OrderedDict
 from numpy import log10
-from scipy.integrate import quad
-from scipy.misc import derivative
 from astropy import units
 from astropy.constants import G
-from astropy.constants import c as speedoflight
-from scipy.integrate import odeint,quad
 from numpy import pi,sqrt,where,zeros,exp,shape,inf,log10,nan,log,isfinite
-from inspect import getargspec
 from scipy.special import hyp2f1,gammainc,betainc
 from scipy.special import beta as betafunc
 from scipy.special import gamma as gammafunc
-import matplotlib.pyplot as plt
 import numpy as np
+import instrument
+import profilekernels
+import profilesolve
+import profilegrid
 
 GN=G.to(units.kpc**3/units.M_sun/(units.s)**2)
 
+#the fixed units of the profilekernels layer
+RUNIT=units.kpc
+MUNIT=units.M_sun
+RHOUNIT=units.M_sun/units.kpc**3
+VUNIT=units.km/units.s
+PHIUNIT=(units.km/units.s)**2
+SIGMAUNIT=units.M_sun/units.kpc**2
+FUNIT=units.M_sun/units.kpc**3/(units.km/units.s)**3
+GUNIT=units.kpc**3*units.km/units.s
+
+def _tofloat(x,unit):
+    #strip a Quantity to a plain value in unit; anything else is already in unit
+    try:
+        xunit=x.unit
+    except AttributeError:
+        return x
+    if xunit is unit:
+        return x.value
+    return x.to(unit).value
+
+def _withunit(x,unit,outunit):
+    q=x*unit
+    if not outunit or outunit is unit:
+        return q
+    return q.to(outunit)
+
+class _Param(object):
+    #A profile parameter kept as a plain float in the kernel units (attribute
+    #'_'+name) and handed out as a Quantity. Dimensionless ones stay floats.
+
+    def __init__(self,name,unit=None):
+        self.name='_'+name
+        self.unit=unit
+
+    def __get__(self,obj,objtype=None):
+        if obj is None:
+            return self
+        v=getattr(obj,self.name)
+        if self.unit is None:
+            return v
+        return v*self.unit
+
+    def __set__(self,obj,value):
+        if self.unit is None:
+            value=_tofloat(value,units.dimensionless_unscaled)
+        else:
+            value=_tofloat(value,self.unit)
+        #a new parameter value makes every lazily derived one stale
+        derived=obj.__dict__.get('_derived')
+        if derived:
+            for k in derived:
+                obj.__dict__.pop(k,None)
+            derived.clear()
+        obj.__dict__[self.name]=float(value)
+
+class _Lazy(object):
+    #A derived float (e.g. _mvir), computed by the decorated method on first
+    #access and kept in the instance dict, where it shadows this descriptor
+    #and _Param finds it, until the next _Param is set.
+
+    def __init__(self,func):
+        self.func=func
+        self.name=func.__name__
+
+    def __get__(self,obj,objtype=None):
+        if obj is None:
+            return self
+        v=float(self.func(obj))
+        obj.__dict__[self.name]=v
+        obj.__dict__.setdefault('_derived',set()).add(self.name)
+        return v
+
 def betaincfunc(p,q,x):
     return x**p/p*hyp2f1(p,1-q,p+1,x)
 
@@ -29,15 +99,15 @@ def getnfwrho0(mvir,rs,rvir):
     return mvir/nfwfx(c)/4/np.pi/rs**3
 
 def getdneinasto(alpha):
-    return 3*alpha-1.0/3+8.0/1215.0/alpha+184.0/229635.0/alpha**2+1048.0/31000725.0/alpha**3-17557576.0/1242974068875.0/alpha**4
+    return profilekernels.einastodn(alpha)
 
 def getmtoteinasto(alpha,rho0,rs):
-    h=rs/getdneinasto(alpha)
+    h=rs/getdneinasto(alpha)**alpha
     return 4*pi*rho0*h**3*alpha*gammafunc(3*alpha)
 
 def getmasseinasto(rho0,rs,r,alpha):
     s=(getdneinasto(alpha)**alpha*r/rs).decompose().value
-    return getmtoteinasto(alpha,rho0,rs)*(1-gammainc(3*alpha,s**(1.0/alpha))/gammafunc(3*alpha))
+    return getmtoteinasto(alpha,rho0,rs)*gammainc(3*alpha,s**(1.0/alpha))
 
 def getxfromrhonfw(rho,rhos):
     
@@ -52,27 +122,8 @@ def getxfromrhonfw(rho,rhos):
     return 1.0/3*(first+second)-2.0/3
 
 def getxmaxzhao0(alpha,beta,gamma):
-
-    if alpha==1 and beta==3 and gamma==1:
-        return 2.1625816019114059
-    if alpha==1 and beta==3 and gamma==0:
-        return 4.4247006595498686
-    if alpha==1 and beta==4 and gamma==1:
-        return 1.0
-    if alpha==1 and beta==4 and gamma==0:
-        return 2.0
-    if alpha==1 and beta==5 and gamma==0:
-        return 1.2749172096233057
-    if alpha==1 and beta==5 and gamma==1:
-        return 0.645751312789415
-
-    a=float(alpha)
-    b=float(beta)
-    g=float(gamma)
-
-    x=fsolve(lambda x: (-1.*(3 - g)*x**(1 - g)*((1 + x**a)**(-(b - g)/a) - hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a)))/(-3. + g) - (1.*(2 - g)*x**(1 - g)*hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a))/(-3. + g),1)
-
-    return x    
+    #shared table + LRU memo, see profilekernels.zhaoxmax
+    return profilekernels.zhaoxmax(alpha,beta,gamma)
 
 
 def getmassfromzhao0(alpha,beta,gamma,rhos,rs,r):
@@ -90,6 +141,21 @@ def getmassfromzhao0(alpha,beta,gamma,rhos,rs,r):
 
     return 4*pi*rhos*r**3*(r/rs)**(-gamma)*f/(3-gamma)
 
+def getmassfromzhao(alpha,beta,gamma,rhos,rs,rvir,r,rdecrvir=0):
+    #M(<r) of the Zhao profile of Zhao.rhofunc, tabulating the truncated tail
+    rhos=_tofloat(rhos,RHOUNIT)
+    rs=_tofloat(rs,RUNIT)
+    rvir=_tofloat(rvir,RUNIT)
+    r=_tofloat(r,RUNIT)
+    if rdecrvir==0:
+        return profilekernels.zhaomass(r,rhos,rs,alpha,beta,gamma)*MUNIT
+    return profilekernels.zhaotruncmass(r,rhos,rs,alpha,beta,gamma,rvir,rdecrvir)*MUNIT
+
+def _haloparams(**kwargs):
+    #the nonzero halo parameters as floats in the profilekernels units
+    paramunits={'rho0':RHOUNIT,'rs':RUNIT,'rvir':RUNIT,'mvir':MUNIT,'deltavirrhou':RHOUNIT,'c':units.dimensionless_unscaled,'vmax':VUNIT,'rmax':RUNIT}
+    return dict((k,float(_tofloat(v,paramunits[k]))) for k,v in kwargs.items() if v!=0)
+
 def getrho0frommvirzhao(alpha,beta,gamma,mvir,rs,delta):
     rvir=(mvir/(4*pi/3*delta))**(1.0/3)
     rho0=mvir/getmassfromzhao0(alpha,beta,gamma,1,rs,rvir)
@@ -102,7 +168,7 @@ def getmassfromnfw(rhos,rs,r):
 def getmassfromprofile(rhofunc,r,*args):
     if r==0:
             return 0*units.M_sun
-    return 4*pi*quad(lambda x: (x*r.unit*x*r.unit*(rhofunc(x,*args).to(units.M_sun/r.unit**3))).value,0,r.value)[0]*units.M_sun
+    return 4*pi*instrument.quad(lambda x: (x*r.unit*x*r.unit*(rhofunc(x,*args).to(units.M_sun/r.unit**3))).value,0,r.value)[0]*units.M_sun
 
 def zhaoc(alpha,beta,gamma):
     return 1.0/4/np.pi/betainc(alpha*(3-gamma),alpha*(beta-3),1)
@@ -145,8 +211,17 @@ def zhaorho(x,rho0,alpha,beta,gamma):
 
 def zhaopotential(r,rho0,rs,alpha,beta,gamma):
     
-    if alpha!=1:
-        return np.nan
+    if alpha!=1 or gamma!=int(gamma):
+        #no closed form, tabulate Phi over 8 decades around rs
+        rhos=_tofloat(rho0,RHOUNIT)
+        rsf=_tofloat(rs,RUNIT)
+        grid=profilegrid.ProfileGrid(lambda x: profilekernels.zhaorho(x,rhos,rsf,alpha,beta,gamma),1e-4*rsf,1e4*rsf,m0=profilekernels.zhaomass(1e-4*rsf,rhos,rsf,alpha,beta,gamma))
+        phi=(grid.get_phi(_tofloat(r,RUNIT))*PHIUNIT).to(units.kpc**2/units.s**2)
+        try:
+            tmp=rho0.unit
+            return phi
+        except:
+            return phi.value
 
     else:
         try:
@@ -179,7 +254,7 @@ def zhaozx(x):
 
 def zhaou(i,r,alpha):
     a2=1.0/alpha
-    return quad(lambda x: (np.sin(x)**a2/(r**a2+np.sin(x)**a2))**i,0,np.pi/2)[0]
+    return instrument.quad(lambda x: (np.sin(x)**a2/(r**a2+np.sin(x)**a2))**i,0,np.pi/2)[0]
 
 
 def nfwpotential(rho0,rs,r):
@@ -199,8 +274,8 @@ def plummerfe(m,a,e):
 
 def getge(pot,e):
     
-    rmax=fsolve(lambda x: pot(x)+e,1)
-    return quad(lambda r: np.sqrt(2*(pot(r)-e))*r**2,0,rmax)[0]
+    rmax=instrument.fsolve(lambda x: pot(x)+e,1)
+    return instrument.quad(lambda r: np.sqrt(2*(pot(r)-e))*r**2,0,rmax)[0]
 
 def dehnengecore(m,rs,e):
 
@@ -265,96 +340,305 @@ def dehnenfe(m,rs,gamma,e):
 #     return pre*(first+second+third+fourth)    
 
 
-class RhoProfile():
+#output units of RhoProfile, left out of get_record
+_DEFAULTUNITS=(('rhounit',units.M_sun/units.pc**3),('munit',units.M_sun),('vunit',units.km/units.s),('runit',units.kpc))
+
+def _nargs(f):
+    #number of positional arguments of a function, lambda or bound method
+    func=getattr(f,'__func__',f)
+    try:
+        n=func.__code__.co_argcount
+    except AttributeError:
+        return 1
+    return n-1 if func is not f else n
+
+def _shapeparam(x):
+    #integer-valued shape parameters go back to int, as Zhao special-cases them
+    x=float(x)
+    return int(x) if x==int(x) else x
+
+class RhoProfile(object):
 
     rho_func=0
-    min_r=10**(-4)
-    max_r=10**(4)
+    min_r=_Param('min_r',RUNIT)
+    max_r=_Param('max_r',RUNIT)
+    _min_r=10**(-4)
+    _max_r=10**(4)
+    _gridcache=None
+    _jeanscache=None
+    _dfcache=None
     nargs=1
+    #shape parameters and _Param names of the record (get_record)
+    _recordshape=()
+    _recordparams=()
     rhounit=0
     munit=0
     vunit=0
     runit=0
     
     def __init__(self,rho_func,min_r=10**(-4)*units.kpc,max_r=10**(4)*units.kpc,rhounit=units.M_sun/(units.pc)**3,munit=units.M_sun,vunit=units.km/units.s,runit=units.kpc):
-        #rhofunc: given r, gives rho
+        #rhofunc: given r, gives rho; None for the subclasses, which override _rho
         self.rho_func=rho_func
         self.min_r=min_r
         self.max_r=max_r
-        self.nargs=len(getargspec(rho_func).args)
+        self.nargs=_nargs(rho_func)
         self.rhounit=rhounit
         self.munit=munit
         self.vunit=vunit
         self.runit=runit
 
-    def get_rho(self,r,*args,**kwargs):
+    #The underscore methods are the unit-free core: radii in kpc, densities in
+    #M_sun/kpc^3, masses in M_sun, velocities in km/s. Subclasses override them
+    #with profilekernels functions; the get_ methods convert units once and take
+    #units=False to hand back the raw floats/arrays.
 
+    def _rho(self,r,*args,**kwargs):
+        #generic profiles: rho_func works on Quantities
         if self.nargs==1:
-            return self.rho_func(r,**kwargs).to(self.rhounit)
+            return self.rho_func(r*RUNIT,**kwargs).to(RHOUNIT).value
         else:
             arglist=list(args)[0:self.nargs-1]
             argtp=tuple(arglist)
-            return self.rho_func(r,*argtp,**kwargs).to(self.rhounit)
+            return self.rho_func(r*RUNIT,*argtp,**kwargs).to(RHOUNIT).value
+
+    def _mass(self,r,*args,**kwargs):
+        if len(shape(r))>0:
+            return profilekernels.massgrid(lambda x: self._rho(x,*args,**kwargs),r,self._min_r)
+        if r<=self._min_r:
+            return 0.0
+        return 4*pi*instrument.quad(lambda x: x*x*self._rho(x,*args,**kwargs),self._min_r,r)[0]
+
+    def _vcirc(self,r,*args,**kwargs):
+        return profilekernels.vcirc(self._mass(r,*args,**kwargs),r)
+
+    def _rmax(self,*args,**kwargs):
+        return instrument.minimize_scalar(lambda x: -self._vcirc(x,*args,**kwargs))['x']
+
+    def _phi(self,r):
+        # BT 2.122, tabulated once on the profile grid
+        return self._grid().get_phi(r)
+
+    def _gridkey(self):
+        #the float parameters the grid tables depend on, not the lazily derived ones
+        derived=self.__dict__.get('_derived',())
+        return tuple(sorted((k,v) for k,v in self.__dict__.items() if k[0]=='_' and isinstance(v,float) and k not in derived))
+
+    def _gridbreaks(self):
+        return ()
+
+    def _grid(self):
+        #profilegrid tables between min_r and max_r, built on first use
+        key=self._gridkey()
+        if self._gridcache is None or self._gridcache[0]!=key:
+            #generic profiles have no mass inside min_r, let the grid estimate it
+            m0=self._mass(self._min_r) or None
+            grid=profilegrid.ProfileGrid(self._rho,self._min_r,self._max_r,m0=m0,breaks=self._gridbreaks())
+            self._gridcache=(key,grid)
+        return self._gridcache[1]
+
+    def _jeans(self,beta=0,tracer=None):
+        #profilegrid.JeansTable of the tracer (default the profile itself) in the
+        #mass of this profile, built on first use
+        key=(self._gridkey(),float(beta),None if tracer is None else (type(tracer),tracer._gridkey()))
+        if self._jeanscache is None or self._jeanscache[0]!=key:
+            nufunc=None if tracer is None else tracer._rho
+            self._jeanscache=(key,profilegrid.JeansTable(self._grid(),nufunc=nufunc,beta=beta))
+        return self._jeanscache[1]
+
+    def _sigma(self,r,beta=0,tracer=None):
+        #Jeans equation with constant anisotropy, nu sigma_r^2 r^2beta=G int_r^inf nu M r'^(2beta-2) dr'
+        return self._jeans(beta,tracer).get_sigma(r)
+
+    def _df(self,tracer=None):
+        #profilegrid.EddingtonTable of the tracer (default the profile itself) in the
+        #potential of this profile, built on first use
+        key=(self._gridkey(),None if tracer is None else (type(tracer),tracer._gridkey()))
+        if self._dfcache is None or self._dfcache[0]!=key:
+            nufunc=None if tracer is None else tracer._rho
+            self._dfcache=(key,profilegrid.EddingtonTable(self._grid(),nufunc=nufunc))
+        return self._dfcache[1]
+
+    def _projected(self,r,maxr=None):
+        #Abel projection, tabulated on the profile grid unless cut at the 3D radius maxr
+        if maxr is None:
+            return self._grid().get_projected(r)
+        return profilegrid.abel(self._rho,r,maxr,self._gridbreaks())
+
+    def _sethaloparams(self,p,branch):
+        #rho0, rs and rvir from profilesolve.solvehalo, mvir if the branch had
+        #it; anything missing from p is derived on first use
+        self.rho0=float(p['rho0'])
+        self.rs=float(p['rs'])
+        if 'rvir' in p:
+            self.rvir=float(p['rvir'])
+        if 'mvir' in branch:
+            self.mvir=float(p['mvir'])
+
+    #Derived halo parameters, computed on first access (see _Lazy). rvir is only
+    #left to here when the constructor got rho0 and rs, which fix rho(r).
+
+    @_Lazy
+    def _rvir(self):
+        #(a deferred constructor solve, so it raises ValueError here when
+        #no concentration fits the given parameters)
+        given=dict(self._given,rho0=self._rho0,rs=self._rs)
+        return profilesolve.solvehalo(self._solveshape(),strict=True,**given)['rvir']
+
+    @_Lazy
+    def _mvir(self):
+        return self._mass(self._rvir)
+
+    @_Lazy
+    def _c(self):
+        return self._rvir/self._rs
+
+    @_Lazy
+    def _deltavirrhou(self):
+        return self._mvir/(4*pi/3*self._rvir**3)
+
+    @_Lazy
+    def _rpeak(self):
+        #radius and height of the circular velocity peak
+        return self._rmax()
+
+    @_Lazy
+    def _vpeak(self):
+        return self._vcirc(self._rpeak)
+
+    def _solvehalo(self,given,branch,rdecrvir=0):
+        #solve the constructor parameters with profilesolve, leaving the
+        #concentration solve for later when rho0 and rs are given
+        if branch[:2]==('rho0','rs') and rdecrvir==0:
+            self._given=given
+            p=given
+        else:
+            p=profilesolve.solvehalo(self._solveshape(),strict=True,**given)
+        self._sethaloparams(p,branch)
+
+    def get_record(self):
+        """
+        The profile as a small dict of plain floats (and strings of any
+        non-default output units), from which profilefromrecord rebuilds it
+        without the constructor solve.
+        """
+        if not self._recordparams:
+            raise TypeError('%s has no parameter record' % type(self).__name__)
+        rec={'kind':type(self).__name__}
+        for k in self._recordshape:
+            rec[k]=float(getattr(self,k))
+        for k in self._recordparams:
+            rec[k]=getattr(self,'_'+k)
+        for k,default in _DEFAULTUNITS:
+            if getattr(self,k) and getattr(self,k)!=default:
+                rec[k]=getattr(self,k).to_string()
+        return rec
+
+    def __reduce_ex__(self,protocol):
+        #pickle the record; the tables are rebuilt on first use
+        if not self._recordparams:
+            return object.__reduce_ex__(self,protocol)
+        return (profilefromrecord,(self.get_record(),))
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        for k in ('_gridcache','_jeanscache','_dfcache','_masstable'):
+            state.pop(k,None)
+        return state
+
+    def get_rho(self,r,*args,**kwargs):
+        withunits=kwargs.pop('units',True)
+        rho=self._rho(_tofloat(r,RUNIT),*args,**kwargs)
+        return _withunit(rho,RHOUNIT,self.rhounit) if withunits else rho
         
     def get_mass(self,r,*args,**kwargs):
-
-        if r==0:
-            return 0*self.munit
-        m=4*pi*quad(lambda x: x*x*(self.get_rho(x*r.unit,*args,**kwargs).to(self.munit/(r.unit)**3)).value,self.min_r.to(r.unit).value,r.value)[0]
-        return m*self.munit
+        withunits=kwargs.pop('units',True)
+        m=self._mass(_tofloat(r,RUNIT),*args,**kwargs)
+        return _withunit(m,MUNIT,self.munit) if withunits else m
 
     def phiode(self,y,r,*args):
         phi,r2dpdr=y
         return [(1.0/r/r*r2dpdr).value,(r*r*4*pi*GN*self.get_rho(r,args)).value]
-    def get_phi(self,r,*args,**kwargs):#DOES NOT WORK
-#        print 'this function doesn\'t work yet'
-#        final=odeint(lambda y,r,*args: self.phiode([y[0]*GN.unit*self.munit/self.runit,y[1]*GN.unit*self.munit/self.runit/self.runit],r*self.runit,args),[(-4*pi*GN*self.rho0*self.rs**2).value,0],[self.min_r.value,r.value])
-#        return -4*pi*GN*derivative(lambda y,*args: y*y*d1(y,args),r,args=args,dx=.1*r)/r/r
-        
-        # BT 2.122
-
-        i1=1.0/(r.to(units.kpc).value)*quad(lambda rp:self.get_rho(rp*units.kpc).to(units.M_sun/units.kpc**3).value*rp**2,0,r.to(units.kpc).value)[0]*units.M_sun/units.kpc
-        i2=quad(lambda nu: self.get_rho(1.0/np.sqrt(nu)*units.kpc).to(units.M_sun/units.kpc**3).value/nu**2/2.0,0,1.0/(r.to(units.kpc).value)**2)[0]*units.M_sun/units.kpc
 
-        return -4*np.pi*GN*(i1+i2)
-
-    def get_sigma(self,r):
-        intg=quad(lambda nu: self.get_mass(1.0/nu*units.kpc).value*self.get_rho(1.0/nu*units.kpc).value*nu**4,0,(1.0/r).value)[0]
-        return GN*intg/self.get_rho(r)
+    def get_phi(self,r,units=True):
+        phi=self._phi(_tofloat(r,RUNIT))
+        return phi*PHIUNIT if units else phi
+
+    def get_sigma(self,r,beta=0,tracer=None,units=True):
+        #radial velocity dispersion of tracer (a massless RhoProfile, e.g. a
+        #Plummer in a Zhao halo; default the profile itself) with constant anisotropy beta
+        sigma=self._sigma(_tofloat(r,RUNIT),beta,tracer)
+        return _withunit(sigma,VUNIT,self.vunit) if units else sigma
+
+    def get_fe(self,e,tracer=None,units=True):
+        #isotropic distribution function f(E) of tracer (default the profile itself), Eddington inversion
+        f=self._df(tracer).get_f(_tofloat(e,PHIUNIT))
+        return f*FUNIT if units else f
+
+    def get_ge(self,e,units=True):
+        #density of states g(E)
+        g=self._df().get_g(_tofloat(e,PHIUNIT))
+        return g*GUNIT if units else g
+
+    def get_dftable(self,tracer=None,units=True):
+        #energies, f(E) and g(E) at the nodes of the profile grid
+        df=self._df(tracer)
+        if units:
+            return df.E*PHIUNIT,df.f*FUNIT,df.g*GUNIT
+        return df.E,df.f,df.g
 
     def get_vcirc(self,r,*args,**kwargs):
-        if r==0:
-            return 0*self.vunit
-        return sqrt(GN*self.get_mass(r,*args,**kwargs)/r).to(self.vunit)
+        withunits=kwargs.pop('units',True)
+        v=self._vcirc(_tofloat(r,RUNIT),*args,**kwargs)
+        return _withunit(v,VUNIT,self.vunit) if withunits else v
 
     def get_vmax(self,*args,**kwargs):
-        return -minimize_scalar(lambda x: -self.get_vcirc(x*self.runit,*args,**kwargs).value)['fun']*(self.vunit)
+        withunits=kwargs.pop('units',True)
+        if args or kwargs:
+            v=self._vcirc(self._rmax(*args,**kwargs),*args,**kwargs)
+        else:
+            v=self._vpeak
+        return _withunit(v,VUNIT,self.vunit) if withunits else v
 
     def get_rmax(self,*args,**kwargs):
-        return minimize_scalar(lambda x: -self.get_vcirc(x*self.runit,*args,**kwargs).value)['x']*(self.runit)
+        withunits=kwargs.pop('units',True)
+        rmax=self._rmax(*args,**kwargs) if args or kwargs else self._rpeak
+        return _withunit(rmax,RUNIT,self.runit) if withunits else rmax
 
     def get_meanrho(self,r,*args,**kwargs):
-        return self.get_mass(r,*args,**kwargs)/(4*pi/3*r**3)
-
-    def get_projected(self,r,maxr):
-        smallnum=1E-10
-        projint=lambda x:(self.get_rho(x*r.unit).to(self.munit/(r.unit**3))*(x*r.unit)/(sqrt((x*r.unit)**2-r**2))).value
-        mr=maxr.to(r.unit).value
-        return 2*quad(projint,r.value+smallnum,mr-smallnum)[0]*self.munit/(r.unit**2)
+        withunits=kwargs.pop('units',True)
+        r=_tofloat(r,RUNIT)
+        rho=self._mass(r,*args,**kwargs)/(4*pi/3*r**3)
+        return rho*RHOUNIT if withunits else rho
+
+    def get_projected(self,r,maxr=None,units=True):
+        sigma=self._projected(_tofloat(r,RUNIT),None if maxr is None else _tofloat(maxr,RUNIT))
+        return sigma*SIGMAUNIT if units else sigma
+
+    def get_image(self,npix,width,center=(0,0),maxr=None,oversample=1,units=True):
+        #npix x npix surface density map of side width, pixel means over oversample^2 subpixels
+        center=[float(_tofloat(x,RUNIT)) for x in center]
+        maxr=None if maxr is None else _tofloat(maxr,RUNIT)
+        image=profilegrid.rasterize(lambda r: self._projected(r,maxr),npix,_tofloat(width,RUNIT),centers=[center],oversample=oversample)
+        return image*SIGMAUNIT if units else image
     
 class Zhao(RhoProfile):
 
     alpha=0
     beta=0
     gamma=0
-    rho0=0
-    rs=0
-    rvir=0
-    mvir=0
-    deltavirrhou=0
-    c=0
+    rho0=_Param('rho0',RHOUNIT)
+    rs=_Param('rs',RUNIT)
+    rvir=_Param('rvir',RUNIT)
+    mvir=_Param('mvir',MUNIT)
+    deltavirrhou=_Param('deltavirrhou',RHOUNIT)
+    c=_Param('c')
+    _rho0=0
+    _rs=0
     xmax=-1
     rdecrvir=0
+    _masstable=None
+    _recordshape=('alpha','beta','gamma','rdecrvir')
+    _recordparams=('rho0','rs','rvir','mvir','deltavirrhou','c')
     
     def __init__(self,alpha,beta,gamma,rho0=0,rs=0,rvir=0,mvir=0,deltavirrhou=0,c=0,rdecrvir=0,vatr=0,rforv=0,vmax=0,rmax=0,rhounit=units.M_sun/(units.pc)**3,munit=units.M_sun,vunit=units.km/units.s,runit=units.kpc):
         
@@ -368,259 +652,46 @@ class Zhao(RhoProfile):
         self.rdecrvir=rdecrvir
 
 
-        if rs==0 and c!=0 and rvir!=0:
-            rs=rvir/c
-        if rvir==0 and c!=0 and rs!=0:
-            rvir=rs*c
-
         if vmax!=0 and rmax!=0:
             vatr=vmax
             rforv=rmax
-        if rho0!=0 and rs!=0 and rvir!=0:
-            self.rho0=rho0
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            rhof=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhof)
-            self.mvir=self.get_mass(rvir)
-            self.deltavirrhou=self.mvir/(4*pi/3*rvir**3)
-        elif mvir!=0 and rs!=0 and rvir!=0:
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            self.mvir=mvir
-            if rdecrvir==0:
-                m1=getmassfromzhao0(alpha,beta,gamma,1*mvir.unit/(rs.unit**3),rs,rvir)
-                self.rho0=mvir/m1*mvir.unit/(rs.unit**3)
-            else:
-                rhof1=lambda r,rhos: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,rhos*(mvir.unit/(rs.unit**3)),self.rs,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rho0: getmassfromprofile(rhof1,rvir,rho0)
-                x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-                self.rho0=x*mvir.unit/(rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-        elif deltavirrhou!=0 and rs!=0 and rvir!=0:
-            mvir=4.0*pi/3*deltavirrhou*rvir**3
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            if rdecrvir==0:
-                m1=getmassfromzhao0(alpha,beta,gamma,1*mvir.unit/(rs.unit**3),rs,rvir)
-                self.rho0=mvir/m1*mvir.unit/(rs.unit**3)
-            else:
-                rhof1=lambda r,rhos: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,rhos*(mvir.unit/(rs.unit**3)),self.rs,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rho0: getmassfromprofile(rhof1,rvir,rho0)
-                x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-                self.rho0=x*mvir.unit/(rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rvir!=0 and mvir!=0:
-            self.rho0=rho0
-            self.rvir=rvir
-            self.mvir=mvir
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            if rdecrvir==0:
-                m1=lambda rsa: getmassfromzhao0(alpha,beta,gamma,rho0,rsa,rvir)
-            else:
-                rhof1=lambda r,rsa: self.rhofunc(r*rvir.unit,self.alpha,self.beta,self.gamma,self.rho0,rsa*rvir.unit,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rsa: getmassfromprofile(rhof1,rvir,rsa)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            self.c=self.rvir/self.rs
-            rhofn=lambda r: self.rhofunc(r*rvir.unit,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rs!=0 and mvir!=0:
-            self.rho0=rho0
-            self.mvir=mvir
-            self.rs=rs
-            if rdecrvir==0:
-                m1=lambda rvira: getmassfromzhao0(alpha,beta,gamma,rho0,rs,rvira)
-            else:
-                rhof1=lambda r,rvira: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,self.rho0,self.rs,rvira*rs.unit,rdecrvir=rdecrvir)
-                m1=lambda rvira: getmassfromprofile(rhof1,rvira,rvira)
-            x=minimize_scalar(lambda y: abs(log10((m1(y)/mvir).decompose().value)))['x']
-            self.rvir=x*rs.unit
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rho0!=0 and rs!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.rs=rs
-            self.deltavirrhou=deltavirrhou
-            self.c=self.rvir/self.rs
-            if rdecrvir==0:
-                m1=lambda rvira: getmassfromzhao0(alpha,beta,gamma,rho0,rs,rvira)
-            else:
-                rhof1=lambda r,rvira: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,self.rho0,self.rs,rvira*rs.unit,rdecrvir=rdecrvir)
-                m1=lambda rvira: getmassfromprofile(rhof1,rvira,rvira)
-            x=minimize_scalar(lambda y: abs((m1(y*rs.unit)/(4*pi/3*(y*rs.unit)**3)).value-(deltavirrhou.to(units.M_sun/rs.unit**3).value)))['x']
-            self.rvir=x*rs.unit
-            self.mvir=4*pi/3*(x*rs.unit)**3*deltavirrhou
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rvir!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.rvir=rvir
-            self.deltavirrhou=deltavirrhou
-            mvir=4*pi/3*rvir**3
-            self.mvir=mvir
-            if rdecrvir==0:
-                m1=lambda rsa: getmassfromzhao0(alpha,beta,gamma,rho0,rsa,rvir)
-            else:
-                rhof1=lambda r,rsa: self.rhofunc(r*rvir.unit,self.alpha,self.beta,self.gamma,self.rho0,rsa*rvir.unit,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rsa: getmassfromprofile(rhof1,rvir,rsa)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and mvir!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.rvir=rvir
-            self.c=self.rvir/self.rs
-            if rdecrvir==0:
-                m1=lambda rsa: getmassfromzhao0(alpha,beta,gamma,rho0,rsa,rvir)
-            else:
-                rhof1=lambda r,rsa: self.rhofunc(r*rvir.unit,self.alpha,self.beta,self.gamma,self.rho0,rsa*rvir.unit,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rsa: getmassfromprofile(rhof1,rvir,rsa)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-            
-        elif rs!=0 and mvir!=0 and deltavirrhou!=0:
-            self.rs=rs
-            self.mvir=mvir
-            rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.deltavirrhou=deltavirrhou
-            self.rvir=rvir
-            self.c=self.rvir/self.rs
-            if rdecrvir==0:
-                m1=getmassfromzhao0(alpha,beta,gamma,1.0*mvir.unit/(rs.unit**3),rs,rvir)
-                self.rho0=mvir/m1*mvir.unit/(rs.unit**3)
-            else:
-                rhof1=lambda r,rhos: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,rhos*(mvir.unit/(rs.unit**3)),self.rs,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rho0: getmassfromprofile(rhof1,rvir,rho0)
-                x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-                self.rho0=x
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif c!=0 and mvir!=0 and deltavirrhou!=0:
-            self.c=c
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            self.rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.rs=self.rvir/copy.copy(c)
-            if rdecrvir==0:
-                m1=getmassfromzhao0(alpha,beta,gamma,1*self.mvir.unit/(self.rs.unit**3),self.rs,self.rvir)
-                self.rho0=self.mvir/m1*self.mvir.unit/(self.rs.unit**3)
-            else:
-                rhof1=lambda r,rhos: self.rhofunc(r*self.rs.unit,self.alpha,self.beta,self.gamma,rhos*(self.mvir.unit/(self.rs.unit**3)),self.rs,self.rvir,rdecrvir=rdecrvir)
-                m1=lambda rho0: getmassfromprofile(rhof1,self.rvir,self.rho0)
-                x=minimize_scalar(lambda y: abs(log10(m1(y)/self.mvir)))['x']
-                self.rho0=x*self.mvir.unit/(self.rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rmax!=0 and vmax!=0 and mvir!=0 and rdecrvir==0:
-            self.mvir=mvir
-            self.rs=rmax/getxmaxzhao0(self.alpha,self.beta,self.gamma)
-            mwithinrmax=vmax**2*rmax/GN
-            m2=getmassfromzhao0(self.alpha,self.beta,self.gamma,1*mvir.unit/(rmax.unit**3),self.rs,rmax)
-            self.rho0=mwithinrmax/m2*(mvir.unit/rmax.unit**3)
-            m1=lambda rvira: getmassfromzhao0(self.alpha,self.beta,self.gamma,self.rho0,self.rs,rvira*units.kpc)
-            x=minimize_scalar(lambda y: abs(log10((m1(y)/mvir).decompose().value)))
-            self.rvir=x['x']*rmax.unit
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rmax!=0 and vmax!=0 and rvir!=0 and rdecrvir==0:
-            self.rvir=rvir
-            self.rs=rmax/getxmaxzhao0(self.alpha,self.beta,self.gamma)
-            mwithinrmax=vmax**2*rmax/GN
-            m2=getmassfromzhao0(self.alpha,self.beta,self.gamma,1*units.M_sun/(rmax.unit**3),self.rs,rmax)
-            self.rho0=mwithinrmax/m2*(units.M_sun/rmax.unit**3)
-            self.mvir=getmassfromzhao0(self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir)
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif vmax!=0 and mvir!=0 and deltavirrhou!=0 and rdecrvir==0:
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            self.rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            mmax=lambda params: (np.log10(getmassfromzhao0(self.alpha,self.beta,self.gamma,10**params[0]*units.M_sun/units.kpc**3,params[1]*units.kpc,self.rvir).value/mvir.value))**2+(np.log10(getmassfromzhao0(self.alpha,self.beta,self.gamma,10**params[0]*units.M_sun/units.kpc**3,params[1]*units.kpc,params[1]*units.kpc*getxmaxzhao0(self.alpha,self.beta,self.gamma)).value/(vmax**2*params[1]*units.kpc*getxmaxzhao0(self.alpha,self.beta,self.gamma)/GN).to(units.M_sun).value))**2
-            x=minimize(mmax,[6,.1*self.rvir.value],bounds=[[-2,30],[.01,1000]])
-            xwithunit=[10**x['x'][0]*mvir.unit/(units.kpc**3),x['x'][1]*units.kpc]
-            self.rho0=xwithunit[0]
-            self.rs=xwithunit[1]
-            self.c=self.rvir/self.rs
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-                    
-        elif rmax!=0 and vmax!=0 and deltavirrhou!=0 and rdecrvir==0:
-            self.rs=rmax/getxmaxzhao0(self.alpha,self.beta,self.gamma)
-            mwithinrmax=(vmax**2*rmax/GN).to(units.M_sun)
-            m2=getmassfromzhao0(self.alpha,self.beta,self.gamma,1*units.M_sun/(rmax.unit**3),self.rs,rmax)
-            self.rho0=mwithinrmax/m2*(units.M_sun/rmax.unit**3)
-            self.deltavirrhou=deltavirrhou
-            self.c=self.rvir/self.rs
-            if rdecrvir==0:
-                m1=lambda rvira: getmassfromzhao0(alpha,beta,gamma,self.rho0,self.rs,rvira)
-            else:
-                rhof1=lambda r,rvira: self.rhofunc(r*rs.unit,self.alpha,self.beta,self.gamma,self.rho0,self.rs,rvira*rs.unit,rdecrvir=rdecrvir)
-                m1=lambda rvira: getmassfromprofile(rhof1,rvira,rvira)
-            x=minimize_scalar(lambda y: abs((m1(y*rmax.unit)/(4*pi/3*(y*rmax.unit)**3)).value-(deltavirrhou.to(units.M_sun/rmax.unit**3).value)))['x']
-            print 'rv', minimize_scalar(lambda y: abs((m1(y*rmax.unit)/(4*pi/3*(y*rmax.unit)**3)).value-(deltavirrhou.to(units.M_sun/rmax.unit**3).value)))['x']
-            self.rvir=x*rmax.unit
-            self.mvir=4*pi/3*(x*rmax.unit)**3*deltavirrhou
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-            
+        if rdecrvir!=0:
+            #the vmax/rmax branches assume the untruncated x_max
+            vmax=rmax=0
+        t=instrument.tic()
+        given=_haloparams(rho0=rho0,rs=rs,rvir=rvir,mvir=mvir,deltavirrhou=deltavirrhou,c=c,vmax=vmax,rmax=rmax)
+        branch=profilesolve.findbranch(given)
+        if branch is not None:
+            self._solvehalo(given,branch,rdecrvir)
+            branch='+'.join(branch)
         elif vatr!=0 and rforv!=0 and mvir!=0:
+            branch='vatr+rforv+mvir'
             self.mvir=mvir
-            rhof1=lambda r,haloparams: self.rhofunc(r*rforv.unit,self.alpha,self.beta,self.gamma,haloparams[0]*(mvir.unit/(rforv.unit**3)),haloparams[1]*rforv.unit,haloparams[2]*rforv.unit,rdecrvir=rdecrvir)
-            m1=lambda haloparams: getmassfromprofile(rhof1,rforv,haloparams)
-            m2=lambda haloparams: getmassfromprofile(rhof1,haloparams[2],haloparams)
+            m1=lambda haloparams: getmassfromzhao(self.alpha,self.beta,self.gamma,haloparams[0],haloparams[1],haloparams[2],rforv,rdecrvir)
+            m2=lambda haloparams: getmassfromzhao(self.alpha,self.beta,self.gamma,haloparams[0],haloparams[1],haloparams[2],haloparams[2],rdecrvir)
 
-            x=minimize(lambda params: abs((GN*m1([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[(20*mvir/(4*pi/3*rforv**3)).value,rforv.value,5*rforv.value],constraints={'type':'eq','fun': lambda params: log10(m2([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/mvir)})
+            x=instrument.minimize(lambda params: abs((GN*m1([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[(20*mvir/(4*pi/3*rforv**3)).value,rforv.value,5*rforv.value],constraints={'type':'eq','fun': lambda params: log10(m2([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/mvir)})
 
             xwithunit=[x['x'][0]*mvir.unit/(rforv.unit**3),x['x'][1]*rforv.unit,x['x'][2]*rforv.unit]
             self.rho0=xwithunit[0]
             self.rs=xwithunit[1]
             self.rvir=xwithunit[2]
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
 
         elif vatr!=0 and rforv!=0 and rvir!=0:
+            branch='vatr+rforv+rvir'
             self.rvir=rvir
-            rhof1=lambda r,haloparams: self.rhofunc(r*rforv.unit,self.alpha,self.beta,self.gamma,haloparams[0],haloparams[1],rvir,rdecrvir=rdecrvir)
-            m1=lambda haloparams: getmassfromprofile(rhof1,rforv,haloparams)
+            m1=lambda haloparams: getmassfromzhao(self.alpha,self.beta,self.gamma,haloparams[0],haloparams[1],rvir,rforv,rdecrvir)
 
             mguess=(vatr**2*rforv/GN).to(units.M_sun)
 
-            x=minimize(lambda params: abs(((GN*m1([params[0]*units.M_sun/(rforv.unit**3),params[1]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value),[(mguess/rforv**3).value,3*rforv.value])
+            x=instrument.minimize(lambda params: abs(((GN*m1([params[0]*units.M_sun/(rforv.unit**3),params[1]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value),[(mguess/rforv**3).value,3*rforv.value])
             xwithunit=[x['x'][0]*units.M_sun/(rforv.unit**3),x['x'][1]*rforv.unit]
             self.rho0=xwithunit[0]
             self.rs=xwithunit[1]
-            self.mvir=getmassfromprofile(rhof1,rvir,xwithunit)
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
-
+        else:
+            raise ValueError('unsupported combination of halo parameters')
+        RhoProfile.__init__(self,None)
+        instrument.toc('branches',type(self).__name__+':'+branch,t)
 
     def rhofunc(self,r,alpha=nan,beta=nan,gamma=nan,rho0=nan,rs=nan,rvir=nan,rdecrvir=.1):
 
@@ -637,76 +708,39 @@ class Zhao(RhoProfile):
         if ~isfinite(rvir):
             rvir=self.rvir
         
-        if len(shape(r))>0:
-
-            if rdecrvir==0:
-                top=rho0
-                roverrs=(r/rs).decompose().value
-                ba=(roverrs)**gamma
-                bb=(1+(roverrs)**alpha)
-                bc=bb**((beta-gamma)/alpha)
+        rho=profilekernels.zhaorho(_tofloat(r,RUNIT),_tofloat(rho0,RHOUNIT),_tofloat(rs,RUNIT),alpha,beta,gamma,_tofloat(rvir,RUNIT),rdecrvir)
+        return rho*RHOUNIT
 
-                return top/(ba*bc)
-            
-            else:
+    def _solveshape(self):
+        return profilesolve.ZhaoShape(self.alpha,self.beta,self.gamma)
 
-                rho=zeros(len(r))
-                w0=where(r==0)
-                rho[w0]=inf
-                win=where(r<=rvir)
-                wout=where(r>rvir)
-    
-                top=rho0
-                ba=(r[win]/rs)**gamma
-                bb=(1+(r[win]/rs)**alpha)
-                bc=bb**(beta-gamma)/alpha
-    
-                rho[win]=top/(ba*bc)
-    
-                rdec=rdecrvir*rvir
-    
-                c=rvir/rs
-                epsilon=(-gamma-beta*c**alpha)/(1+c**alpha)+1.0/rdecrvir
-    
-                ca=rho0/(c**gamma*(1+c**alpha)**((beta-gamma)/alpha))
-                cb=(r[wout]/rvir)**epsilon
-                cd=exp(-(r[wout]-rvir)/rdec)
-    
-                rho[wout]=ca*cb*cd
-    
-                return rho
+    def _rho(self,r):
+        if self.rdecrvir==0:
+            return profilekernels.zhaorho(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma)
+        return profilekernels.zhaorho(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma,self._rvir,self.rdecrvir)
 
+    def _mass(self,r):
+        if self.rdecrvir==0:
+            return profilekernels.zhaomass(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma)
+        elif np.all(r<=self._rvir):
+            return profilekernels.zhaomass(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma)
         else:
+            return profilekernels.zhaotruncmass(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma,self._rvir,self.rdecrvir,table=self._truncmasstable())
 
-            if r<=rvir or rdecrvir==0:
-                if r==0 and gamma>0:
-                    return inf
-                top=rho0
-                roverrs=(r/rs).decompose().value
-                ba=(roverrs)**gamma
-                bb=(1+(roverrs)**alpha)
-                bc=bb**(beta-gamma)/alpha
-
-                return top/(ba*bc)
-
-            else:
-
-                rdec=rdecrvir*rvir
-
-                c=rvir/rs
-                epsilon=(-gamma-beta*c**alpha)/(1+c**alpha)+1.0/rdecrvir
+    def _truncmasstable(self):
+        #tabulated mass beyond rvir, built on first use and rebuilt only if c changes
+        key=(self._rvir/self._rs,self.rdecrvir)
+        if self._masstable is None or self._masstable[0]!=key:
+            self._masstable=(key,profilekernels.zhaotrunctable(self.alpha,self.beta,self.gamma,key[0],self.rdecrvir))
+        return self._masstable[1]
 
-                ca=rho0/(c**gamma*(1+c**alpha)**((beta-gamma)/alpha))
-                cb=(r/rvir)**epsilon
-                cd=exp(-(r-rvir)/rdec)
+    def _phi(self,r):
+        if self.alpha==1 and self.gamma==int(self.gamma) and self.rdecrvir==0:
+            return profilekernels.zhaophi(r,self._rho0,self._rs,self.alpha,self.beta,self.gamma)
+        return RhoProfile._phi(self,r)
 
-                return ca*cb*cd
-
-    def get_mass(self,r):
-        if self.rdecrvir==0:
-            return getmassfromzhao0(self.alpha,self.beta,self.gamma,self.rho0,self.rs,r)
-        else:
-            return super(Zhao,self).get_mass(r)
+    def _gridbreaks(self):
+        return (self._rvir,) if self.rdecrvir!=0 else ()
 
     def rmax_ftomin(self,xm):
         print 'm',xm
@@ -730,66 +764,19 @@ class Zhao(RhoProfile):
             return abs(top(xm)/(xm*(bot1(xm)+bot2(xm))))
 
 
-    def get_rmax(self):
+    def _rmax(self):
         if self.xmax==-1:
-            a=float(self.alpha)
-            b=float(self.beta)
-            g=float(self.gamma)
-
-#            x=fsolve(lambda x: (-1.*(3 - g)*x**(1 - g)*((1 + x**a)**(-(b - g)/a) - hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a)))/(-3. + g) - (1.*(2 - g)*x**(1 - g)*hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a))/(-3. + g),1,fprime=lambda x:(x**(2 - g)*(((3 - g)*(-((b - g)*x**(-1 + a)*(1 + x**a)**(-1 - (b - g)/a)) - ((3 - g)*((1 + x**a)**(-(b - g)/a) - hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a)))/x))/x - ((3 - g)*((1 + x**a)**(-(b - g)/a) - hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a)))/x**2))/(3 - g) + (2*(2 - g)*((1 + x**a)**(-(b - g)/a) - hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a)))/x**g + ((1 - g)*(2 - g)*hyp2f1((3 - g)/a,(b - g)/a,(3 + a - g)/a,-x**a))/((3 - g)*x**g))
-
-            x=minimize_scalar(lambda x: -getmassfromzhao0(a,b,g,1,1,10**x)/10**x)
-            
-            
-            #a=1.0*(3-self.gamma)/self.alpha
-            #b=1.0*(self.beta-self.gamma)/self.alpha
-            #c=1.0*(self.alpha-self.gamma+3)/self.alpha
-            
-            
-#            print a,b,c
-#            top=lambda xm: xm**(3-self.gamma)/(3-self.gamma)*hyp2f1(a,b,c,-xm**self.alpha)
-#            bot1=lambda xm: xm**(2-self.gamma)*hyp2f1(a,b,c,-xm**self.alpha)
-#            bot2=lambda xm: xm**(3-self.gamma)/(3-self.gamma)*(-self.alpha*xm**(self.alpha-1))*a*b/c*hyp2f1(a+1,b+1,c+1,-xm**self.alpha)
-
-            #minfunc=lambda xm:abs(log10(top(xm))-log10(xm*(bot1(xm)+bot2(xm))))
-            #x=minimize_scalar(lambda xm: self.rmax_ftomin(xm),[.5,1,100])
-            self.xmax=10**x['x']
-            return self.xmax*self.rs
-        else:
-            return self.xmax*self.rs
-
-    def get_vmax(self):
-        rmax=self.get_rmax()
-        return self.get_vcirc(rmax)
+            self.xmax=getxmaxzhao0(self.alpha,self.beta,self.gamma)
+        if self.rdecrvir!=0 and self.xmax*self._rs>self._rvir:
+            #the truncation cuts in before the untruncated peak
+            x=instrument.minimize_scalar(lambda lr: -self._vcirc(10**lr),bounds=(log10(self._rvir),log10(self.xmax*self._rs)),method='bounded')
+            return 10**x['x']
+        return self.xmax*self._rs
     
     def get_sigma_0(self):
         if self.beta==4 and self.alpha==1:
             return 3.0*(1-self.gamma)/(4*(3.0-2*self.gamma)*(5-2*self.gamma))*self.GN/self.rs
 
-    def get_phi(self,r):
-        return zhaopotential(r,self.rho0,self.rs,self.alpha,self.beta,self.gamma)
-        
-    def get_projected(self,r):
-
-        if r==0:
-            if self.gamma==1:
-                return np.inf
-            else:
-                return 2*self.rs*self.rho0*abs(gammafunc(1-self.gamma)*gammafunc(self.gamma-1+1.0*self.beta/self.alpha-1.0*self.gamma/self.alpha)/gammafunc(1.0*self.beta/self.alpha-self.gamma/self.alpha))
-
-        modbeta=self.alpha*(self.beta-3)
-        if isinstance(self.alpha,int) and self.alpha>0 and isinstance(modbeta,int) and modbeta>0:
-            ui=0
-            for i in range(0,self.alpha*(2-self.gamma)):
-                print i
-                print self.alpha,self.beta,self.gamma
-                print zhaofi(i,self.alpha,self.beta,self.gamma)
-                print zhaou(self.alpha*(self.beta-2)+i,r/self.rs,self.alpha)
-                ui=ui+zhaofi(i,self.alpha,self.beta,self.gamma)*zhaou(self.alpha*(self.beta-2)+i,r/self.rs,self.alpha)
-                
-            return ui/(r/self.rs)
-
-    
     def get_dispersion(self,r):
         x=r/self.rs
         drhodroverrho=-self.gamma/r-(self.beta-self.gamma)/self.alpha**2*x**(1.0/self.alpha-1)/self.rs/(1+x)
@@ -797,13 +784,16 @@ class Zhao(RhoProfile):
 
 class NFW(RhoProfile):
 
-    rho0=0
-    rs=0
-    rvir=0
-    mvir=0
-    deltavirrhou=0
-    c=0
+    rho0=_Param('rho0',RHOUNIT)
+    rs=_Param('rs',RUNIT)
+    rvir=_Param('rvir',RUNIT)
+    mvir=_Param('mvir',MUNIT)
+    deltavirrhou=_Param('deltavirrhou',RHOUNIT)
+    c=_Param('c')
+    _rho0=0
+    _rs=0
     xmax=2.163
+    _recordparams=('rho0','rs','rvir','mvir','deltavirrhou','c')
     munit=0
     rhounit=0
     runit=0
@@ -815,183 +805,42 @@ class NFW(RhoProfile):
         self.munit=units.M_sun
 
 
-        if rs==0 and c!=0 and rvir!=0:
-            rs=rvir/c
-        if rvir==0 and c!=0 and rs!=0:
-            rvir=rs*c
-
         if vmax!=0 and rmax!=0:
             vatr=vmax
             rforv=rmax
-        if rho0!=0 and rs!=0 and rvir!=0:
-            self.rho0=rho0
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            rhof=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhof)
-            self.mvir=self.get_mass(rvir)
-            self.deltavirrhou=self.mvir/(4*pi/3*rvir**3)
-        elif mvir!=0 and rs!=0 and rvir!=0:
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            self.mvir=mvir
-            m1=getmassfromnfw(1*mvir.unit/(rs.unit)**3,rs,rvir)
-            self.rho0=mvir/m1*(mvir.unit/rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-        elif deltavirrhou!=0 and rs!=0 and rvir!=0:
-            mvir=4.0*pi/3*deltavirrhou*rvir**3
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            m1=getmassfromnfw(1*mvir.unit/(rs.unit)**3,rs,rvir)
-            self.rho0=mvir/m1*mvir.unit/(rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rvir!=0 and mvir!=0:
-            self.rho0=rho0
-            self.rvir=rvir
-            self.mvir=mvir
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            m1=lambda rsa: getmassfromnfw(rho0,rsa,rvir)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            self.c=self.rvir/self.rs
-            rhofn=lambda r: self.rhofunc(r*rvir.unit,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rs!=0 and mvir!=0:
-            self.rho0=rho0
-            self.mvir=mvir
-            self.rs=rs
-            m1=lambda rvira: getmassfromnfw(rho0,rs,rvira)
-            x=minimize_scalar(lambda y: abs(log10(m1(x)/mvir)))['x']
-            self.rvir=x*rs.unit
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rho0!=0 and rs!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.rs=rs
-            self.deltavirrhou=deltavirrhou
-            self.c=self.rvir/self.rs
-            m1=lambda rvira: getmassfromnfw(rho0,rs,rvira)
-            x=minimize_scalar(lambda y: abs(m1(y)/(4*pi/3*y**3)-deltavirrhou))['x']
-            self.rvir=x*rs.unit
-            self.mvir=4*pi/3*(x*rs.unit)**3*deltavirrhou
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-        elif rho0!=0 and rvir!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.rvir=rvir
-            self.deltavirrhou=deltavirrhou
-            mvir=4*pi/3*rvir**3
-            self.mvir=mvir
-            m1=lambda rsa: getmassfromnfw(rho0,rsa,rvir)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-            
-        elif rho0!=0 and mvir!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.rvir=rvir
-            self.c=self.rvir/self.rs
-            m1=lambda rsa: getmassfromnfw(rho0,rsa,rvir)
-            x=minimize_scalar(lambda y: abs(log10(m1(y)/mvir)))['x']
-            self.rs=x*rvir.unit
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-            
-        elif rs!=0 and mvir!=0 and deltavirrhou!=0:
-            self.rs=rs
-            self.mvir=mvir
-            rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.deltavirrhou=deltavirrhou
-            self.rvir=rvir
-            self.c=self.rvir/self.rs
-            m1=getmassfromnfw(1*mvir.unit/(rs.unit**3),rs,rvir)
-            self.rho0=mvir/m1*(mvir.unit/(rs.unit**3))
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif c!=0 and mvir!=0 and deltavirrhou!=0:
-            self.c=c
-            self.mvir=mvir
-            self.deltavirrhou=deltavirrhou
-            self.rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.rs=self.rvir/copy.copy(c)
-            m1=getmassfromnfw(1*self.mvir.unit/(self.rs.unit**3),self.rs,self.rvir)
-            self.rho0=mvir/m1*self.mvir.unit/(self.rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-            
-        elif vmax!=0 and rmax!=0 and mvir!=0:
-            self.mvir=mvir
-            self.rs=rmax/2.163
-            mwithinrmax=vmax**2*rmax/GN
-            m2=getmassfromnfw(1*mvir.unit/(rmax.unit**3),self.rs,rmax)
-            self.rho0=mwithinrmax/m2*(mvir.unit/rmax.unit**3)
-            m1=lambda rvira: getmassfromnfw(rho0,rs,rvira)
-            x=minimize_scalar(lambda y: abs(log10(m1(x)/mvir)))['x']
-            self.rvir=x*rmax.unit
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-        
-        elif vmax!=0 and rmax!=0 and rvir!=0:
-            self.rvir=rvir
-            self.rs=rmax/2.163
-            mwithinrmax=vmax**2*rmax/GN
-            m2=getmassfromnfw(1*self.munit/(rmax.unit**3),self.rs,rmax)
-            self.rho0=mwithinrmax/m2*(self.munit/rmax.unit**3)
-            self.mvir=getmassfromnfw(self.rho0,self.rs,self.rvir)
-            self.c=self.rvir/self.rs
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-            
+        t=instrument.tic()
+        given=_haloparams(rho0=rho0,rs=rs,rvir=rvir,mvir=mvir,deltavirrhou=deltavirrhou,c=c,vmax=vmax,rmax=rmax)
+        branch=profilesolve.findbranch(given)
+        if branch is not None:
+            self._solvehalo(given,branch)
+            branch='+'.join(branch)
         elif vatr!=0 and rforv!=0 and mvir!=0:
+            branch='vatr+rforv+mvir'
             self.mvir=mvir
-            rhof1=lambda r,haloparams: self.rhofunc(r*rforv.unit,self.alpha,self.beta,self.gamma,haloparams[0]*(mvir.unit/(rforv.unit**3)),haloparams[1]*rforv.unit,haloparams[2]*rforv.unit,rdecrvir=rdecrvir)
-            m1=lambda haloparams: getmassfromprofile(rhof1,rforv,haloparams)
-            m2=lambda haloparams: getmassfromprofile(rhof1,haloparams[2],haloparams)
+            m1=lambda haloparams: getmassfromnfw(haloparams[0],haloparams[1],rforv)
+            m2=lambda haloparams: getmassfromnfw(haloparams[0],haloparams[1],haloparams[2])
 
-            x=minimize(lambda params: abs((GN*m1([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[(20*mvir/(4*pi/3*rforv**3)).value,rforv.value,5*rforv.value],constraints={'type':'eq','fun': lambda params: log10(m2([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/mvir)})
+            x=instrument.minimize(lambda params: abs((GN*m1([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[(20*mvir/(4*pi/3*rforv**3)).value,rforv.value,5*rforv.value],constraints={'type':'eq','fun': lambda params: log10(m2([params[0]*mvir.unit/(rforv.unit**3),params[1]*rforv.unit,params[2]*rforv.unit])/mvir)})
 
             xwithunit=[x['x'][0]*mvir.unit/(rforv.unit**3),x['x'][1]*rforv.unit,x['x'][2]*rforv.unit]
             self.rho0=xwithunit[0]
             self.rs=xwithunit[1]
             self.rvir=xwithunit[2]
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.alpha,self.beta,self.gamma,self.rho0,self.rs,self.rvir,rdecrvir=rdecrvir)
-            RhoProfile.__init__(self,rhofn)
 
         elif vatr!=0 and rforv!=0 and rvir!=0:
+            branch='vatr+rforv+rvir'
             self.rvir=rvir
-            rhof1=lambda r,haloparams: self.rhofunc(r,haloparams[0],haloparams[1],rvir)
-            m1=lambda haloparams: getmassfromprofile(rhof1,rforv,haloparams)
-            m2=lambda haloparams: getmassfromprofile(rhof1,rvir,haloparams)
+            m1=lambda haloparams: getmassfromnfw(haloparams[0],haloparams[1],rforv)
 
-            x=minimize(lambda params: abs((GN*m1([params[0]*units.M_sun/(rforv.unit**3),params[1]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[4000,rforv.value])
+            x=instrument.minimize(lambda params: abs((GN*m1([params[0]*units.M_sun/(rforv.unit**3),params[1]*rforv.unit])/rforv).to(vatr.unit**2)-vatr**2).value,[4000,rforv.value])
 
             xwithunit=[x['x'][0]*units.M_sun/(rforv.unit**3),x['x'][1]*rforv.unit]
             self.rho0=xwithunit[0]
             self.rs=xwithunit[1]
-            self.mvir=getmassfromprofile(rhof1,rvir,xwithunit)
-            self.deltavirrhou=self.mvir/(4*pi/3*self.rvir**3)
-            rhofn=lambda r: self.rhofunc(r,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+        else:
+            raise ValueError('unsupported combination of halo parameters')
+        RhoProfile.__init__(self,None)
+        instrument.toc('branches',type(self).__name__+':'+branch,t)
 
     def rhofunc(self,r,rho0=nan,rs=nan,rvir=nan):
 
@@ -1002,185 +851,94 @@ class NFW(RhoProfile):
         if ~isfinite(rvir):
             rvir=self.rvir
 
-        return rho0/((r/rs)*(1+r/rs)**2)
+        return profilekernels.nfwrho(_tofloat(r,RUNIT),_tofloat(rho0,RHOUNIT),_tofloat(rs,RUNIT))*RHOUNIT
 
     def nfwfx(self,x):
-        return log(1+x)-x/(1+x)
-    
-    def get_mass(self,r,rho0=nan,rs=nan):
-
-        if ~isfinite(rho0):
-            rho0=self.rho0
-        if ~isfinite(rs):
-            rs=self.rs
-
-        return 4*pi*rs**3*rho0*self.nfwfx(r/rs)
-
-    def get_phi(self,r,rho0=nan,rs=nan):
-
-        if ~isfinite(rho0):
-            rho0=self.rho0
-        if ~isfinite(rs):
-            rs=self.rs
-
-        return -4*GN*pi*rho0*rs**3/r*log(1+r/rs)
+        return profilekernels.nfwfx(x)
 
-    def get_vcirc(self,r):
+    def _solveshape(self):
+        return profilesolve.NFWShape()
 
-        x=r/self.rs
-        return (sqrt(GN*self.mvir/self.rvir*self.c/x*self.nfwfx(x)/self.nfwfx(self.c))).to(self.vunit)
-
-    def get_vmax(self):
-        return self.get_vcirc(2.16258*self.rs)
-
-    def get_rmax(self):
-        return 2.16258*self.rs
-
-    def get_projected(self,r):
-        
-        x=(r/self.rs).decompose().value
-        front=2*self.rho0*self.rs/(x**2-1)
-        
-        if x>1:
-            return front*(1-2.0/(np.sqrt(x**2-1))*np.arctan(np.sqrt((x-1)/(x+1))))
-        elif x<1:
-            return front*(1-2.0/(np.sqrt(1-x**2))*np.arctanh(np.sqrt((1-x)/(x+1))))
-        else:
-            return front*1.0/3
-
-class Einasto(RhoProfile):
+    def _rho(self,r):
+        return profilekernels.nfwrho(r,self._rho0,self._rs)
 
-    rs=0
-    rho0=0
-    rvir=0
-    mvir=0
-    deltavirrhou=0
-    c=0
-    alpha=0
-    rhounit=0
-    runit=0
-    munit=0
+    def _mass(self,r):
+        return profilekernels.nfwmass(r,self._rho0,self._rs)
 
-    def __init__(self,alpha,rho0=0,c=0,rs=0,deltavirrhou=0,mvir=0,rvir=0):
+    def _phi(self,r):
+        return profilekernels.nfwphi(r,self._rho0,self._rs)
 
-        self.alpha=alpha
-        self.rhounit=units.M_sun/units.kpc**3
-        self.runit=units.kpc
-        self.munit=units.M_sun
-
-        if c!=0 and rvir!=0:
-            rs=rvir/c
-        
-        if c!=0 and rs!=0:
-            rvir=c*rs
-
-
-        if rs!=0 and mvir!=0 and deltavirrhou!=0:
-            self.rs=rs
-            self.mvir=mvir
-            rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
-            self.deltavirrhou=deltavirrhou
-            self.rvir=rvir
-            self.c=self.rvir/self.rs
-            m1=getmasseinasto(1*mvir.unit/(rs.unit**3),rs,rvirs,self.alpha)
-            self.rho0=mvir/m1*(mvir.unit/(rs.unit**3))
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif mvir!=0 and rs!=0 and rvir!=0:
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            self.mvir=mvir
-            m1=getmasseinasto(1*mvir.unit/(rs.unit)**3,rs,rvir,self.alpha)
-            self.rho0=mvir/m1*(mvir.unit/rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rho0!=0 and rs!=0 and rvir!=0:
-            self.rs=rs
-            self.rvir=rvir
-            self.c=rvir/rs
-            self.rho0=rho0
-            mvir=getmasseinasto(rho0,rs,rvir,self.alpha)
-            self.mvir=mvir
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
-
-        elif rs!=0 and rho0!=0 and deltavirrhou!=0:
-            self.rho0=rho0
-            self.rs=rs
-            self.deltavirrhou=deltavirrhou
-            self.c=self.rvir/self.rs
-            m1=lambda rvira: getmasseinasto(rho0,rs,rvira*rs.unit,self.alpha)
-            x=minimize_scalar(lambda y: abs(m1(y)/(4*pi/3*(y*rs.unit)**3)-deltavirrhou))['x']
-            self.rvir=x*rs.unit
-            self.mvir=4*pi/3*(x*rs.unit)**3*deltavirrhou
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+    def _rmax(self):
+        return getxmaxzhao0(1,3,1)*self._rs
+    
+    def get_mass(self,r,rho0=nan,rs=nan,units=True):
 
+        rho0=self._rho0 if ~isfinite(rho0) else _tofloat(rho0,RHOUNIT)
+        rs=self._rs if ~isfinite(rs) else _tofloat(rs,RUNIT)
 
-            
-    def rhofunc(self,r,alpha=nan,rho0=nan,rs=nan,rvir=nan):
+        m=profilekernels.nfwmass(_tofloat(r,RUNIT),rho0,rs)
+        return _withunit(m,MUNIT,self.munit) if units else m
 
-        if ~isfinite(alpha):
-            alpha=self.alpha
-        if ~isfinite(rho0):
-            rho0=self.rho0
-        if ~isfinite(rs):
-            rs=self.rs
-        if ~isfinite(rvir):
-            rvir=self.rvir
+    def get_phi(self,r,rho0=nan,rs=nan,units=True):
 
-        h=rs/getdneinasto(alpha)
-        return rho0*exp(-(r/h)**(1.0/alpha))
+        rho0=self._rho0 if ~isfinite(rho0) else _tofloat(rho0,RHOUNIT)
+        rs=self._rs if ~isfinite(rs) else _tofloat(rs,RUNIT)
 
+        phi=profilekernels.nfwphi(_tofloat(r,RUNIT),rho0,rs)
+        return phi*PHIUNIT if units else phi
 
-    def get_mass(self,r):
-        return getmasseinasto(self.rho0,self.rs,r,self.alpha)
+    def _projected(self,r,maxr=None):
+        if maxr is None:
+            return profilekernels.nfwsigma(r,self._rho0,self._rs)
+        return RhoProfile._projected(self,r,maxr)
 
 class Plummer(RhoProfile):
 
-    m=0
-    a=0
+    m=_Param('m',MUNIT)
+    a=_Param('a',RUNIT)
+    _m=0
+    _a=0
+    _recordparams=('m','a')
 
-    def __init__(self,m,a):
+    def __init__(self,m,a,rhounit=units.M_sun/(units.pc)**3,munit=units.M_sun,vunit=units.km/units.s,runit=units.kpc):
 
         self.a=a
         self.m=m
+        self.rhounit=rhounit
+        self.munit=munit
+        self.vunit=vunit
+        self.runit=runit
 
-    def get_rho(self,r):
-
-        first=3*self.m/4/np.pi/self.a**3
-        second=(1+(r/self.a)**2)**(-5.0/2)
-
-        return first*second
+    def _rho(self,r):
+        return profilekernels.plummerrho(r,self._m,self._a)
 
-    def get_potential(self,r):
-        return -GN*self.m/(np.sqrt(r**2+a**2))
+    def _mass(self,r):
+        return profilekernels.plummermass(r,self._m,self._a)
 
-    def get_mass(self,r):
+    def _phi(self,r):
+        return profilekernels.plummerphi(r,self._m,self._a)
 
-        return self.m*(r**3/(r**2+self.a**2)**1.5)
+    def get_potential(self,r,units=True):
+        return self.get_phi(r,units=units)
 
-    def get_projected(self,r):
-        
-        left=2*3*self.m/4/np.pi/self.a**3
-        top=2*self.a**5
-        bottom=3.0*(self.a**2+r**2)**2
-        return left*top/bottom
+    def _projected(self,r,maxr=None):
+        if maxr is None:
+            return profilekernels.plummersigma(r,self._m,self._a)
+        return RhoProfile._projected(self,r,maxr)
 
 class Einasto(RhoProfile):
 
-    rs=0
-    rho0=0
-    rvir=0
-    mvir=0
-    deltavirrhou=0
-    c=0
+    rs=_Param('rs',RUNIT)
+    rho0=_Param('rho0',RHOUNIT)
+    rvir=_Param('rvir',RUNIT)
+    mvir=_Param('mvir',MUNIT)
+    deltavirrhou=_Param('deltavirrhou',RHOUNIT)
+    c=_Param('c')
+    _rs=0
+    _rho0=0
     alpha=0
+    _recordshape=('alpha',)
+    _recordparams=('rho0','rs','rvir','mvir','deltavirrhou','c')
     rhounit=0
     runit=0
     munit=0
@@ -1205,45 +963,33 @@ class Einasto(RhoProfile):
             rvir=(mvir/(4*pi/3*deltavirrhou))**(1.0/3)
             self.deltavirrhou=deltavirrhou
             self.rvir=rvir
-            self.c=self.rvir/self.rs
-            m1=getmasseinasto(1*mvir.unit/(rs.unit**3),rs,rvirs,self.alpha)
+            m1=getmasseinasto(1*mvir.unit/(rs.unit**3),rs,rvir,self.alpha)
             self.rho0=mvir/m1*(mvir.unit/(rs.unit**3))
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+            RhoProfile.__init__(self,None)
 
         elif mvir!=0 and rs!=0 and rvir!=0:
             self.rs=rs
             self.rvir=rvir
-            self.c=rvir/rs
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
             self.mvir=mvir
             m1=getmasseinasto(1*mvir.unit/(rs.unit)**3,rs,rvir,self.alpha)
             self.rho0=mvir/m1*(mvir.unit/rs.unit**3)
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+            RhoProfile.__init__(self,None)
 
         elif rho0!=0 and rs!=0 and rvir!=0:
             self.rs=rs
             self.rvir=rvir
-            self.c=rvir/rs
             self.rho0=rho0
-            mvir=getmasseinasto(rho0,rs,rvir,self.alpha)
-            self.mvir=mvir
-            self.deltavirrhou=mvir/(4*pi/3*rvir**3)
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+            RhoProfile.__init__(self,None)
 
         elif rs!=0 and rho0!=0 and deltavirrhou!=0:
             self.rho0=rho0
             self.rs=rs
             self.deltavirrhou=deltavirrhou
-            self.c=self.rvir/self.rs
             m1=lambda rvira: getmasseinasto(rho0,rs,rvira*rs.unit,self.alpha)
-            x=minimize_scalar(lambda y: abs(m1(y)/(4*pi/3*(y*rs.unit)**3)-deltavirrhou))['x']
+            x=instrument.minimize_scalar(lambda y: abs(m1(y)/(4*pi/3*(y*rs.unit)**3)-deltavirrhou))['x']
             self.rvir=x*rs.unit
             self.mvir=4*pi/3*(x*rs.unit)**3*deltavirrhou
-            rhofn=lambda r: self.rhofunc(r,alpha,self.rho0,self.rs,self.rvir)
-            RhoProfile.__init__(self,rhofn)
+            RhoProfile.__init__(self,None)
 
 
 
@@ -1258,11 +1004,151 @@ class Einasto(RhoProfile):
         if ~isfinite(rvir):
             rvir=self.rvir
 
-        h=rs/getdneinasto(alpha)
-        return rho0*exp(-(r/h)**(1.0/alpha))
-
-
-    def get_mass(self,r):
-        return getmasseinasto(self.rho0,self.rs,r,self.alpha)
-
-
+        return profilekernels.einastorho(_tofloat(r,RUNIT),_tofloat(rho0,RHOUNIT),_tofloat(rs,RUNIT),alpha)*RHOUNIT
+
+    def _rho(self,r):
+        return profilekernels.einastorho(r,self._rho0,self._rs,self.alpha)
+
+    def _mass(self,r):
+        return profilekernels.einastomass(r,self._rho0,self._rs,self.alpha)
+
+
+_PROFILECLASSES={'NFW':NFW,'Zhao':Zhao,'Einasto':Einasto,'Plummer':Plummer}
+
+def profilefromrecord(rec):
+    """
+    Rebuild a profile from RhoProfile.get_record without re-running the
+    constructor solve.
+    """
+    cls=_PROFILECLASSES[rec['kind']]
+    prof=cls.__new__(cls)
+    for k in cls._recordshape:
+        setattr(prof,k,_shapeparam(rec[k]))
+    for k in cls._recordparams:
+        prof.__dict__['_'+k]=float(rec[k])
+    for k,default in _DEFAULTUNITS:
+        setattr(prof,k,units.Unit(rec[k]) if k in rec else default)
+    prof.nargs=1
+    return prof
+
+def profiletable(profiles):
+    """
+    A list of profiles, e.g. a halo history, as a numpy structured array
+    with one row of float64 record values per profile (nan where a kind has
+    no such value). Output units fall back to the defaults.
+    """
+    recs=[p.get_record() for p in profiles]
+    kinds=sorted(set(r['kind'] for r in recs))
+    names=[]
+    for kind in kinds:
+        cls=_PROFILECLASSES[kind]
+        names+=[k for k in cls._recordshape+cls._recordparams if k not in names]
+    arr=np.zeros(len(recs),dtype=[('kind','S8')]+[(k,'f8') for k in names])
+    for i,r in enumerate(recs):
+        arr[i]=tuple([r['kind']]+[r.get(k,nan) for k in names])
+    return arr
+
+def profilesfromtable(arr):
+    """
+    The list of profiles in a profiletable array.
+    """
+    names=arr.dtype.names[1:]
+    profiles=[]
+    for row in arr:
+        rec=dict((k,row[k]) for k in names)
+        rec['kind']=row['kind'].decode() if isinstance(row['kind'],bytes) else row['kind']
+        profiles.append(profilefromrecord(rec))
+    return profiles
+
+def packprofiles(profiles):
+    """
+    Compact binary form of a list of profiles: their profiletable written
+    with np.save.
+    """
+    buf=io.BytesIO()
+    np.save(buf,profiletable(profiles))
+    return buf.getvalue()
+
+def unpackprofiles(data):
+    """
+    The list of profiles stored by packprofiles.
+    """
+    return profilesfromtable(np.load(io.BytesIO(data)))
+
+#size of the makeprofile memo; the least recently used profile goes first
+PROFILECACHESIZE=256
+_profilememo=OrderedDict()
+_profilestats={'hits':0,'misses':0,'evictions':0}
+_unitkeys={}
+
+def _memokey(x):
+    #a hashable, unit-normalized stand-in for one constructor argument
+    if isinstance(x,units.Quantity):
+        #a zero is 0 in any unit, so it is "not given" like a plain 0
+        if float(x.value)==0:
+            return 0.0
+        try:
+            scale,name=_unitkeys[x.unit]
+        except KeyError:
+            si=x.unit.si
+            scale,name=_unitkeys[x.unit]=(si.scale,units.CompositeUnit(1,si.bases,si.powers).to_string())
+        return (float(x.value)*scale,name)
+    if isinstance(x,units.UnitBase):
+        return ('unit',x.to_string())
+    if isinstance(x,(int,float,np.number)):
+        return float(x)
+    return x
+
+def makeprofile(cls,*args,**kwargs):
+    """
+    Memoized profile constructor: makeprofile(NFW,mvir=m,c=c,deltavirrhou=d)
+    builds NFW(mvir=m,...) once and afterwards returns the same object for
+    the same parameters, whatever units they were given in. cls is a
+    profile class or its name ('NFW','Zhao','Einasto','Plummer').
+    Parameters left at 0 count as not given. The memo holds the
+    PROFILECACHESIZE most recently used profiles of this process.
+
+    The returned profile is shared between callers, which also share its
+    potential and distribution function tables; do not modify it.
+    """
+    cls=_PROFILECLASSES.get(cls,cls)
+    params=((k,_memokey(v)) for k,v in kwargs.items())
+    key=(cls,tuple(_memokey(a) for a in args),tuple(sorted(kv for kv in params if kv[1]!=0.0)))
+    try:
+        prof=_profilememo.pop(key)
+    except KeyError:
+        _profilestats['misses']+=1
+        prof=cls(*args,**kwargs)
+        while _profilememo and len(_profilememo)>=PROFILECACHESIZE:
+            _profilememo.popitem(last=False)
+            _profilestats['evictions']+=1
+    else:
+        _profilestats['hits']+=1
+    _profilememo[key]=prof
+    return prof
+
+def profilecachestats(reset=False):
+    """
+    Hits, misses and evictions of makeprofile so far, with the current
+    and maximum number of memoized profiles. reset=True zeros the counts.
+    """
+    stats=dict(_profilestats,size=len(_profilememo),maxsize=PROFILECACHESIZE)
+    if reset:
+        for k in _profilestats:
+            _profilestats[k]=0
+    return stats
+
+def invalidateprofiles(cls=None):
+    """
+    Drop the memoized profiles of class cls (a class or its name), or all of
+    them when cls is None. Returns the number dropped.
+    """
+    if cls is None:
+        n=len(_profilememo)
+        _profilememo.clear()
+        return n
+    cls=_PROFILECLASSES.get(cls,cls)
+    keys=[k for k in _profilememo if k[0] is cls]
+    for k in keys:
+        del _profilememo[k]
+    return len(keys)
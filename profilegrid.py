@@ -0,0 +1,391 @@
+"""
+profilegrid.py
+
+Tables of a spherical density profile on a log radius grid, built once from
+cumulative Gauss-Legendre integrals of the density and then interpolated for
+any number of radii: the enclosed mass, potential and surface density
+(ProfileGrid), the Jeans velocity dispersion of a tracer (JeansTable) and
+its isotropic distribution function and density of states (EddingtonTable).
+abel and rasterize evaluate projected densities directly and as images. Units are those of profilekernels: kpc, M_sun,
+M_sun/kpc^3, km/s and (km/s)^2.
+"""
+import numpy as np
+from numpy import pi
+import profilekernels
+
+def _gaussnodes(lnr, ngauss):
+    # Gauss-Legendre nodes and weights (in ln r) of every grid interval.
+    xg, wg = np.polynomial.legendre.leggauss(ngauss)
+    half = (lnr[1:] - lnr[:-1])/2.0
+    u = (lnr[1:] + lnr[:-1])[:, None]/2.0 + half[:, None]*xg[None, :]
+    return u, half[:, None]*wg[None, :]
+
+def _tail(func, rmax, p, taildex, ngauss):
+    # int_rmax^inf func(r)*r^p dlnr: a coarse grid over taildex more decades,
+    # then a power law with the local slope there.
+    lnr = np.linspace(np.log(rmax), np.log(rmax) + taildex*np.log(10), 4*taildex + 1)
+    u, w = _gaussnodes(lnr, ngauss)
+    tail = (np.asarray(func(np.exp(u).ravel()), dtype=float).reshape(u.shape)*np.exp(p*u)*w).sum()
+    f = np.asarray(func(np.exp(lnr[-2:])), dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = -(np.log(f[1]) - np.log(f[0]))/(lnr[1] - lnr[0])
+    if np.isfinite(slope) and slope > p:
+        tail += f[1]*np.exp(p*lnr[-1])/(slope - p)
+    return tail
+
+def _lnderivs(func, r, step=1e-2):
+    # ln func and its first two derivatives in ln r, by five-point central
+    # differences.
+    f = [np.log(np.asarray(func(r*np.exp(k*step)), dtype=float)) for k in (-2, -1, 0, 1, 2)]
+    d1 = (f[0] - 8*f[1] + 8*f[3] - f[4])/(12*step)
+    d2 = (-f[0] + 16*f[1] - 30*f[2] + 16*f[3] - f[4])/(12*step**2)
+    return f[2], d1, d2
+
+def _rule(npanel, ngauss):
+    # composite Gauss-Legendre nodes and weights on [0, 1].
+    t, w = _gaussnodes(np.linspace(0, 1, npanel + 1), ngauss)
+    return t.ravel(), w.ravel()
+
+def abel(rhofunc, R, rmax, breaks=(), ngauss=16, npanel=8):
+    """
+    Surface density Sigma(R) = 2*int_0^zmax rho(sqrt(R^2+z^2)) dz of a
+    spherical density cut at the 3D radius rmax, for an array of projected
+    radii R > 0 in one pass. With z = R*sinh(u) the integrand is smooth in
+    u, and every R uses the same composite Gauss-Legendre rule of npanel
+    panels of ngauss points on [0, arccosh(rmax/R)], split again at every
+    kink of the density. Sigma is 0 for R >= rmax.
+
+    Arguments:
+      rhofunc: density as a function of an array of radii; it is called
+        with R[..., None]*cosh(u), one trailing axis of nodes.
+      R: projected radii.
+      rmax: outer radius of the density.
+
+    Optional Keyword Arguments:
+      breaks: radii where the density has a kink (default none).
+      ngauss: Gauss-Legendre points per panel (default 16).
+      npanel: panels per segment between kinks (default 8).
+    """
+    R = np.asarray(R, dtype=float)
+    xg, wg = np.polynomial.legendre.leggauss(ngauss)
+    t = ((np.arange(npanel)[:, None] + 0.5*(xg[None, :] + 1))/npanel).ravel()
+    wt = np.tile(wg, npanel)/(2.0*npanel)
+    top = np.maximum(rmax/R, 1.0)
+    edges = [np.zeros(R.shape)] + [np.arccosh(np.clip(b/R, 1.0, top)) for b in sorted(breaks)] + [np.arccosh(top)]
+    lo = np.stack(edges[:-1], axis=-1)[..., None]
+    du = np.stack(edges[1:], axis=-1)[..., None] - lo
+    cu = np.cosh(lo + du*t).reshape(R.shape + (-1,))
+    w = (du*wt).reshape(R.shape + (-1,))
+    rho = np.asarray(rhofunc(R[..., None]*cu), dtype=float)
+    return 2*np.sum(rho*R[..., None]*cu*w, axis=-1)
+
+def rasterize(sigma, npix, width, centers=((0.0, 0.0),), oversample=1):
+    """
+    Surface density image of profiles centred at centers: the mean of
+    sigma(R) over the subpixels of every pixel, summed over the profiles.
+
+    Arguments:
+      sigma: Sigma(R) for an array of projected radii. With several
+        centers it is called with R of shape (N, M), one row per profile,
+        as taken by profilepop get_projected with units=False; with one
+        centre R has shape (M,).
+      npix: pixels per side.
+      width: side of the image, in the units of R.
+
+    Optional Keyword Arguments:
+      centers: (N, 2) positions of the profiles on the image (default one
+        profile at the centre).
+      oversample: subpixels per pixel side (default 1).
+
+    Returns an (npix, npix) array, first axis y.
+    """
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+    n = npix*oversample
+    x = (np.arange(n) + 0.5)*width/n - width/2.0
+    R = np.hypot(x[None, None, :] - centers[:, 0, None, None],
+        x[None, :, None] - centers[:, 1, None, None]).reshape(len(centers), -1)
+    s = np.asarray(sigma(R if len(centers) > 1 else R[0]), dtype=float)
+    s = s.reshape(len(centers), n, n).sum(axis=0)
+    return s.reshape(npix, oversample, npix, oversample).mean(axis=(1, 3))
+
+class ProfileGrid(object):
+    """
+    Enclosed mass and potential of a density profile tabulated at the nodes
+    of a log radius grid between rmin and rmax.
+
+    M(<r) = m0 + 4*pi*int_rmin^r rho r'^2 dr'
+    Phi(r) = -G*(M(<r)/r + 4*pi*int_r^inf rho r' dr')
+
+    Both integrals are one cumulative sum of a fixed Gauss-Legendre rule per
+    interval. The outer integral carries on over taildex decades beyond rmax
+    on a coarse grid and then as a power law with the local slope, so Phi
+    goes to 0 at infinity whenever the profile falls faster than r^-2
+    (otherwise the zero point is at rmax*10^taildex).
+    Queries interpolate with cubic Hermite splines in ln r, using the exact
+    derivatives dM/dlnr = 4*pi*r^3*rho and dPhi/dlnr = G*M/r.
+
+    Arguments:
+      rhofunc: density as a function of an array of radii.
+      rmin, rmax: ends of the grid.
+
+    Optional Keyword Arguments:
+      m0: mass within rmin (default from continuing the density inwards
+        as a power law with its local slope at rmin).
+      breaks: radii where the density has a kink, added as grid nodes
+        (default none).
+      nperdex: grid intervals per decade (default 32).
+      ngauss: Gauss-Legendre points per interval (default 8).
+      taildex: decades integrated beyond rmax (default 4).
+    """
+
+    def __init__(self, rhofunc, rmin, rmax, m0=None, breaks=(), nperdex=32, ngauss=8, taildex=4):
+        n = max(int(np.ceil(nperdex*np.log10(1.0*rmax/rmin))), 1) + 1
+        lnr = np.linspace(np.log(rmin), np.log(rmax), n)
+        breaks = [np.log(b) for b in breaks if rmin < b < rmax]
+        self.breaks = np.exp(breaks)
+        self.lnr = lnr = np.unique(np.concatenate([lnr, breaks]))
+        self.r = r = np.exp(lnr)
+        self.rho = rho = np.asarray(rhofunc(r), dtype=float)
+        u, w = _gaussnodes(lnr, ngauss)
+        rhou = np.asarray(rhofunc(np.exp(u).ravel()), dtype=float).reshape(u.shape)
+        if m0 is None:
+            # power-law continuation of the density inside rmin.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = -(np.log(rho[1]) - np.log(rho[0]))/(lnr[1] - lnr[0])
+            m0 = 4*pi*rho[0]*r[0]**3/(3 - slope) if slope < 3 else 0.0
+        # mass: int rho r^3 dlnr from rmin; outer: int rho r^2 dlnr to rmax.
+        self.mass = m0 + 4*pi*np.concatenate([[0], np.cumsum((rhou*np.exp(3*u)*w).sum(axis=1))])
+        seg = (rhou*np.exp(2*u)*w).sum(axis=1)
+        outer = np.concatenate([np.cumsum(seg[::-1])[::-1], [0]])
+        self.outer = outer + _tail(rhofunc, rmax, 2, taildex, ngauss)
+        self.phi = -profilekernels.G*(self.mass/r + 4*pi*self.outer)
+        self.rhofunc = rhofunc
+        self.ngauss = ngauss
+        self.taildex = taildex
+        self._lnsigma = None
+
+    def _outermass(self, r):
+        # M(<r) beyond rmax, continuing the density as a power law with its
+        # local slope at rmax.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = -(np.log(self.rho[-1]) - np.log(self.rho[-2]))/(self.lnr[-1] - self.lnr[-2])
+            x = np.log(r/self.r[-1])
+            dm = x if abs(s - 3) < 1e-8 else np.expm1((3 - s)*x)/(3 - s)
+            dm = np.where(np.isfinite(dm), 4*pi*self.rho[-1]*self.r[-1]**3*dm, 0.0)
+        return self.mass[-1] + dm
+
+    def get_mass(self, r):
+        """
+        M(<r); the density continues as a power law beyond rmax and
+        M = m0*(r/rmin)^3 inside rmin.
+        """
+        r = np.asarray(r, dtype=float)
+        m = profilekernels.hermite(self.lnr, self.mass, 4*pi*self.r**3*self.rho, np.log(r))
+        m = np.where(r > self.r[-1], self._outermass(np.maximum(r, self.r[-1])), m)
+        return np.where(r < self.r[0], self.mass[0]*(r/self.r[0])**3, m)
+
+    def get_projected(self, R):
+        """
+        Sigma(R) of the density out to rmax*10^taildex. Inside the grid it
+        interpolates a cubic spline of ln Sigma through abel at the grid
+        nodes, built on first use; outside it calls abel directly.
+        """
+        R = np.asarray(R, dtype=float)
+        rout = self.r[-1]*10**self.taildex
+        if self._lnsigma is None:
+            from scipy.interpolate import CubicSpline
+            sigma = abel(self.rhofunc, self.r, rout, self.breaks)
+            self._lnsigma = CubicSpline(self.lnr, np.log(np.maximum(sigma, 1e-300)))
+        inside = (R >= self.r[0]) & (R <= self.r[-1])
+        sigma = np.exp(self._lnsigma(np.log(np.clip(R, self.r[0], self.r[-1]))))
+        if np.all(inside):
+            return sigma
+        return np.where(inside, sigma, abel(self.rhofunc, np.where(inside, self.r[0], R), rout, self.breaks))
+
+    def get_phi(self, r):
+        """
+        Phi(r); Keplerian beyond rmax and the rmin value inside rmin.
+        """
+        r = np.asarray(r, dtype=float)
+        with np.errstate(divide='ignore'):
+            phi = profilekernels.hermite(self.lnr, self.phi, profilekernels.G*self.mass/self.r, np.log(r))
+            return np.where(r > self.r[-1], self.phi[-1]*self.r[-1]/r, phi)
+
+class JeansTable(object):
+    """
+    Radial velocity dispersion of a tracer with density nu and constant
+    anisotropy beta = 1 - sigma_t^2/sigma_r^2 in the mass of a ProfileGrid,
+    from the spherical Jeans equation
+
+    nu*sigma_r^2*r^(2*beta) = P(r) = G*int_r^inf nu*M*r'^(2*beta-2) dr',
+
+    tabulated at the grid nodes with one backward cumulative sum of the
+    grid's Gauss-Legendre rule, using M(<r) from the grid table. Beyond
+    rmax the integral carries on as in ProfileGrid. Queries interpolate
+    ln P with cubic Hermite splines, using the exact derivative
+    dlnP/dlnr = -G*nu*M*r^(2*beta-1)/P.
+
+    Arguments:
+      grid: ProfileGrid of the mass generating the potential.
+
+    Optional Keyword Arguments:
+      nufunc: tracer density as a function of an array of radii, with any
+        normalization (default the density of the grid itself).
+      beta: constant velocity anisotropy (default 0, isotropic).
+    """
+
+    def __init__(self, grid, nufunc=None, beta=0.0):
+        nufunc = grid.rhofunc if nufunc is None else nufunc
+        self.nufunc = nufunc
+        self.beta = beta = float(beta)
+        self.lnr = lnr = grid.lnr
+        self.r = r = grid.r
+        p = 2*beta - 1
+        u, w = _gaussnodes(lnr, grid.ngauss)
+        ru = np.exp(u)
+        nuu = np.asarray(nufunc(ru.ravel()), dtype=float).reshape(u.shape)
+        seg = (nuu*grid.get_mass(ru)*np.exp(p*u)*w).sum(axis=1)
+        tail = _tail(lambda x: nufunc(x)*grid.get_mass(x), r[-1], p, grid.taildex, grid.ngauss)
+        P = profilekernels.G*(np.concatenate([np.cumsum(seg[::-1])[::-1], [0]]) + tail)
+        self.nu = nu = np.asarray(nufunc(r), dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.lnp = np.log(P)
+            self.dlnp = -profilekernels.G*nu*grid.mass*r**p/P
+
+    def get_sigma(self, r):
+        """
+        sigma_r(r); radii outside the grid are moved to its ends.
+        """
+        r = np.clip(np.asarray(r, dtype=float), self.r[0], self.r[-1])
+        lnp = profilekernels.hermite(self.lnr, self.lnp, self.dlnp, np.log(r))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.exp(lnp)/(np.asarray(self.nufunc(r), dtype=float)*r**(2*self.beta)))
+
+class EddingtonTable(object):
+    """
+    Isotropic distribution function of a tracer with density nu in the
+    potential of a ProfileGrid, from Eddington's formula
+
+    f(E) = 1/(sqrt(8)*pi^2) int_0^eps d^2nu/dPsi^2 dPsi/sqrt(eps-Psi),
+
+    and the density of states g(E) = 16*pi^2 int_0^r(eps) r^2
+    sqrt(2*(Psi-eps)) dr, where Psi = -Phi and eps = -E. Both are tabulated
+    at E = Phi of the grid nodes (attributes E, f and g, in order of
+    increasing binding energy eps) with fixed Gauss-Legendre rules for all
+    energies at once. Nodes where |dln nu/dln r| < amin, at the centre of a
+    core where d^2nu/dPsi^2 is lost to rounding, and nodes closer than
+    dymin in ln Psi to the previous one are left out of the tables.
+
+    nu(Psi) is a Hermite spline of ln nu in ln Psi through the grid nodes,
+    with dln nu/dln r and d^2ln nu/dln r^2 from central differences of
+    nufunc and the exact derivatives of Psi (dPsi/dlnr = -G*M/r). Below
+    the grid it continues as a power law, and the boundary term
+    dnu/dPsi/sqrt(eps) at Psi = 0 is dropped, which holds for nu falling
+    faster than Psi. Energies near Phi(rmin) lose the mass inside rmin in g.
+    f is good to ~1e-5 for NFW, Plummer and Dehnen profiles except within
+    about a decade in radius of the grid ends.
+
+    Queries interpolate ln f and ln g in ln eps with cubic splines and
+    continue them as power laws off the table. Unbound energies (E >= 0)
+    and energies below Phi(rmin) give 0, as do negative table values of f,
+    which mean no isotropic distribution function exists for nu there
+    (e.g. a cored tracer in a cusp).
+
+    Arguments:
+      grid: ProfileGrid of the mass generating the potential.
+
+    Optional Keyword Arguments:
+      nufunc: tracer density as a function of an array of radii (default
+        the density of the grid itself).
+      amin: smallest |dln nu/dln r| of a table node (default 1e-4).
+      dymin: smallest step in ln Psi between table nodes (default 1e-10).
+    """
+
+    def __init__(self, grid, nufunc=None, amin=1e-4, dymin=1e-10):
+        nufunc = grid.rhofunc if nufunc is None else nufunc
+        self.grid = grid
+        lnnu, a, b = _lnderivs(nufunc, grid.r)
+        keep = [len(grid.r) - 1]
+        for i in range(len(grid.r) - 2, -1, -1):
+            if abs(a[i]) >= amin and grid.phi[keep[-1]] - grid.phi[i] >= -dymin*grid.phi[keep[-1]]:
+                keep.append(i)
+        keep = np.array(keep[::-1])
+        r = grid.r[keep]
+        psi = -grid.phi[keep]
+        mass = grid.mass[keep]
+        lnnu, a, b = lnnu[keep], a[keep], b[keep]
+        # y = ln Psi and its derivatives in ln r.
+        yx = -profilekernels.G*mass/r/psi
+        yxx = -profilekernels.G*(4*pi*r**3*grid.rho[keep] - mass)/r/psi - yx**2
+        dlnnu = a/yx
+        q = dlnnu**2 - dlnnu + (b - dlnnu*yxx)/yx**2
+        from scipy.interpolate import CubicSpline
+        # tables in increasing y.
+        self.y = np.log(psi)[::-1]
+        self.lnnu = lnnu[::-1]
+        self.dlnnu = dlnnu[::-1]
+        self.lnr = grid.lnr[keep][::-1]
+        self.dlnr = 1.0/yx[::-1]
+        self._q = CubicSpline(self.y, q[::-1])
+        eps = psi[::-1]
+        self.E = -eps
+        self.f = self._eddington(eps)/(np.sqrt(8)*pi**2)
+        self.g = self._dos(eps)
+        with np.errstate(divide='ignore'):
+            self._lnf = CubicSpline(self.y, np.log(np.maximum(self.f, 1e-300)))
+            self._lng = CubicSpline(self.y, np.log(np.maximum(self.g, 1e-300)))
+
+    def _d2nu(self, y):
+        # d^2nu/dPsi^2 = nu*q/Psi^2 at ln Psi = y.
+        yc = np.clip(y, self.y[0], self.y[-1])
+        lnnu = profilekernels.hermite(self.y, self.lnnu, self.dlnnu, yc) + self.dlnnu[0]*np.minimum(y - self.y[0], 0)
+        return np.exp(lnnu - 2*y)*self._q(yc)
+
+    def _eddington(self, eps, npanel=32, ngauss=8):
+        # int_0^eps d^2nu/dPsi^2 dPsi/sqrt(eps-Psi): in ln Psi below eps/2,
+        # starting where the power law below the grid has fallen by 1e-10,
+        # and with Psi = eps - t^2 above, on panels in t shrinking towards
+        # t = 0 for the steep d^2nu/dPsi^2 just under the depth of a core.
+        t, w = _rule(npanel, ngauss)
+        ylo = self.y[0] - min(23.0/max(self.dlnnu[0] - 1, 1e-3), 30.0)
+        dy = (np.log(eps/2) - ylo)[:, None]
+        y = ylo + dy*t
+        psi = np.exp(y)
+        low = (self._d2nu(y)*psi/np.sqrt(eps[:, None] - psi)*dy*w).sum(axis=1)
+        t, w = _gaussnodes(np.concatenate([[0], np.logspace(-4, 0, 9)]), ngauss)
+        t, w = t.ravel(), w.ravel()
+        tmax = np.sqrt(eps/2)[:, None]
+        high = (2*self._d2nu(np.log(eps[:, None] - (tmax*t)**2))*tmax*w).sum(axis=1)
+        return low + high
+
+    def _dos(self, eps, npanel=8, ngauss=8):
+        # 16*pi^2 int r^3 sqrt(2*(Psi-eps)) dlnr from rmin to r(eps), with
+        # ln r = ln r(eps) - W*s^2 to take out the square root at r(eps).
+        s, w = _rule(npanel, ngauss)
+        xe = profilekernels.hermite(self.y, self.lnr, self.dlnr, np.log(eps))
+        W = (xe - self.grid.lnr[0])[:, None]
+        r = np.exp(xe[:, None] - W*s**2)
+        psi = -self.grid.get_phi(r)
+        kin = np.sqrt(2*np.maximum(psi - eps[:, None], 0))
+        return 16*pi**2*(r**3*kin*2*W*s*w).sum(axis=1)
+
+    def _interp(self, spline, E):
+        eps = -np.asarray(E, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            y = np.log(eps)
+            yc = np.clip(y, self.y[0], self.y[-1])
+            val = np.exp(spline(yc) + spline(yc, 1)*(y - yc))
+        bound = (eps > 0) & (eps <= -self.grid.phi[0])
+        return np.where(bound & (val > 1e-299), val, 0.0)
+
+    def get_f(self, E):
+        """
+        f(E) for an array of energies.
+        """
+        return self._interp(self._lnf, E)
+
+    def get_g(self, E):
+        """
+        g(E) for an array of energies.
+        """
+        return self._interp(self._lng, E)
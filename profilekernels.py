@@ -0,0 +1,409 @@
+"""
+profilekernels.py
+
+Unit-free kernels behind the profileclass density profiles. Every function
+takes and returns plain floats or numpy arrays in fixed units: kpc for radii,
+M_sun for masses, M_sun/kpc^3 for densities, km/s for velocities and
+(km/s)^2 for potentials. Conversion to and from astropy Quantities happens
+once, in the profileclass public methods.
+"""
+from collections import OrderedDict
+import numpy as np
+from numpy import pi
+from scipy.special import hyp2f1, gammainc
+from scipy.special import gamma as gammafunc
+from astropy import units
+from astropy.constants import G as _G
+
+# G in kpc (km/s)^2 / M_sun.
+G = _G.to(units.kpc*units.km**2/units.s**2/units.M_sun).value
+
+def _where(cond, a, b):
+    # np.where that hands scalars straight back, so scalar kernels stay
+    # cheap inside quad integrands.
+    if np.ndim(cond) == 0:
+        return a if cond else b
+    return np.where(cond, a, b)
+
+def massgrid(rhofunc, r, rmin, nperdex=16, ngauss=8):
+    """
+    Return 4*pi*int_rmin^r x^2 rho(x) dx for every element of the array r.
+    The sorted radii are merged into a log grid and every interval gets a
+    fixed Gauss-Legendre rule in ln(x), so the whole curve costs one
+    vectorized rho evaluation and one cumulative sum.
+
+    Arguments:
+      rhofunc: function of an array of radii returning the density.
+      r: array of radii.
+      rmin: inner radius of the integration, below which the mass is 0.
+
+    Optional Keyword Arguments:
+      nperdex: log grid intervals per decade of radius (default 16).
+      ngauss: Gauss-Legendre points per interval (default 8).
+    """
+    r = np.asarray(r, dtype=float)
+    m = np.zeros(r.shape)
+    w = np.where(r > rmin)
+    if len(w[0]) == 0:
+        return m
+    rmaxgrid = np.max(r[w])
+    ngrid = max(int(np.ceil(nperdex*np.log10(rmaxgrid/rmin))), 1) + 1
+    grid = np.unique(np.concatenate([np.logspace(np.log10(rmin), np.log10(rmaxgrid), ngrid), r[w]]))
+    lo = np.log(grid[:-1])
+    hi = np.log(grid[1:])
+    xg, wg = np.polynomial.legendre.leggauss(ngauss)
+    half = (hi - lo)/2.0
+    x = np.exp((lo + hi)[:, None]/2.0 + half[:, None]*xg[None, :])
+    seg = (rhofunc(x.ravel()).reshape(x.shape)*x**3*wg[None, :]).sum(axis=1)*half
+    cum = np.concatenate([[0], np.cumsum(seg)])
+    m[w] = 4*pi*cum[np.searchsorted(grid, r[w])]
+    return m
+
+def vcirc(m, r):
+    """
+    Circular velocity in km/s of mass m (M_sun) enclosed within r (kpc),
+    0 at r=0.
+    """
+    r = np.asarray(r, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        v = np.sqrt(G*m/r)
+    return _where(r > 0, v, 0.0)
+
+def hermite(xgrid, f, df, xq):
+    """
+    Cubic Hermite interpolation of f, with derivative df, tabulated on the
+    increasing xgrid, at xq (clipped to the grid). Each query is one
+    searchsorted, so O(log n).
+    """
+    xq = np.clip(np.asarray(xq, dtype=float), xgrid[0], xgrid[-1])
+    i = np.clip(np.searchsorted(xgrid, xq) - 1, 0, len(xgrid) - 2)
+    h = xgrid[i + 1] - xgrid[i]
+    t = (xq - xgrid[i])/h
+    t2 = t*t
+    t3 = t2*t
+    return (f[i]*(2*t3 - 3*t2 + 1) + df[i]*h*(t3 - 2*t2 + t) +
+        f[i + 1]*(-2*t3 + 3*t2) + df[i + 1]*h*(t3 - t2))
+
+# NFW.
+
+def nfwfx(x):
+    x = np.asarray(x, dtype=float)
+    # the two terms cancel for small x, where the series takes over.
+    with np.errstate(invalid='ignore'):
+        series = x*x*(0.5 + x*(-2.0/3 + x*(0.75 + x*(-0.8 + x*5.0/6))))
+        return _where(x < 1e-3, series, np.log1p(x) - x/(1.0 + x))
+
+def nfwrho(r, rho0, rs):
+    x = np.asarray(r, dtype=float)/rs
+    with np.errstate(divide='ignore'):
+        return rho0/(x*(1 + x)**2)
+
+def nfwmass(r, rho0, rs):
+    return 4*pi*rho0*rs**3*nfwfx(np.asarray(r, dtype=float)/rs)
+
+def nfwphi(r, rho0, rs):
+    x = np.asarray(r, dtype=float)/rs
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lx = np.log1p(x)/x
+    return -4*pi*G*rho0*rs**2*_where(x > 0, lx, 1.0)
+
+def nfwsigma(r, rho0, rs):
+    # projected density, with the x<1, x>1 and x=1 branches picked by where.
+    x = np.asarray(r, dtype=float)/rs
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xl = np.minimum(x, 1 - 1e-12)
+        low = (1 - 2.0/np.sqrt(1 - xl**2)*np.arctanh(np.sqrt((1 - xl)/(1 + xl))))/(xl**2 - 1)
+        xh = np.maximum(x, 1 + 1e-12)
+        high = (1 - 2.0/np.sqrt(xh**2 - 1)*np.arctan(np.sqrt((xh - 1)/(xh + 1))))/(xh**2 - 1)
+    return 2*rho0*rs*_where(x < 1, low, _where(x > 1, high, 1.0/3))
+
+# Zhao (alpha, beta, gamma).
+
+def zhaoshape(x, alpha, beta, gamma):
+    """
+    Dimensionless Zhao density rho/rho0 at x=r/rs.
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore'):
+        return 1.0/(x**gamma*(1 + x**alpha)**(1.0*(beta - gamma)/alpha))
+
+def zhaorho(r, rho0, rs, alpha, beta, gamma, rvir=np.inf, rdecrvir=0):
+    """
+    Zhao density. For rdecrvir!=0 the profile beyond rvir is replaced by
+    the exponential truncation of Kazantzidis et al. (2004) with decay
+    length rdecrvir*rvir, matched in value and slope at rvir.
+    """
+    x = np.asarray(r, dtype=float)/rs
+    rho = rho0*zhaoshape(x, alpha, beta, gamma)
+    if rdecrvir == 0:
+        return rho
+    c = 1.0*rvir/rs
+    epsilon = (-gamma - beta*c**alpha)/(1 + c**alpha) + 1.0/rdecrvir
+    y = x/c
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        outer = rho0*zhaoshape(c, alpha, beta, gamma)*y**epsilon*np.exp(-(y - 1)/rdecrvir)
+    return _where(y <= 1, rho, outer)
+
+def zhaomu(x, alpha, beta, gamma):
+    """
+    Dimensionless untruncated Zhao mass M(<x*rs)/(4*pi*rho0*rs^3).
+    """
+    x = np.asarray(x, dtype=float)
+    a = 1.0*(3 - gamma)/alpha
+    b = 1.0*(beta - gamma)/alpha
+    c = 1.0*(alpha - gamma + 3)/alpha
+    return x**(3 - gamma)/(3 - gamma)*hyp2f1(a, b, c, -x**alpha)
+
+def zhaomass(r, rho0, rs, alpha, beta, gamma):
+    return 4*pi*rho0*rs**3*zhaomu(np.asarray(r, dtype=float)/rs, alpha, beta, gamma)
+
+def _betaincfunc(p, q, x):
+    return x**p/p*hyp2f1(p, 1 - q, p + 1, x)
+
+def zhaophi(r, rho0, rs, alpha, beta, gamma):
+    """
+    Untruncated Zhao potential, only available in closed form for alpha=1
+    (nan otherwise).
+    """
+    if alpha != 1:
+        return np.nan*np.asarray(r, dtype=float)
+    r = np.asarray(r, dtype=float)
+    x = r/rs
+    i1 = -rs**3*rho0*(-x)**gamma*x**(-gamma)*_betaincfunc(3 - gamma, -beta + gamma + 1, -x)/r
+    i2 = rs**2*rho0*np.float64(-1.0)**(-beta)*_betaincfunc(beta - 2, -beta + gamma + 1, -1.0/x)
+    return -4*pi*G*(i1 + i2)
+
+# x_max=r_max/rs of the untruncated Zhao profile, where M(<x)/x peaks, i.e.
+# the root of F(x)=x^3*shape(x)-mu(x). F>0 inside x_max and F<0 outside.
+
+# Closed-form or long-known answers, used as is.
+_XMAXEXACT = {
+    (1.0, 3.0, 1.0): 2.1625816019114059,
+    (1.0, 3.0, 0.0): 4.4247006595498686,
+    (1.0, 4.0, 1.0): 1.0,
+    (1.0, 4.0, 0.0): 2.0,
+    (1.0, 5.0, 0.0): 1.2749172096233057,
+    (1.0, 5.0, 1.0): 0.645751312789415,
+}
+
+# Grid of the shared table, log-spaced in alpha and beta-2 where x_max varies
+# fastest. Outside it zhaoxmax falls back to a wide bracketed solve.
+XMAXTABLEALPHA = np.exp(np.linspace(np.log(0.5), np.log(3.0), 16))
+XMAXTABLEBETA = 2 + np.exp(np.linspace(np.log(0.5), np.log(6.0), 23))
+XMAXTABLEGAMMA = np.linspace(0.0, 1.8, 19)
+XMAXMEMOSIZE = 1024
+
+_xmaxtable = []
+_xmaxmemo = OrderedDict()
+
+def _xmaxf(lx, alpha, beta, gamma):
+    x = np.exp(lx)
+    return x**3*zhaoshape(x, alpha, beta, gamma) - zhaomu(x, alpha, beta, gamma)
+
+def _xmaxbisect(alpha, beta, gamma, lo, hi, niter=60):
+    # Vectorized bisection in ln(x) between x=lo and x=hi.
+    lo = np.log(lo)*np.ones(np.shape(alpha))
+    hi = np.log(hi)*np.ones(np.shape(alpha))
+    for i in range(niter):
+        mid = 0.5*(lo + hi)
+        up = _xmaxf(mid, alpha, beta, gamma) > 0
+        lo = np.where(up, mid, lo)
+        hi = np.where(up, hi, mid)
+    return np.exp(0.5*(lo + hi))
+
+def _xmaxnewton(x, alpha, beta, gamma, niter=4):
+    # Newton steps in ln(x) from a good starting guess:
+    # dF/dlnx = x^3*shape*(2-gamma-(beta-gamma)*x^alpha/(1+x^alpha)).
+    lx = np.log(x)
+    for i in range(niter):
+        x = np.exp(lx)
+        xa = x**alpha
+        df = x**3*zhaoshape(x, alpha, beta, gamma)*(2 - gamma - (beta - gamma)*xa/(1 + xa))
+        lx = lx - _xmaxf(lx, alpha, beta, gamma)/df
+    return np.exp(lx)
+
+def xmaxtable():
+    """
+    Return the shared x_max interpolator over (alpha, beta, gamma), built on
+    first use by one vectorized bisection over the XMAXTABLE* grid. It is
+    linear in ln(x_max), typically good to ~1e-3 (a few per cent towards
+    gamma=1.8), which is plenty to seed the Newton polish in zhaoxmax.
+    """
+    if not _xmaxtable:
+        from scipy.interpolate import RegularGridInterpolator
+        a, b, g = np.meshgrid(XMAXTABLEALPHA, XMAXTABLEBETA, XMAXTABLEGAMMA, indexing='ij')
+        lx = np.log(_xmaxbisect(a, b, g, 1e-3, 1e3))
+        _xmaxtable.append(RegularGridInterpolator(
+            (XMAXTABLEALPHA, XMAXTABLEBETA, XMAXTABLEGAMMA), lx))
+    return _xmaxtable[0]
+
+def _inxmaxtable(alpha, beta, gamma):
+    return ((alpha >= XMAXTABLEALPHA[0]) & (alpha <= XMAXTABLEALPHA[-1]) &
+        (beta >= XMAXTABLEBETA[0]) & (beta <= XMAXTABLEBETA[-1]) &
+        (gamma >= XMAXTABLEGAMMA[0]) & (gamma <= XMAXTABLEGAMMA[-1]))
+
+def _zhaoxmaxsolve(alpha, beta, gamma):
+    # Uncached x_max for arrays of distinct shapes.
+    xmax = np.empty(alpha.shape)
+    intable = _inxmaxtable(alpha, beta, gamma)
+    if intable.any():
+        guess = np.exp(xmaxtable()(np.array([alpha[intable], beta[intable], gamma[intable]]).T))
+        xmax[intable] = _xmaxnewton(guess, alpha[intable], beta[intable], gamma[intable])
+    if not intable.all():
+        out = ~intable
+        a, b, g = alpha[out], beta[out], gamma[out]
+        lo, hi = 1e-6, 1e6
+        # No peak inside the bracket (e.g. gamma>=2 or beta<=2) gives nan.
+        bracketed = (_xmaxf(np.log(lo), a, b, g) > 0) & (_xmaxf(np.log(hi), a, b, g) < 0)
+        xmax[out] = np.where(bracketed, _xmaxbisect(a, b, g, lo, hi, niter=80), np.nan)
+    return xmax
+
+def zhaoxmax(alpha, beta, gamma):
+    """
+    x_max=r_max/rs of the untruncated Zhao profile for scalar or array
+    shape parameters (broadcast together). Shapes are looked up in order in
+    the exact answers, an LRU memo of XMAXMEMOSIZE previous results, and the
+    shared table polished by Newton steps to machine precision.
+    """
+    alpha, beta, gamma = np.broadcast_arrays(*[np.asarray(s, dtype=float)
+        for s in (alpha, beta, gamma)])
+    shape = alpha.shape
+    uniq, inv = np.unique(np.array([alpha.ravel(), beta.ravel(), gamma.ravel()]).T,
+        axis=0, return_inverse=True)
+    keys = [tuple(k) for k in uniq]
+    xmax = np.empty(len(keys))
+    todo = OrderedDict()
+    for i, k in enumerate(keys):
+        if k in _XMAXEXACT:
+            xmax[i] = _XMAXEXACT[k]
+        elif k in _xmaxmemo:
+            xmax[i] = _xmaxmemo.pop(k)
+            _xmaxmemo[k] = xmax[i]
+        else:
+            todo.setdefault(k, []).append(i)
+    if todo:
+        new = _zhaoxmaxsolve(*[np.array(s) for s in zip(*todo.keys())])
+        for (k, idx), x in zip(todo.items(), new):
+            xmax[idx] = x
+            _xmaxmemo[k] = x
+        while len(_xmaxmemo) > XMAXMEMOSIZE:
+            _xmaxmemo.popitem(last=False)
+    if shape == ():
+        return float(xmax[0])
+    return xmax[inv.ravel()].reshape(shape)
+
+# Enclosed mass of the truncated Zhao profile (rdecrvir!=0). Inside rvir it is
+# the analytic zhaomass; beyond rvir the exponential tail is tabulated once per
+# (alpha, beta, gamma, c, rdecrvir) in units of 4*pi*rho0*rs^3 against
+# ln(r/rvir), so every later query is a Hermite interpolation.
+
+TRUNCMASSMEMOSIZE = 256
+
+_truncmassmemo = OrderedDict()
+
+def _trunctail(y, alpha, beta, gamma, c, rdecrvir):
+    # dm/dlny of the dimensionless tail mass, y=r/rvir>=1.
+    epsilon = (-gamma - beta*c**alpha)/(1 + c**alpha) + 1.0/rdecrvir
+    with np.errstate(over='ignore', under='ignore'):
+        return c**3*zhaoshape(c, alpha, beta, gamma)*y**(3 + epsilon)*np.exp(-(y - 1)/rdecrvir)
+
+def _trunccum(lny, alpha, beta, gamma, c, rdecrvir, ngauss=8):
+    # Cumulative Gauss-Legendre integral of _trunctail over the lny grid.
+    xg, wg = np.polynomial.legendre.leggauss(ngauss)
+    half = (lny[1:] - lny[:-1])/2.0
+    x = (lny[1:] + lny[:-1])[:, None]/2.0 + half[:, None]*xg[None, :]
+    seg = (_trunctail(np.exp(x), alpha, beta, gamma, c, rdecrvir)*wg[None, :]).sum(axis=1)*half
+    return np.concatenate([[0], np.cumsum(seg)])
+
+def zhaotrunctable(alpha, beta, gamma, c, rdecrvir, rtol=1e-8, nperdex=64):
+    """
+    Tabulate the dimensionless tail mass (M(<r)-M(<rvir))/(4*pi*rho0*rs^3)
+    of the truncated Zhao profile. The grid runs from r=rvir until the tail
+    integrand falls below rtol of the accumulated mass, and its resolution is
+    doubled until the coarser grid, interpolated, agrees with it to rtol of
+    the total. Results
+    are kept in an LRU memo of TRUNCMASSMEMOSIZE entries.
+
+    Returns (lny, m, dmdlny) for use with hermite.
+    """
+    alpha, beta, gamma, c, rdecrvir = key = tuple(float(v) for v in (alpha, beta, gamma, c, rdecrvir))
+    if key in _truncmassmemo:
+        table = _truncmassmemo.pop(key)
+        _truncmassmemo[key] = table
+        return table
+    # Outer edge: step out in units of the decay length until the integrand
+    # is negligible next to the mass already enclosed.
+    ymax = 1.0 + 10*rdecrvir
+    while True:
+        lny = np.linspace(0, np.log(ymax), max(int(nperdex*np.log10(ymax)), 1) + 1)
+        m = _trunccum(lny, alpha, beta, gamma, c, rdecrvir)
+        if _trunctail(ymax, alpha, beta, gamma, c, rdecrvir) <= rtol*max(m[-1], 1e-300):
+            break
+        ymax = 1.0 + 2*(ymax - 1.0)
+    dm = _trunctail(np.exp(lny), alpha, beta, gamma, c, rdecrvir)
+    while len(lny) < 1e5:
+        # The halved grid checks both the quadrature and the Hermite
+        # interpolation of the current one at the new midpoints.
+        lny2 = np.linspace(0, np.log(ymax), 2*len(lny) - 1)
+        m2 = _trunccum(lny2, alpha, beta, gamma, c, rdecrvir)
+        err = np.max(abs(hermite(lny, m, dm, lny2) - m2))
+        lny, m = lny2, m2
+        dm = _trunctail(np.exp(lny), alpha, beta, gamma, c, rdecrvir)
+        if err <= rtol*m[-1]:
+            break
+    table = (lny, m, dm)
+    _truncmassmemo[key] = table
+    while len(_truncmassmemo) > TRUNCMASSMEMOSIZE:
+        _truncmassmemo.popitem(last=False)
+    return table
+
+def zhaotruncmass(r, rho0, rs, alpha, beta, gamma, rvir, rdecrvir, table=None):
+    """
+    Enclosed mass of the truncated Zhao profile of zhaorho. A table from
+    zhaotrunctable may be passed in; otherwise it is fetched from the memo.
+    """
+    r = np.asarray(r, dtype=float)
+    c = 1.0*rvir/rs
+    m = zhaomass(np.minimum(r, rvir), rho0, rs, alpha, beta, gamma)
+    if np.all(r <= rvir):
+        return m
+    if table is None:
+        table = zhaotrunctable(alpha, beta, gamma, c, rdecrvir)
+    lny, tail, dtail = table
+    with np.errstate(divide='ignore'):
+        lnr = np.log(np.maximum(r, rvir)/rvir)
+    return m + 4*pi*rho0*rs**3*hermite(lny, tail, dtail, lnr)
+
+# Einasto, with rs the radius enclosing half the total mass.
+
+def einastodn(alpha):
+    return 3*alpha - 1.0/3 + 8.0/1215.0/alpha + 184.0/229635.0/alpha**2 + \
+        1048.0/31000725.0/alpha**3 - 17557576.0/1242974068875.0/alpha**4
+
+def einastoh(rs, alpha):
+    return rs/einastodn(alpha)**alpha
+
+def einastorho(r, rho0, rs, alpha):
+    return rho0*np.exp(-(np.asarray(r, dtype=float)/einastoh(rs, alpha))**(1.0/alpha))
+
+def einastomtot(rho0, rs, alpha):
+    return 4*pi*rho0*einastoh(rs, alpha)**3*alpha*gammafunc(3*alpha)
+
+def einastomass(r, rho0, rs, alpha):
+    s = (np.asarray(r, dtype=float)/einastoh(rs, alpha))**(1.0/alpha)
+    return einastomtot(rho0, rs, alpha)*gammainc(3*alpha, s)
+
+# Plummer.
+
+def plummerrho(r, m, a):
+    return 3*m/4.0/pi/a**3*(1 + (np.asarray(r, dtype=float)/a)**2)**(-2.5)
+
+def plummermass(r, m, a):
+    r = np.asarray(r, dtype=float)
+    return m*r**3/(r**2 + a**2)**1.5
+
+def plummerphi(r, m, a):
+    return -G*m/np.sqrt(np.asarray(r, dtype=float)**2 + a**2)
+
+def plummersigma(r, m, a):
+    return m*a**2/pi/(a**2 + np.asarray(r, dtype=float)**2)**2
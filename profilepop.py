@@ -0,0 +1,320 @@
+"""
+profilepop.py
+
+Struct-of-arrays containers for populations of NFW and Zhao halos. Each
+population stores its halo parameters as contiguous float64 arrays in fixed
+units (kpc, M_sun, km/s) and evaluates profile quantities for every halo in
+one vectorized pass, instead of one profileclass object per halo.
+"""
+from collections import OrderedDict
+import numpy as np
+from astropy import units
+import profileclass
+import profilegrid
+import profilekernels
+import profilesolve
+
+GKMS = profilekernels.G
+
+KPC = units.kpc
+MSUN = units.M_sun
+VUNIT = units.km/units.s
+RHOUNIT = MSUN/KPC**3
+SIGMAUNIT = MSUN/KPC**2
+PHIUNIT = VUNIT**2
+FUNIT = RHOUNIT/VUNIT**3
+GUNIT = KPC**3*VUNIT
+
+DFMEMOSIZE = 64
+
+_dfmemo = OrderedDict()
+
+def _dftable(key, rhoshape):
+    # profilegrid.EddingtonTable of the unit halo (rho0=1 M_sun/kpc^3,
+    # rs=1 kpc) of one shape, in an LRU memo of DFMEMOSIZE shapes.
+    if key in _dfmemo:
+        table = _dfmemo.pop(key)
+    else:
+        table = profilegrid.EddingtonTable(profilegrid.ProfileGrid(rhoshape, 1e-5, 1e5))
+    _dfmemo[key] = table
+    while len(_dfmemo) > DFMEMOSIZE:
+        _dfmemo.popitem(last=False)
+    return table
+
+def _tofloat(x, unit):
+    # Quantities are converted to unit, anything else is taken to be in unit.
+    if hasattr(x, 'unit'):
+        return np.asarray(x.to(unit).value, dtype=float)
+    return np.asarray(x, dtype=float)
+
+class HaloPopulation(object):
+    """
+    Base class for populations of halos with a density profile
+    rho(r) = rho0*rhoshape(r/rs). Subclasses provide the dimensionless
+    enclosed mass mu(x) = M(<x*rs)/(4*pi*rho0*rs**3), the dimensionless
+    projected density and the scale radius of the peak circular velocity.
+
+    Attributes are float64 arrays with one entry per halo:
+      rho0: scale density in M_sun/kpc^3.
+      rs: scale radius in kpc.
+      rvir: virial radius in kpc.
+      mvir: virial mass in M_sun.
+      c: concentration rvir/rs.
+      deltavirrhou: mean density within rvir in M_sun/kpc^3.
+      converged: False for halos whose parameters have no solution (no
+        concentration in profilesolve's [CMIN, CMAX] fits them); their
+        rvir, mvir, c and deltavirrhou are nan.
+
+    Radii passed to the get_ methods may be Quantities or floats in kpc and
+    broadcast against the halo axis: a scalar is used for every halo, an
+    array of shape (N,) gives one radius per halo and an array of shape
+    (1, M) or (N, M) gives an M-point curve per halo. They return
+    Quantities, or plain arrays in kpc, M_sun and km/s with units=False.
+    """
+
+    shapenames = ()
+
+    def __init__(self, rho0=None, rs=None, rvir=None, mvir=None,
+        deltavirrhou=None, c=None, vmax=None, rmax=None):
+
+        given = {}
+        for name, value, unit in [('rho0', rho0, RHOUNIT),
+            ('rs', rs, KPC), ('rvir', rvir, KPC),
+            ('mvir', mvir, MSUN), ('deltavirrhou', deltavirrhou, RHOUNIT),
+            ('c', c, units.dimensionless_unscaled),
+            ('vmax', vmax, VUNIT), ('rmax', rmax, KPC)]:
+            if value is not None:
+                given[name] = _tofloat(value, unit)
+        if len(given) == 0:
+            raise ValueError('no halo parameters given')
+        # the parameters and any shape parameters set by a subclass are
+        # broadcast to one common halo axis.
+        names = sorted(given)
+        arrays = np.broadcast_arrays(*([np.atleast_1d(given[k]) for k in names] +
+            [np.atleast_1d(getattr(self, k)) for k in self.shapenames]))
+        for k, a in zip(names + list(self.shapenames), arrays):
+            a = np.ascontiguousarray(a, dtype=float).ravel()
+            if k in given:
+                given[k] = a
+            else:
+                setattr(self, k, a)
+        self._solve(given)
+
+    def _solve(self, p):
+        # see profilesolve.BRANCHES for the accepted combinations.
+        p, info = profilesolve.solvehalo(self._solveshape(), full_output=True, **p)
+        self._setparams(p['rho0'], p['rs'], p['rvir'], p['mvir'], info['converged'])
+
+    def _setparams(self, rho0, rs, rvir, mvir, converged=True):
+        self.rho0 = np.ascontiguousarray(rho0, dtype=float)
+        self.rs = np.ascontiguousarray(rs, dtype=float)
+        self.rvir = np.ascontiguousarray(rvir, dtype=float)
+        self.mvir = np.ascontiguousarray(mvir, dtype=float)
+        self.c = self.rvir/self.rs
+        self.deltavirrhou = self.mvir/(4*np.pi/3*self.rvir**3)
+        self.converged = np.broadcast_to(converged, self.rs.shape).copy()
+
+    def __len__(self):
+        return len(self.rs)
+
+    def _bcast(self, x, r):
+        # Reshape a per-halo array so it broadcasts against r.
+        return x.reshape((-1,) + (1,)*(np.ndim(r) - 1)) if np.ndim(r) > 1 else x
+
+    def _massfloat(self, r, rho0, rs):
+        return 4*np.pi*rho0*rs**3*self._mu(r/rs)
+
+    def _withunits(self, x, unit, withunits):
+        return x*unit if withunits else x
+
+    def get_mass(self, r, units=True):
+        r = _tofloat(r, KPC)
+        rho0 = self._bcast(self.rho0, r)
+        rs = self._bcast(self.rs, r)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = np.where(r > 0, self._massfloat(r, rho0, rs), 0.0)
+        return self._withunits(m, MSUN, units)
+
+    def get_vcirc(self, r, units=True):
+        r = _tofloat(r, KPC)
+        v = profilekernels.vcirc(self.get_mass(r, units=False), r)
+        return self._withunits(v, VUNIT, units)
+
+    def get_rmax(self, units=True):
+        return self._withunits(self.get_xmax()*self.rs, KPC, units)
+
+    def get_vmax(self, units=True):
+        return self.get_vcirc(self.get_rmax(units=False), units=units)
+
+    def get_meanrho(self, r, units=True):
+        r = _tofloat(r, KPC)
+        return self._withunits(self.get_mass(r, units=False)/(4*np.pi/3*r**3), RHOUNIT, units)
+
+    def get_rho(self, r, units=True):
+        r = _tofloat(r, KPC)
+        rho0 = self._bcast(self.rho0, r)
+        rs = self._bcast(self.rs, r)
+        return self._withunits(rho0*self._rhoshape(r/rs), RHOUNIT, units)
+
+    def get_projected(self, r, units=True):
+        r = _tofloat(r, KPC)
+        rho0 = self._bcast(self.rho0, r)
+        rs = self._bcast(self.rs, r)
+        return self._withunits(rho0*rs*self._sigmashape(r/rs), SIGMAUNIT, units)
+
+    def _sigmashape(self, x):
+        # Generic line-of-sight integral out to r=1e4*rs.
+        return profilegrid.abel(self._rhoshape, x, 1e4)
+
+    def _dfeval(self, E, which):
+        # f(E) or g(E) of every halo from the unit-halo table of its shape:
+        # with Psi in units of rho0*rs^2, f scales as rho0*(rho0*rs^2)^-1.5
+        # and g as rs^3*(rho0*rs^2)^0.5.
+        E = _tofloat(E, PHIUNIT)
+        rho0 = self._bcast(self.rho0, E)
+        rs = self._bcast(self.rs, E)
+        k = rho0*rs**2
+        x = E/k
+        out = np.empty(x.shape)
+        for halos, key, rhoshape in self._shapegroups():
+            table = _dftable(key, rhoshape)
+            out[halos] = getattr(table, which)(x[halos])
+        if which == 'get_f':
+            return out*rho0*k**-1.5
+        return out*rs**3*np.sqrt(k)
+
+    def get_fe(self, E, units=True):
+        """
+        Isotropic distribution function f(E) of every halo, from one
+        Eddington inversion per distinct shape. Energies broadcast against
+        the halo axis like radii.
+        """
+        return self._withunits(self._dfeval(E, 'get_f'), FUNIT, units)
+
+    def get_ge(self, E, units=True):
+        """
+        Density of states g(E) of every halo, broadcast like get_fe.
+        """
+        return self._withunits(self._dfeval(E, 'get_g'), GUNIT, units)
+
+    def get_profile(self, i):
+        """
+        Return halo i as a scalar profileclass profile, rebuilt from its
+        parameter record without a constructor solve.
+        """
+        rec = self._record(i)
+        for k in ('rho0', 'rs', 'rvir', 'mvir', 'deltavirrhou', 'c'):
+            rec[k] = getattr(self, k)[i]
+        return profileclass.profilefromrecord(rec)
+
+    def to_profiles(self):
+        """
+        Return the population as a list of scalar profileclass profiles.
+        """
+        return [self.get_profile(i) for i in range(len(self))]
+
+class NFWPopulation(HaloPopulation):
+    """
+    A population of NFW halos.
+
+    Optional Keyword Arguments (arrays or scalars, broadcast together, as
+    Quantities or floats in M_sun, kpc and km/s):
+      rho0, rs, rvir, mvir, deltavirrhou, c, vmax, rmax: the same
+        parameterizations as profileclass.NFW, e.g. mvir+c+deltavirrhou,
+        rho0+rs+rvir or vmax+rmax+mvir.
+    """
+
+    def get_xmax(self):
+        return profilekernels.zhaoxmax(1, 3, 1)
+
+    def _solveshape(self):
+        return profilesolve.NFWShape()
+
+    def _mu(self, x):
+        return profilekernels.nfwfx(x)
+
+    def _rhoshape(self, x):
+        return profilekernels.nfwrho(x, 1.0, 1.0)
+
+    def _sigmashape(self, x):
+        return profilekernels.nfwsigma(x, 1.0, 1.0)
+
+    def _shapegroups(self):
+        return [(slice(None), ('nfw',), self._rhoshape)]
+
+    @classmethod
+    def from_profiles(cls, profiles):
+        """
+        Build a population from a list of profileclass.NFW objects.
+        """
+        pop = cls.__new__(cls)
+        pop._setparams(*[[getattr(pr, k).to(u).value for pr in profiles]
+            for k, u in [('rho0', RHOUNIT), ('rs', KPC),
+            ('rvir', KPC), ('mvir', MSUN)]])
+        return pop
+
+    def _record(self, i):
+        return {'kind': 'NFW'}
+
+class ZhaoPopulation(HaloPopulation):
+    """
+    A population of untruncated Zhao (alpha, beta, gamma) halos.
+
+    Arguments:
+      alpha, beta, gamma: the profile shape (Penarrubia 2010, eqn 2), as
+        scalars or arrays with one entry per halo.
+
+    Optional Keyword Arguments (arrays or scalars, broadcast together, as
+    Quantities or floats in M_sun, kpc and km/s):
+      rho0, rs, rvir, mvir, deltavirrhou, c, vmax, rmax: the same
+        parameterizations as profileclass.Zhao with rdecrvir=0.
+    """
+
+    shapenames = ('alpha', 'beta', 'gamma')
+
+    def __init__(self, alpha, beta, gamma, **kwargs):
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        HaloPopulation.__init__(self, **kwargs)
+
+    def get_xmax(self):
+        return profilekernels.zhaoxmax(self.alpha, self.beta, self.gamma)
+
+    def _solveshape(self):
+        return profilesolve.ZhaoShape(self.alpha, self.beta, self.gamma)
+
+    def _shape(self, x):
+        return [self._bcast(s, x) for s in (self.alpha, self.beta, self.gamma)]
+
+    def _mu(self, x):
+        a, b, g = self._shape(x)
+        return profilekernels.zhaomu(x, a, b, g)
+
+    def _rhoshape(self, x):
+        a, b, g = self._shape(x)
+        return profilekernels.zhaoshape(x, a, b, g)
+
+    def _shapegroups(self):
+        # halo mask, memo key and unit-halo density of every distinct shape.
+        uniq, inv = np.unique(np.array([self.alpha, self.beta, self.gamma]).T,
+            axis=0, return_inverse=True)
+        return [(inv == i, ('zhao',) + tuple(s), lambda x, s=s: profilekernels.zhaoshape(x, *s))
+            for i, s in enumerate(uniq)]
+
+    @classmethod
+    def from_profiles(cls, profiles):
+        """
+        Build a population from a list of profileclass.Zhao objects.
+        """
+        pop = cls.__new__(cls)
+        pop.alpha, pop.beta, pop.gamma = [np.array([getattr(pr, k) for pr in profiles],
+            dtype=float) for k in ('alpha', 'beta', 'gamma')]
+        pop._setparams(*[[getattr(pr, k).to(u).value for pr in profiles]
+            for k, u in [('rho0', RHOUNIT), ('rs', KPC),
+            ('rvir', KPC), ('mvir', MSUN)]])
+        return pop
+
+    def _record(self, i):
+        return {'kind': 'Zhao', 'alpha': self.alpha[i], 'beta': self.beta[i],
+            'gamma': self.gamma[i], 'rdecrvir': 0}
@@ -0,0 +1,311 @@
+"""
+profilesolve.py
+
+Bracketed root finding for the halo parameterizations accepted by
+profileclass.Zhao and the profilepop populations. Every branch is reduced to
+at most one monotone equation in the concentration c=rvir/rs, solved in
+log(c) by Newton steps safeguarded by bisection, with the analytic
+derivative dln(mu)/dln(x) = x^3*rhoshape(x)/mu(x) of the hyp2f1 mass.
+Everything works element-wise on arrays, so one call solves many halos.
+Units are kpc, M_sun, M_sun/kpc^3 and km/s.
+"""
+import numpy as np
+import profilekernels
+
+# Parameter combinations in order of precedence. The first one whose names
+# are all given (after filling in rs or rvir from c) is used.
+BRANCHES = [
+    ('rho0', 'rs', 'rvir'),
+    ('mvir', 'rs', 'rvir'),
+    ('deltavirrhou', 'rs', 'rvir'),
+    ('rho0', 'rvir', 'mvir'),
+    ('rho0', 'rs', 'mvir'),
+    ('rho0', 'rs', 'deltavirrhou'),
+    ('rho0', 'rvir', 'deltavirrhou'),
+    ('rho0', 'mvir', 'deltavirrhou'),
+    ('rs', 'mvir', 'deltavirrhou'),
+    ('c', 'mvir', 'deltavirrhou'),
+    ('rmax', 'vmax', 'mvir'),
+    ('rmax', 'vmax', 'rvir'),
+    ('vmax', 'mvir', 'deltavirrhou'),
+    ('rmax', 'vmax', 'deltavirrhou'),
+]
+
+# Default bracket on c for the branches that solve for it.
+CMIN = 1e-8
+CMAX = 1e8
+
+class ZhaoShape(object):
+    """
+    The dimensionless Zhao (alpha, beta, gamma) profile seen by the solvers.
+    The shape parameters may be scalars or arrays broadcasting against the
+    halo parameters.
+    """
+
+    def __init__(self, alpha, beta, gamma):
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+    def mu(self, x):
+        """
+        M(<x*rs)/(4*pi*rho0*rs^3).
+        """
+        return profilekernels.zhaomu(x, self.alpha, self.beta, self.gamma)
+
+    def dlnmu(self, x, mu=None):
+        """
+        dln(mu)/dln(x) = x^3*rhoshape(x)/mu(x).
+        """
+        if mu is None:
+            mu = self.mu(x)
+        return x**3*profilekernels.zhaoshape(x, self.alpha, self.beta, self.gamma)/mu
+
+    def xmax(self):
+        return profilekernels.zhaoxmax(self.alpha, self.beta, self.gamma)
+
+class NFWShape(ZhaoShape):
+    """
+    ZhaoShape(1, 3, 1) with the closed-form NFW mass.
+    """
+
+    def __init__(self):
+        ZhaoShape.__init__(self, 1, 3, 1)
+
+    def mu(self, x):
+        return profilekernels.nfwfx(x)
+
+    def dlnmu(self, x, mu=None):
+        if mu is None:
+            mu = self.mu(x)
+        return x**2/(1 + x)**2/mu
+
+    def xmax(self):
+        return profilekernels.zhaoxmax(1, 3, 1)
+
+def lognewton(f, lo, hi, x0=None, xtol=1e-12, maxiter=100, full_output=False):
+    """
+    Solve f(x)=0 element-wise for x in the brackets [lo, hi], where g=f(x)
+    changes sign across each bracket. Newton steps in ln(x) are taken while
+    they stay inside the shrinking bracket, and bisection steps otherwise,
+    so convergence is guaranteed. Elements without a sign change come back
+    as nan.
+
+    Arguments:
+      f: function f(x, idx) returning the pair (g, dg/dln(x)) for the 1-d
+        array x of the elements with indices idx, so any per-element
+        parameters can be subset with idx. Only unconverged elements are
+        passed after the first iteration.
+      lo, hi: 1-d arrays with the ends of the brackets.
+
+    Optional Keyword Arguments:
+      x0: starting guess (default the geometric mean of the bracket).
+      xtol: absolute tolerance in ln(x) (default 1e-12).
+      maxiter: maximum number of iterations (default 100).
+      full_output: if True, also return the number of f evaluations each
+        element needed, including the two at the bracket ends.
+    """
+    llo = np.log(np.asarray(lo, dtype=float))
+    lhi = np.log(np.asarray(hi, dtype=float))
+    allidx = np.arange(len(llo))
+    glo = np.asarray(f(np.exp(llo), allidx)[0])
+    ghi = np.asarray(f(np.exp(lhi), allidx)[0])
+    bad = ~(glo*ghi <= 0)
+    # orient the brackets so that g(lneg)<0<g(lpos).
+    flip = glo > 0
+    lneg = np.where(flip, lhi, llo)
+    lpos = np.where(flip, llo, lhi)
+    lx = 0.5*(llo + lhi)
+    if x0 is not None:
+        l0 = np.log(np.asarray(x0, dtype=float))*np.ones(llo.shape)
+        lx = np.where((l0 - llo)*(l0 - lhi) < 0, l0, lx)
+    lx[bad] = np.nan
+    niter = np.full(llo.shape, 2, dtype=int)
+    idx = allidx[~bad]
+    for i in range(maxiter):
+        if len(idx) == 0:
+            break
+        cur = lx[idx]
+        g, dg = f(np.exp(cur), idx)
+        neg = g < 0
+        ln = np.where(neg, cur, lneg[idx])
+        lp = np.where(neg, lpos[idx], cur)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dx = g/dg
+        step = cur - dx
+        inside = np.isfinite(step) & ((step - ln)*(step - lp) < 0)
+        # a Newton step below xtol means cur is already the root; judging it
+        # against the bracket instead would bisect away from it.
+        done = (g == 0) | (abs(dx) < xtol) | (abs(lp - ln) < xtol)
+        new = np.where(done, cur, np.where(inside, step, 0.5*(ln + lp)))
+        lneg[idx] = ln
+        lpos[idx] = lp
+        lx[idx] = new
+        niter[idx] += 1
+        idx = idx[~done]
+    x = np.exp(lx)
+    if full_output:
+        return x, niter
+    return x
+
+def _take(a, idx):
+    # Per-halo parameter a restricted to the elements idx (scalars pass).
+    a = np.asarray(a)
+    if a.ndim == 0:
+        return a
+    return a[idx]
+
+def _shapeat(shape, idx):
+    # Shallow copy of shape with array shape parameters subset to idx.
+    sub = ZhaoShape.__new__(type(shape))
+    sub.__dict__.update(shape.__dict__)
+    for k in ('alpha', 'beta', 'gamma'):
+        sub.__dict__[k] = _take(getattr(shape, k), idx)
+    return sub
+
+def _equation(shape, kind, q):
+    """
+    The monotone equation g(c)=0 of each solving branch, with its
+    derivative in ln(c), as a function of (c, idx) for lognewton.
+      'mu': mu(c) = q.
+      'meanrho': 3*mu(c)/c^3 = q, the mean density within rvir over rho0.
+      'vmax': mu(c)/c = q, the circular velocity at rvir, c > x_max.
+    """
+    def f(c, idx):
+        s = _shapeat(shape, idx)
+        qq = _take(q, idx)
+        mu = s.mu(c)
+        dlnmu = s.dlnmu(c, mu)
+        if kind == 'mu':
+            return np.log(mu/qq), dlnmu
+        elif kind == 'meanrho':
+            return np.log(3*mu/c**3/qq), dlnmu - 3
+        else:
+            return np.log(mu/c/qq), dlnmu - 1
+    return f
+
+def solvec(shape, kind, q, lo=CMIN, hi=CMAX, full_output=False):
+    """
+    Solve one of the _equation kinds ('mu', 'meanrho', 'vmax') for the
+    concentration, element-wise over q.
+    """
+    q = np.asarray(q, dtype=float)
+    shapeparams = [np.asarray(getattr(shape, k)) for k in ('alpha', 'beta', 'gamma')]
+    n = np.broadcast(q, *shapeparams).shape
+    scalar = len(n) == 0
+    size = int(np.prod(n))
+    flat = lambda a: np.broadcast_to(np.asarray(a, dtype=float), n).reshape(size)
+    sub = ZhaoShape.__new__(type(shape))
+    sub.__dict__.update(shape.__dict__)
+    for k, a in zip(('alpha', 'beta', 'gamma'), shapeparams):
+        if a.ndim:
+            sub.__dict__[k] = flat(a)
+    c, niter = lognewton(_equation(sub, kind, flat(q)), flat(lo), flat(hi), full_output=True)
+    if scalar:
+        c, niter = float(c[0]), int(niter[0])
+    else:
+        c, niter = c.reshape(n), niter.reshape(n)
+    if full_output:
+        return c, niter
+    return c
+
+def findbranch(names):
+    """
+    Return the entry of BRANCHES used for the given parameter names, or None.
+    """
+    names = set(names)
+    if 'rs' not in names and 'c' in names and 'rvir' in names:
+        names.add('rs')
+    if 'rvir' not in names and 'c' in names and 'rs' in names:
+        names.add('rvir')
+    for branch in BRANCHES:
+        if names.issuperset(branch):
+            return branch
+    return None
+
+def solvehalo(shape, full_output=False, strict=False, **params):
+    """
+    Solve for rho0, rs, rvir and mvir from any parameter combination in
+    BRANCHES. Parameters are floats or arrays in kpc, M_sun, M_sun/kpc^3 and
+    km/s that broadcast together (and with the shape parameters).
+
+    Arguments:
+      shape: ZhaoShape or NFWShape.
+      rho0, rs, rvir, mvir, deltavirrhou, c, vmax, rmax: keyword arguments,
+        only the given ones are used.
+
+    Optional Keyword Arguments:
+      full_output: if True, also return a dict with the branch used, the
+        per-halo iteration counts of the concentration solve ('niter', 0
+        for the closed-form branches) and the boolean mask 'converged',
+        False for halos whose concentration equation has no root in
+        [CMIN, CMAX] (their parameters are nan).
+      strict: if True, raise ValueError instead when any halo has no root.
+
+    Raises ValueError for an unsupported combination.
+    """
+    p = dict((k, np.asarray(v, dtype=float)) for k, v in params.items() if v is not None)
+    branch = findbranch(p)
+    if branch is None:
+        raise ValueError('unsupported combination of halo parameters: %s' % ', '.join(sorted(p)))
+    p = dict((k, p[k]) for k in p if k in branch or (k == 'c' and 'c' not in branch))
+    if 'rs' not in p and 'c' in p and 'rvir' in p:
+        p['rs'] = p['rvir']/p['c']
+    if 'rvir' not in p and 'c' in p and 'rs' in p:
+        p['rvir'] = p['rs']*p['c']
+    c = None
+    niter = 0
+    has = lambda *names: all(n in p for n in names)
+
+    if has('mvir', 'deltavirrhou') and 'rvir' not in p:
+        p['rvir'] = (p['mvir']/(4*np.pi/3*p['deltavirrhou']))**(1.0/3)
+    if has('c', 'rvir') and 'rs' not in p:
+        p['rs'] = p['rvir']/p['c']
+    if has('deltavirrhou', 'rvir') and 'mvir' not in p:
+        p['mvir'] = 4*np.pi/3*p['deltavirrhou']*p['rvir']**3
+    if has('rmax', 'vmax'):
+        # vmax and rmax fix rs and the mass within rmax.
+        xmax = shape.xmax()
+        p['rs'] = p['rmax']/xmax
+        mrmax = p['vmax']**2*p['rmax']/profilekernels.G
+        p['rho0'] = mrmax/(4*np.pi*p['rs']**3*shape.mu(xmax))
+
+    if has('rho0', 'rs', 'rvir'):
+        pass
+    elif has('mvir', 'rs', 'rvir'):
+        pass
+    elif has('rho0', 'rvir', 'mvir'):
+        # the mean density within rvir falls monotonically with c.
+        q = p['mvir']/(4*np.pi/3*p['rvir']**3)/p['rho0']
+        c, niter = solvec(shape, 'meanrho', q, full_output=True)
+        p['rs'] = p['rvir']/c
+    elif has('rho0', 'rs', 'mvir'):
+        # the mass within rvir grows monotonically with c.
+        q = p['mvir']/(4*np.pi*p['rho0']*p['rs']**3)
+        c, niter = solvec(shape, 'mu', q, full_output=True)
+        p['rvir'] = c*p['rs']
+    elif has('rho0', 'rs', 'deltavirrhou'):
+        c, niter = solvec(shape, 'meanrho', p['deltavirrhou']/p['rho0'], full_output=True)
+        p['rvir'] = c*p['rs']
+    elif has('vmax', 'mvir', 'rvir'):
+        # M(<r)/r peaks at x_max, so beyond it there is one c with
+        # vcirc(rvir) = vvir for the given vmax.
+        xmax = shape.xmax()
+        q = shape.mu(xmax)/xmax*profilekernels.G*p['mvir']/p['rvir']/p['vmax']**2
+        c, niter = solvec(shape, 'vmax', q, lo=xmax, full_output=True)
+        p['rs'] = p['rvir']/c
+
+    if 'rho0' not in p:
+        p['rho0'] = p['mvir']/(4*np.pi*p['rs']**3*shape.mu(p['rvir']/p['rs']))
+    if 'mvir' not in p:
+        p['mvir'] = 4*np.pi*p['rho0']*p['rs']**3*shape.mu(p['rvir']/p['rs'])
+
+    out = dict((k, p[k]) for k in ('rho0', 'rs', 'rvir', 'mvir'))
+    converged = np.isfinite(c) if c is not None else True
+    converged = np.broadcast_to(converged, np.broadcast(*out.values()).shape)
+    if strict and not converged.all():
+        raise ValueError('no concentration in [%g, %g] solves the %s branch for these halo parameters'
+            % (CMIN, CMAX, '+'.join(branch)))
+    if full_output:
+        return out, {'branch': branch, 'niter': niter, 'converged': converged}
+    return out
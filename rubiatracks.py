@@ -1,237 +1,143 @@
-from numpy import log10,shape,where,random,array,cumsum,repeat
-def getvmaxfinal(mloss,gamma,minrmax=False,withscatter=False):
-    if minrmax:
-        if gamma>0.75:
-            mu=0.12
-            nu=0.29
-        else:
-            mu=0.53
-            nu=0.53
-    else:
-        if gamma>1.25 and gamma<1.75:
-            mu=0.4
-            nu=0.24
-        elif gamma>0.75:
-            #using new fits from Raphael
-            #mu=0.67
-            #nu=0.37
-            mu=0.4
-            nu=0.3
-        elif gamma>0.25:
-            mu=0.4
-            nu=0.35
-        else:
-            mu=0.4
-            nu=0.37
-    if withscatter and gamma<.25:
-        mlbins=array([10,.5,.2,.1,0])
-        histx=[array([1,0]),array([1,.85]),array([1,.8]),array([1,.8])]
-        histy=[array([1,0]),array([.9,.1]),array([.625,.375]),array([.5,.5])]
-        if len(shape(mloss))==0:
-            w=where(mloss>mlbins)[0][0]-1
-            r=random.rand()
-            wx=where(r<cumsum(histy[w]))[0][0]
-            return 2**mu*mloss**nu/(1+mloss)**mu*histx[w][wx]
-        else:
-            ret=[]
-            for i in mloss:
-                w=where(i>mlbins)[0][0]-1
-                r=random.rand()
-                wx=where(r<cumsum(histy[w]))[0][0]
-                ret.append(2**mu*i**nu/(1+i)**mu*histx[w][wx])
-            return array(ret)
-
-
-    return 2**mu*mloss**nu/(1+mloss)**mu
-
-
-def getrmaxfinal(mloss,gamma,minrmax=False,withscatter=False):
-    if minrmax:
-        if gamma>0.75:
-            mu=-0.17
-            nu=0.43
-        else:
-            mu=-0.85
-            nu=0.023
-    else:
-        if gamma>1.25 and gamma<1.75:
-            mu=0
-            nu=0.48
-        elif gamma>0.75:
-            #using new fits from Raphael
-            #mu=0.95
-            #nu=0.58
-            mu=-0.3
-            nu=0.4
-        elif gamma>0.25:
-            mu=-0.4
-            nu=0.27
-        else:
-            mu=-1.3
-            nu=0.05
-
-    if withscatter and gamma<.25:
-        mlbins=array([10,.5,.2,.1,0])
-        histx=[array([1,0]),array([1,1.1]),array([1,1.2]),array([1,1.2])]
-        histy=[array([1,0]),array([.9,.1]),array([.625,.375]),array([.5,.5])]
-        if len(shape(mloss))==0:
-            w=where(mloss>mlbins)[0][0]-1
-            r=random.rand()
-            wx=where(r<cumsum(histy[w]))[0][0]
-            return 2**mu*mloss**nu/(1+mloss)**mu*histx[w][wx]
-        else:
-            ret=[]
-            for i in mloss:
-                w=where(i>mlbins)[0][0]-1
-                r=random.rand()
-                wx=where(r<cumsum(histy[w]))[0][0]
-                ret.append(2**mu*i**nu/(1+i)**mu*histx[w][wx])
-            return array(ret)
-
-    return 2**mu*mloss**nu/(1+mloss)**mu
-
-def getrhfinal(mloss,gamma,rovera=0.1,minrmax=False,withscatter=False):
-
-
-    if minrmax:
-        
-        if gamma>0.5:
-            
-            alpha2=0.075
-            beta2=-0.037
-
-            alpha1=-0.10
-            beta1=-0.067
-
-        else:
-
-            alpha2=0.019
-            beta2=-0.18
-
-            alpha1=0.0036
-            beta1=-0.20
-
-    else:
-
-        if gamma>0.5:
-            
-            alpha2=1.22
-            beta2=0.33
-
-            alpha1=1.49
-            beta1=0.35
-
-        else:
-
-            alpha2=1.63
-            beta2=0.03
-            alpha1=2.91
-            beta1=0.15
-
+from numpy import log10,shape,random,array,searchsorted,asarray,broadcast,where,full,inf,nan
+import instrument
+
+#Track coefficients by named set. TRACKCOEFFS[set][track][minrmax] is a list of
+#(gt,lt,coefficients) rules, and a halo takes the coefficients of the first rule
+#with gt<gamma<lt. vmax and rmax have (mu,nu) of 2**mu*mloss**nu/(1+mloss)**mu;
+#rh and mstar have (alpha2,beta2,alpha1,beta1), that form at rovera=0.2 and 0.1,
+#interpolated in log rovera. More sets are added with addtrackset.
+TRACKCOEFFS={'default':{
+    'vmax':{True:[(0.75,inf,(0.12,0.29)),(-inf,inf,(0.53,0.53))],
+        False:[(1.25,1.75,(0.4,0.24)),(0.75,inf,(0.4,0.3)),(0.25,inf,(0.4,0.35)),(-inf,inf,(0.4,0.37))]},
+    'rmax':{True:[(0.75,inf,(-0.17,0.43)),(-inf,inf,(-0.85,0.023))],
+        False:[(1.25,1.75,(0,0.48)),(0.75,inf,(-0.3,0.4)),(0.25,inf,(-0.4,0.27)),(-inf,inf,(-1.3,0.05))]},
+    'rh':{True:[(0.5,inf,(0.075,-0.037,-0.10,-0.067)),(-inf,inf,(0.019,-0.18,0.0036,-0.20))],
+        False:[(0.5,inf,(1.22,0.33,1.49,0.35)),(-inf,inf,(1.63,0.03,2.91,0.15))]},
+    'mstar':{True:[(0.5,inf,(0.53,0.20,0.15,0.051)),(-inf,inf,(0.33,0.14,0.14,0.053))],
+        False:[(0.5,inf,(3.57,2.06,3.43,1.86)),(-inf,inf,(0.82,0.82,1.43,0.69))]}}}
+
+#The withscatter tracks (gamma<0.25) multiply the track by one of two factors
+#per mass loss bin. SCATTERBINS are the bin edges in mloss; SCATTERP is the
+#probability of the first factor (1) in each bin, from the top bin down, and
+#SCATTERX the factors of each track (for rh and mstar at rovera=0.2 and 0.1).
+SCATTERBINS=array([0,.1,.2,.5,10])
+SCATTERP=array([1,.9,.625,.5])
+SCATTERX={'vmax':array([[1,0],[1,.85],[1,.8],[1,.8]]),
+    'rmax':array([[1,0],[1,1.1],[1,1.2],[1,1.2]]),
+    'rh':(array([[1,0],[1,1.25],[1,1.5],[1,1.5]]),array([[1,0],[1,1.3],[1,1.4],[1,1.4]])),
+    'mstar':(array([[1,0],[1,.7],[1,.95],[1,.95]]),array([[1,0],[1,.9],[1,.95],[1,.95]]))}
+
+def addtrackset(name,tracks,base='default'):
+    #register the coefficient set name: the set base with the rule lists given
+    #in tracks ({track:{minrmax:rules}}) replaced
+    new=dict((track,dict(rules)) for track,rules in TRACKCOEFFS[base].items())
+    for track,rules in tracks.items():
+        new[track].update(rules)
+    TRACKCOEFFS[name]=new
+
+def _trackcoeffs(track,gamma,minrmax,coeffs):
+    #the coefficients of track for gamma and minrmax, as arrays broadcast over both
+    rules=TRACKCOEFFS[coeffs][track]
+    gamma=asarray(gamma,dtype=float)
+    minrmax=asarray(minrmax,dtype=bool)
+    if gamma.ndim==0 and minrmax.ndim==0:
+        for gt,lt,c in rules[bool(minrmax)]:
+            if gt<gamma<lt:
+                return c
+    out=[full(broadcast(gamma,minrmax).shape,nan) for c in rules[True][0][2]]
+    for mr in (True,False):
+        for gt,lt,c in reversed(rules[mr]):
+            sel=(minrmax==mr)&(gamma>gt)&(gamma<lt)
+            out=[where(sel,ci,o) for ci,o in zip(c,out)]
+    return out
+
+def _loginterp(y2,y1,rovera):
+    #log interpolation between the values y1 at rovera=0.1 and y2 at rovera=0.2
+    return 10**(log10(y2)+(log10(y2)-log10(y1))/(log10(.2)-log10(.1))*(log10(rovera)-log10(.2)))
+
+def _scatterdraw(mloss,gamma,size,rng=None):
+    #bin (from the top) and drawn factor index of each halo, in one batch, and
+    #whether it takes the scatter; rng is a numpy.random.Generator or
+    #RandomState, default the global state
+    w=len(SCATTERBINS)-1-searchsorted(SCATTERBINS,mloss)
+    u=(random if rng is None else rng).uniform(size=size)
+    return w,(u>=SCATTERP[w]).astype(int),asarray(gamma)<.25
+
+def _powertrack(track,mloss,gamma,minrmax,withscatter,rng,coeffs):
+    mu,nu=_trackcoeffs(track,gamma,minrmax,coeffs)
+    value=2**mu*mloss**nu/(1+mloss)**mu
+    if withscatter and (asarray(gamma)<.25).any():
+        w,wx,cored=_scatterdraw(mloss,gamma,shape(value),rng)
+        value=value*where(cored,SCATTERX[track][w,wx],1)
+    return value
+
+def _interptrack(track,mloss,gamma,rovera,minrmax,withscatter,rng,coeffs):
+    alpha2,beta2,alpha1,beta1=_trackcoeffs(track,gamma,minrmax,coeffs)
+    y2=2**alpha2*mloss**beta2/(1+mloss)**alpha2
+    y1=2**alpha1*mloss**beta1/(1+mloss)**alpha1
+    value=_loginterp(y2,y1,rovera)
+    if withscatter and (asarray(gamma)<.25).any():
+        histx2,histx1=SCATTERX[track]
+        w,wx,cored=_scatterdraw(mloss,gamma,shape(value),rng)
+        value=value*where(cored,_loginterp(histx2[w,wx],histx1[w,wx],rovera),1)
+    return value
+
+#The track functions broadcast over arrays of mloss, gamma, rovera and minrmax
+#(booleans), so a mixed population of halos goes in one call; coeffs names the
+#TRACKCOEFFS set.
+
+@instrument.staged
+def getvmaxfinal(mloss,gamma,minrmax=False,withscatter=False,rng=None,coeffs='default'):
+    return _powertrack('vmax',mloss,gamma,minrmax,withscatter,rng,coeffs)
+
+@instrument.staged
+def getrmaxfinal(mloss,gamma,minrmax=False,withscatter=False,rng=None,coeffs='default'):
+    return _powertrack('rmax',mloss,gamma,minrmax,withscatter,rng,coeffs)
+
+@instrument.staged
+def getrhfinal(mloss,gamma,rovera=0.1,minrmax=False,withscatter=False,rng=None,coeffs='default'):
+    return _interptrack('rh',mloss,gamma,rovera,minrmax,withscatter,rng,coeffs)
+
+@instrument.staged
+def getmstarfinal(mloss,gamma,rovera=0.1,minrmax=False,withscatter=False,rng=None,coeffs='default'):
+    return _interptrack('mstar',mloss,gamma,rovera,minrmax,withscatter,rng,coeffs)
+
+@instrument.staged
+def getroverainitial(mloss,gamma,roverafinal=0.1,minrmax=False,coeffs='default'):
+    #inverse of the getrhfinal track (without scatter): the rovera before
+    #stripping x with getrhfinal(mloss,gamma,x,minrmax)*x=roverafinal. The
+    #track is a power law in rovera, r2*(x/.2)**s, so x is closed form.
+    alpha2,beta2,alpha1,beta1=_trackcoeffs('rh',gamma,minrmax,coeffs)
     r2=2**alpha2*mloss**beta2/(1+mloss)**alpha2
     r1=2**alpha1*mloss**beta1/(1+mloss)**alpha1
+    s=(log10(r2)-log10(r1))/(log10(.2)-log10(.1))
+    return 10**((log10(roverafinal)-log10(r2)+s*log10(.2))/(1+s))
 
-    interpvalue=10**(log10(r2)+(log10(r2)-log10(r1))/(log10(.2)-log10(.1))*(log10(rovera)-log10(.2)))
-
-
-    if len(shape(rovera))==0 and len(shape(mloss))!=0:
-        rovera=repeat(rovera,len(mloss))
-
-    if withscatter and gamma<.25:
-        mlbins=array([10,.5,.2,.1,0])
-        histx1=[array([1,0]),array([1,1.3]),array([1,1.4]),array([1,1.4])]
-        histx2=[array([1,0]),array([1,1.25]),array([1,1.5]),array([1,1.5])]
-        histy=[array([1,0]),array([.9,.1]),array([.625,.375]),array([.5,.5])]
-        if len(shape(mloss))==0:
-            w=where(mloss>mlbins)[0][0]-1
-            r=random.rand()
-            wx=where(r<cumsum(histy[w]))[0][0]
-            return interpvalue*10**(log10(histx2[w][wx])+(log10(histx2[w][wx])-log10(histx1[w][wx]))/(log10(.2)-log10(.1))*(log10(rovera)-log10(.2)))
-        else:
-            ret=[]
-            for i in range(len(mloss)):
-                w=where(mloss[i]>mlbins)[0][0]-1
-                r=random.rand()
-                wx=where(r<cumsum(histy[w]))[0][0]
-                ret.append(interpvalue[i]*10**(log10(histx2[w][wx])+(log10(histx2[w][wx])-log10(histx1[w][wx]))/(log10(.2)-log10(.1))*(log10(rovera[i])-log10(.2))))
-            return array(ret)
-
-    return interpvalue
-
-def getmstarfinal(mloss,gamma,rovera=0.1,minrmax=False,withscatter=False):
-
-    if minrmax:
-
-        if gamma>0.5:
-
-            alpha2=0.53
-            beta2=0.20
-
-            alpha1=0.15
-            beta1=0.051
-        else:
-
-            alpha2=0.33
-            beta2=0.14
-            alpha1=0.14
-            beta1=0.053
-    else:
-    
-        if gamma>0.5:
-
-            alpha2=3.57
-            beta2=2.06
-            alpha1=3.43
-            beta1=1.86
-
-        else:
-
-            alpha2=0.82
-            beta2=0.82
-            alpha1=1.43
-            beta1=0.69
-
-    m1=2**alpha1*mloss**beta1/(1+mloss)**alpha1
-    m2=2**alpha2*mloss**beta2/(1+mloss)**alpha2
-
-    interpvalue=10**(log10(m2)+(log10(m2)-log10(m1))/(log10(.2)-log10(.1))*(log10(rovera)-log10(.2)))
-
-    if len(shape(rovera))==0 and len(shape(mloss))!=0:
-        rovera=repeat(rovera,len(mloss))
-    if withscatter and gamma<.25:
-        mlbins=array([10,.5,.2,.1,0])
-        histx1=[array([1,0]),array([1,.9]),array([1,.95]),array([1,.95])]
-        histx2=[array([1,0]),array([1,.7]),array([1,.95]),array([1,.95])]
-        histy=[array([1,0]),array([.9,.1]),array([.625,.375]),array([.5,.5])]
-        if len(shape(mloss))==0:
-            w=where(mloss>mlbins)[0][0]-1
-            r=random.rand()
-            wx=where(r<cumsum(histy[w]))[0][0]
-            return interpvalue*10**(log10(histx2[w][wx])+(log10(histx2[w][wx])-log10(histx1[w][wx]))/(log10(.2)-log10(.1))*(log10(rovera)-log10(.2)))
-        else:
-            ret=[]
-            for i in range(len(mloss)):
-                w=where(mloss[i]>mlbins)[0][0]-1
-                r=random.rand()
-                wx=where(r<cumsum(histy[w]))[0][0]
-                ret.append(interpvalue[i]*10**(log10(histx2[w][wx])+(log10(histx2[w][wx])-log10(histx1[w][wx]))/(log10(.2)-log10(.1))*(log10(rovera[i])-log10(.2))))
-            return array(ret)
-
-    
-    return interpvalue
+@instrument.staged
+def getrhinitial(mloss,gamma,roverafinal=0.1,minrmax=False,coeffs='default'):
+    #rh before over rh after stripping, given the rovera after stripping
+    return getroverainitial(mloss,gamma,roverafinal,minrmax,coeffs)/roverafinal
 
+@instrument.staged
 def getmstarfinalnew(mlossrmax,gamma,rovera=0.1):
 
 
 
     return 2**alpha*mlossrmax**beta/(1+mlossrmax)**alpha
     
+@instrument.staged
 def getmstarfinaltim(mlossrmax,gamma,rovera=0.1):
 
     rmaxratio=getrmaxfinal(mlossrmax,gamma,minrmax=True)
     return getmstarfinal((rovera+1)/(rovera+rmaxratio),gamma,rovera)
 
+@instrument.staged
 def getrstarfinaltim(mlossrmax,gamma,rovera=0.1):
 
     rmaxratio=getrmaxfinal(mlossrmax,gamma,minrmax=True)
     return getrhfinal((rovera+1)/(rovera+rmaxratio),gamma,rovera,minrmax=False)
+
+#the fits from Raphael for 0.75<gamma (outside 1.25..1.75) without minrmax
+addtrackset('raphael',{
+    'vmax':{False:[(1.25,1.75,(0.4,0.24)),(0.75,inf,(0.67,0.37)),(0.25,inf,(0.4,0.35)),(-inf,inf,(0.4,0.37))]},
+    'rmax':{False:[(1.25,1.75,(0,0.48)),(0.75,inf,(0.95,0.58)),(0.25,inf,(-0.4,0.27)),(-inf,inf,(-1.3,0.05))]}})
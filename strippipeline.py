@@ -0,0 +1,158 @@
+"""
+strippipeline.py
+
+Tidal stripping of a subhalo along its orbit history: at every pericenter
+passage the host NFW profile, the tidal radius and the getmlossp10 stripped
+profile, for CDM (cuspy, gamma=1) or SIDM (cored, gamma=0) subhalos, e.g.
+
+    pipeline = StrippingPipeline(pericenters, periomega, perimass, pericon)
+    cdmtable = pipeline.run(cdminfall, gamma=1)
+    sidmtable = pipeline.run(sidminfall, gamma=0, checkpoint='sidm.npz')
+
+The history comes back as a profileclass.profiletable array, one row per
+profile from infall through the last passage; profileclass.profilesfromtable
+turns it back into profiles. A passage that leaves no bound halo (no stripped
+profile solves for it) disrupts the subhalo: the history stops at the last
+bound profile and the pipeline's disrupted attribute gives that passage.
+"""
+import os
+import numpy as np
+from astropy import units
+import getmlossp10
+import getrtide
+import instrument
+import profileclass
+
+# The virial overdensity used by default for hosts and stripped subhalos.
+DELTAVIRRHOU = 27191*units.M_sun/units.kpc**3
+
+def _nfwrtide(host, halo, rperi, omega):
+    # getrtide.getrtidenfw of a subhalo of its virial mass in an NFW host.
+    return getrtide.getrtidenfw(host.rho0, host.rs, halo.mvir, rperi, omega)
+
+class StrippingPipeline(object):
+    """
+    The stripping sequence of one orbit history, run for any infall halo.
+
+    Arguments (one entry per pericenter passage, first to last):
+      pericenters: pericenter radii (Quantity).
+      periomega: angular velocities at pericenter (Quantity).
+      perimass: host virial masses (Quantity).
+      pericon: host concentrations.
+
+    Optional Keyword Arguments:
+      deltavirrhou: virial overdensity of the hosts and the stripped
+        subhalos (default DELTAVIRRHOU).
+      alpha, beta: outer shape of the stripped Zhao profiles (default 1, 3).
+      rtide: function (host, halo, rperi, omega) giving the tidal radius of
+        halo at pericenter (default getrtide.getrtidenfw with the subhalo
+        virial mass).
+    """
+
+    def __init__(self, pericenters, periomega, perimass, pericon,
+        deltavirrhou=DELTAVIRRHOU, alpha=1, beta=3, rtide=_nfwrtide):
+
+        self.pericenters = pericenters
+        self.periomega = periomega
+        self.perimass = perimass
+        self.pericon = np.asarray(pericon, dtype=float)
+        self.deltavirrhou = deltavirrhou
+        self.alpha = alpha
+        self.beta = beta
+        self.rtide = rtide
+
+    def __len__(self):
+        return len(self.pericon)
+
+    def get_host(self, i):
+        """
+        The host NFW profile at passage i (shared through the makeprofile
+        memo, so CDM and SIDM runs build each host once).
+        """
+        return profileclass.makeprofile(profileclass.NFW, mvir=self.perimass[i],
+            c=self.pericon[i], deltavirrhou=self.deltavirrhou)
+
+    def strip(self, halo, i, gamma=1):
+        """
+        Return (stripped halo, tidal radius) of halo at passage i; the
+        stripped halo is None if the passage disrupts it.
+        """
+        rtide = self.rtide(self.get_host(i), halo, self.pericenters[i],
+            self.periomega[i])
+        try:
+            stripped = getmlossp10.getmlossp10(self.alpha, self.beta, gamma,
+                halo.mvir, halo.rs, halo.rvir, halo.rvir, rtide, self.deltavirrhou)
+            bound = np.isfinite([stripped.rho0.value, stripped.rs.value,
+                stripped.rvir.value, stripped.mvir.value]).all()
+        except ValueError:
+            # no profile solves for the stripped vmax, rmax and virial density.
+            bound = False
+        return (stripped if bound else None), rtide
+
+    def _orbit(self):
+        # The orbit history as floats, to tell whether a checkpoint is ours.
+        return np.array([units.Quantity(self.pericenters).to(units.kpc).value,
+            units.Quantity(self.periomega).to(1/units.s).value,
+            units.Quantity(self.perimass).to(units.M_sun).value, self.pericon])
+
+    def _load(self, checkpoint, infall, gamma):
+        # The history and tidal radii saved in checkpoint, if it is a run of
+        # this orbit, infall halo and gamma; otherwise None.
+        if checkpoint is None or not os.path.exists(checkpoint):
+            return None
+        data = np.load(checkpoint)
+        history = profileclass.profilesfromtable(data['table'])
+        if (data['gamma'] != gamma or not np.array_equal(data['orbit'], self._orbit())
+            or history[0].get_record() != infall.get_record()):
+            raise ValueError('checkpoint %s is of a different run' % checkpoint)
+        disrupted = int(data['disrupted'])
+        return history, list(data['rtide']), (disrupted if disrupted >= 0 else None)
+
+    def _save(self, checkpoint, history, rtides, gamma, disrupted):
+        # Write the checkpoint atomically, so an interrupted write leaves the
+        # previous one.
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, table=profileclass.profiletable(history),
+                rtide=np.array(rtides), gamma=gamma, orbit=self._orbit(),
+                disrupted=-1 if disrupted is None else disrupted)
+        os.rename(tmp, checkpoint)
+
+    @instrument.staged
+    def run(self, infall, gamma=1, checkpoint=None):
+        """
+        Strip infall at every passage and return the history as a
+        profileclass.profiletable array (infall first). The tidal radius in
+        kpc at each passage is kept as the rtides attribute. Every stripped
+        profile is checked before it is added: if a passage leaves no bound
+        halo, the run stops there, the table ends with the last bound profile
+        and the disrupted attribute is the index of that passage (None if
+        the subhalo survives the whole orbit).
+
+        Arguments:
+          infall: profile of the subhalo at infall.
+
+        Optional Keyword Arguments:
+          gamma: inner slope of the stripped profiles, 1 for CDM and 0 for
+            SIDM (default 1).
+          checkpoint: file the history is saved to after every passage; a
+            run with an existing checkpoint of the same orbit, infall halo
+            and gamma resumes after its last passage.
+        """
+        saved = self._load(checkpoint, infall, gamma)
+        history, rtides, disrupted = saved if saved is not None else ([infall], [], None)
+        start = len(self) if disrupted is not None else len(history) - 1
+        for i in range(start, len(self)):
+            halo, rtide = self.strip(history[-1], i, gamma)
+            if halo is None:
+                disrupted = i
+            else:
+                history.append(halo)
+                rtides.append(units.Quantity(rtide, units.kpc).value)
+            if checkpoint is not None:
+                self._save(checkpoint, history, rtides, gamma, disrupted)
+            if disrupted is not None:
+                break
+        self.rtides = np.array(rtides)
+        self.disrupted = disrupted
+        return profileclass.profiletable(history)
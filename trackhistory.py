@@ -0,0 +1,145 @@
+"""
+trackhistory.py
+
+Composition of the rubiatracks tidal tracks over the pericenter passages of a
+whole population of satellites. The passages of all satellites are stored as
+one flat array plus offsets (satellite i has the passages
+offsets[i]:offsets[i+1]), and every passage index is one vectorized step over
+all satellites that still have passages left.
+"""
+from collections import OrderedDict
+import numpy as np
+import instrument
+import rubiatracks
+
+COLUMNS = ('vmax', 'rmax', 'rh', 'mstar', 'rovera')
+
+class TrackHistory(object):
+    """
+    The satellite states after every pericenter passage, as columns.
+
+    Attributes:
+      offsets: int array of length nsat+1; the passages of satellite i are
+        the entries offsets[i]:offsets[i+1] of the passage columns.
+      initial: OrderedDict of the COLUMNS at infall, one entry per satellite.
+      passages: OrderedDict of the COLUMNS after each passage, flat arrays
+        aligned with the mass loss input.
+    """
+
+    def __init__(self, offsets, initial, passages):
+        self.offsets = offsets
+        self.initial = initial
+        self.passages = passages
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def final(self):
+        """
+        Return an OrderedDict of the COLUMNS after the last passage of each
+        satellite (the infall state for satellites without passages).
+        """
+        last = self.offsets[1:] - 1
+        stripped = np.diff(self.offsets) > 0
+        final = OrderedDict()
+        for name in COLUMNS:
+            final[name] = self.initial[name].copy()
+            final[name][stripped] = self.passages[name][last[stripped]]
+        return final
+
+    def get_satellite(self, i):
+        """
+        Return an OrderedDict of the COLUMNS of satellite i from infall
+        through its last passage.
+        """
+        sl = slice(self.offsets[i], self.offsets[i+1])
+        return OrderedDict((name, np.concatenate([[self.initial[name][i]],
+            self.passages[name][sl]])) for name in COLUMNS)
+
+    def to_records(self):
+        """
+        Return the passages as a numpy record array with the satellite and
+        passage index of each row.
+        """
+        counts = np.diff(self.offsets)
+        sat = np.repeat(np.arange(len(self)), counts)
+        passage = np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], counts)
+        return np.rec.fromarrays([sat, passage] + [self.passages[name] for name in COLUMNS],
+            names=['satellite', 'passage'] + list(COLUMNS))
+
+@instrument.staged
+def composetracks(mloss, offsets, gamma, rovera=0.1, minrmax=False, vmax=1.,
+    rmax=1., mstar=1., rs=1., scaleradius='rmax', withscatter=False, rng=None,
+    coeffs='default'):
+    """
+    Apply the rubiatracks vmax, rmax, rh and mstar tracks passage after
+    passage to a population of satellites and return their TrackHistory.
+
+    Each passage scales vmax, rmax and mstar by the track values for its mass
+    loss and the current r/a, and the half-light radius rh by the rh track.
+    Within a passage the tracks hold the halo scale radius a at its value
+    before the passage, as in backtracks; scaleradius sets the a the next
+    passage starts from, and so r/a after each passage.
+
+    Arguments:
+      mloss: flat array of the mass loss (M(<rmax) after over before) of
+        every passage, satellite by satellite.
+      offsets: int array of length nsat+1 into mloss, with offsets[0]=0 and
+        offsets[-1]=len(mloss).
+      gamma, minrmax: inner slope and track choice, scalars or one per
+        satellite.
+      rovera, vmax, rmax, mstar, rs: infall r/a, vmax, rmax, stellar mass and
+        halo scale radius, scalars or one per satellite (floats in any fixed
+        units; the defaults give the states relative to infall).
+      scaleradius: the scale radius convention between passages:
+        'rmax': a follows the rmax track (a fixed halo shape, the default);
+        'fixed': a keeps its infall value;
+        or a flat array aligned with mloss of the scale radius after over
+        before each passage, e.g. from the profiles of a halo history (the
+        convention of backtracks, which reads rs off each profile).
+      withscatter, rng, coeffs: as for the rubiatracks functions.
+    """
+    mloss = np.asarray(mloss, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)
+    if offsets[0] != 0 or offsets[-1] != len(mloss) or (counts < 0).any():
+        raise ValueError('offsets do not partition the mass loss array')
+    nsat = len(counts)
+    if isinstance(scaleradius, str):
+        if scaleradius not in ('rmax', 'fixed'):
+            raise ValueError("scaleradius is 'rmax', 'fixed' or an array of ratios")
+    else:
+        scaleradius = np.broadcast_to(np.asarray(scaleradius, dtype=float), mloss.shape)
+
+    def persat(x, dtype=float):
+        return np.broadcast_to(np.asarray(x, dtype=dtype), (nsat,)).copy()
+
+    gamma = persat(gamma)
+    minrmax = persat(minrmax, bool)
+    state = OrderedDict([('vmax', persat(vmax)), ('rmax', persat(rmax)),
+        ('rh', persat(rovera)*persat(rs)), ('mstar', persat(mstar)),
+        ('rovera', persat(rovera))])
+    initial = OrderedDict((name, col.copy()) for name, col in state.items())
+    passages = OrderedDict((name, np.empty(len(mloss))) for name in COLUMNS)
+
+    start = offsets[:-1]
+    for k in range(counts.max() if nsat else 0):
+        sel = np.nonzero(counts > k)[0]
+        row = start[sel] + k
+        m, g, mr, ra = mloss[row], gamma[sel], minrmax[sel], state['rovera'][sel]
+        vfac = rubiatracks.getvmaxfinal(m, g, mr, withscatter, rng, coeffs)
+        rfac = rubiatracks.getrmaxfinal(m, g, mr, withscatter, rng, coeffs)
+        hfac = rubiatracks.getrhfinal(m, g, ra, mr, withscatter, rng, coeffs)
+        sfac = rubiatracks.getmstarfinal(m, g, ra, mr, withscatter, rng, coeffs)
+        state['vmax'][sel] *= vfac
+        state['rmax'][sel] *= rfac
+        state['rh'][sel] *= hfac
+        state['mstar'][sel] *= sfac
+        if isinstance(scaleradius, str):
+            afac = rfac if scaleradius == 'rmax' else 1.0
+        else:
+            afac = scaleradius[row]
+        state['rovera'][sel] = ra*hfac/afac
+        for name in COLUMNS:
+            passages[name][row] = state[name][sel]
+    return TrackHistory(offsets, initial, passages)